@@ -8,16 +8,30 @@
 
 import struct
 from batchtable import BatchTable
-from featuretable import FeatureTable
+from bufferpool import assemble
+from featuretable import InstanceFeatureTable, Semantic, finalizeTables
 
 B3DM_MAGIC = 'b3dm'
 B3DM_VERSION = 1
 B3DM_HEADER_LEN = 28
 
+B3DM_SEMANTICS = {
+	# Global semantics; b3dm has no per-feature semantics
+	'BATCH_LENGTH' : Semantic(('u32',), 1, True),
+	'RTC_CENTER' : Semantic(('f32',), 3, True),
+}
+
 class B3DM:
 	def __init__(self):
 		self.batch_table = BatchTable()
-		self.feature_table = FeatureTable()
+		self.feature_table = InstanceFeatureTable(B3DM_SEMANTICS, 'BATCH_LENGTH')
+		self.gltf_bin = bytearray()
+
+	def reset(self):
+		""" Discard all loaded and encoded data so that this encoder can be
+			reused for another tile. Call this between writeBinary() calls. """
+		self.batch_table.reset()
+		self.feature_table.reset()
 		self.gltf_bin = bytearray()
 
 	def loadJSONBatch(self, data_in, object_wise = True):
@@ -26,7 +40,7 @@ class B3DM:
 	def loadJSONFeature(self, data_in, object_wise = True):
 		self.feature_table.loadJSONBatch(data_in, object_wise)
 
-	def writeBinary(self, gltf_bin, num_batch_features = 0, num_feature_features = 0):
+	def writeBinary(self, gltf_bin, num_batch_features = 0, num_feature_features = 0, pool = None, executor = None):
 
 		# Add the required field BATCH_LENGTH to the feature table,
 		# as well as any other required globals
@@ -34,38 +48,25 @@ class B3DM:
 		self.feature_table.addGlobal('BATCH_LENGTH', num_batch_features)
 		num_feature_features = max(num_feature_features, self.feature_table.getNumFeatures())
 
-		self.batch_table.finalize()
-		self.feature_table.finalize()
+		finalizeTables(self.batch_table, self.feature_table, executor)
 
 		# Generate the header
-		output = self.writeHeader(gltf_bin, num_batch_features, num_feature_features)
-
-		# Add the feature table JSON to the output
-		feature_json = self.feature_table.getFeatureJSON()
-		output.extend(feature_json)
-
-		# Add the feature table binary to the output
-		feature_bin  = self.feature_table.getFeatureBin()
-		output.extend(feature_bin)
+		header = self.writeHeader(gltf_bin, num_batch_features, num_feature_features)
 
-		# Add the batch table JSON to the output
-		batch_json = self.batch_table.getBatchJSON()
-		output.extend(batch_json)
+		# Lay out the feature table JSON and binary, the batch table JSON
+		# and binary, and the GLTF model body
+		sections = [header,
+		            self.feature_table.features_json, self.feature_table.features_bin,
+		            self.batch_table.batch_json, self.batch_table.batch_bin,
+		            gltf_bin]
 
-		# Add the batch table binary to the output
-		batch_bin  = self.batch_table.getBatchBin()
-		output.extend(batch_bin)
-
-		# Add the GLTF model body to the output
-		output.extend(gltf_bin)
-
-		return output
+		return assemble(sections, pool)
 
 	def writeHeader(self, gltf_bin, num_feature_features, num_batch_features):
-		len_feature_json = len(self.feature_table.getFeatureJSON())
-		len_feature_bin  = len(self.feature_table.getFeatureBin())
-		len_batch_json   = len(self.batch_table.getBatchJSON())
-		len_batch_bin    = len(self.batch_table.getBatchBin())
+		len_feature_json = len(self.feature_table.features_json)
+		len_feature_bin  = len(self.feature_table.features_bin)
+		len_batch_json   = len(self.batch_table.batch_json)
+		len_batch_bin    = len(self.batch_table.batch_bin)
 
 		length = B3DM_HEADER_LEN + \
 		         len_feature_json + len_feature_bin + \
@@ -115,6 +116,14 @@ class B3DM:
 	def getGLTFBin(self):
 		return self.gltf_bin
 
+	def readFeatureTable(self):
+		""" Decode the feature table read by readBinary() into
+			self.feature_table, with binary semantics as NumPy arrays
+			that view the tile data rather than copying it """
+		self.feature_table.reset()
+		self.feature_table.loadBinary(self.feature_json, self.feature_bin)
+		return self.feature_table
+
 	def unpackString(self, data, length):
 		self.offset += length
 		return data[self.offset - length : self.offset]
@@ -10,12 +10,43 @@ import struct
 import json
 import numpy as np
 
+from bufferpool import OutputBuffer
+
+HIERARCHY_EXTENSION = '3DTILES_batch_table_hierarchy'
+
+""" How columns that only some features have values for are written:
+	- SPARSE_NULLS (the default): as plain JSON arrays, with null for
+	  missing values, which every 3D Tiles 1.0 client reads
+	- SPARSE_HIERARCHY: by splitting the features into one class per set
+	  of present keys with 3DTILES_batch_table_hierarchy, so that no
+	  nulls are written at all, and the class IDs are binary
+	- SPARSE_AUTO: as a hierarchy if any column was loaded sparse (see
+	  loadJSONBatch) and the hierarchy is smaller than the nulls would
+	  be, since nulls grow with features times keys
+	Tiles written with a hierarchy need a client that supports the
+	extension, and the tileset should list it in extensionsUsed. """
+SPARSE_NULLS = 'nulls'
+SPARSE_HIERARCHY = 'hierarchy'
+SPARSE_AUTO = 'auto'
+SPARSE_ENCODINGS = (SPARSE_AUTO, SPARSE_NULLS, SPARSE_HIERARCHY)
+
+def dumpJSON(value):
+	return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+def finalizeTable(table):
+	""" Finalize a batch table and return its JSON and binary. This is a
+		module-level function so that it can run in a process pool. """
+	table.finalize()
+	return table.batch_json, table.batch_bin
+
 class BatchTable:
-	def __init__(self):
+	def __init__(self, sparse_encoding = SPARSE_NULLS):
 		self.batch_in = {}
-		self.batch_json = bytearray()
-		self.batch_bin = bytearray()
+		self.sparse_in = {}
+		self.batch_json = OutputBuffer()
+		self.batch_bin = OutputBuffer()
 		self.num_features = 0
+		self.sparse_encoding = sparse_encoding
 
 	def loadJSONBatch(self, data_in, object_wise = True):
 		""" Load object batch data from a dict/object. The data could,
@@ -27,7 +58,9 @@ class BatchTable:
 			method will transpose the data to map keys to
 			arrays of values, one for each object. It handles
 			keys that only exist for a subset of the batched
-			obhects.
+			objects: those are kept as sparse columns holding
+			only the indices and values of the objects that
+			have them, in self.sparse_in.
 	
 			If object_wise is False, then it is assumed that
 			the input data already maps keys to arrays of
@@ -36,37 +69,162 @@ class BatchTable:
 			have a real value for that particular object.
 		"""
 		if object_wise:
-			n_objs = len(data_in)
 			# Find all the fields for all the objects
 			if type(data_in) is list:
-				data_in = {i: data_in[i] for i in range(len(data_in))}
-			for obj, objval in data_in.items():
-				obj = int(obj)
+				items = enumerate(data_in)
+				n_objs = len(data_in)
+			else:
+				items = sorted((int(obj), objval) for obj, objval in data_in.items())
+				n_objs = items[-1][0] + 1 if items else 0
 
+			columns = {}
+			for obj, objval in items:
 				# Add this object's key-vals
 				for key, val in objval.items():
-					if not key in self.batch_in:
-						self.batch_in[key] = [None] * n_objs
+					if not key in columns:
+						columns[key] = ([], [])
+					columns[key][0].append(obj)
+					columns[key][1].append(val)
 
-					self.batch_in[key][obj] = val
-
-				n_objs += 1
+			# Columns every object has a value for are stored densely
+			for key, (indices, values) in columns.items():
+				if len(indices) == n_objs:
+					self.batch_in[key] = values
+				else:
+					self.sparse_in[key] = (indices, values)
+			self.num_features = n_objs
 
 		else:
 			self.batch_in = data_in
-		if len(self.batch_in):
-			first_key = next(iter(self.batch_in))
-			self.num_features = len(self.batch_in[first_key])
+			if len(self.batch_in):
+				first_key = next(iter(self.batch_in))
+				self.num_features = len(self.batch_in[first_key])
+
+	def densify(self):
+		""" Convert sparse columns to dense ones, with None for missing values """
+		for key, (indices, values) in self.sparse_in.items():
+			column = [None] * self.num_features
+			for idx, val in zip(indices, values):
+				column[idx] = val
+			self.batch_in[key] = column
+		self.sparse_in = {}
 
 	def writeOutput(self):
+		encoding = self.sparse_encoding
+		if encoding == SPARSE_AUTO and not self.sparse_in:
+			encoding = SPARSE_NULLS
+		if encoding != SPARSE_NULLS:
+			batch_json = dumpJSON(self.writeHierarchy()).encode('utf-8')
+			if encoding == SPARSE_HIERARCHY or len(batch_json) + len(self.batch_bin) < self.nullsLength():
+				self.batch_json.assign(batch_json)
+				return
+			self.batch_bin.clear()
+
+		# Write the JSON one column at a time, so that sparse columns'
+		# nulls never need to exist as Python lists. The output matches
+		# json.dumps(..., sort_keys=True) of the equivalent dense table.
+		columns = []
+		for key in sorted(set(self.batch_in) | set(self.sparse_in)):
+			if key in self.sparse_in:
+				column = self.sparseColumnJSON(*self.sparse_in[key])
+			else:
+				column = dumpJSON(self.batch_in[key])
+			columns.append(dumpJSON(key) + ':' + column)
+		self.batch_json.assign(('{' + ','.join(columns) + '}').encode('utf-8'))
+
+	def nullsLength(self):
+		""" The length of the JSON that SPARSE_NULLS would write, counted
+			without writing out the nulls """
+		n = self.num_features
+		length = 1 + max(len(self.batch_in) + len(self.sparse_in), 1)		# Braces and commas
+		for key, column in self.batch_in.items():
+			length += len(dumpJSON(key)) + 1 + len(dumpJSON(column))
+		for key, (indices, values) in self.sparse_in.items():
+			length += len(dumpJSON(key)) + 1 + 1 + max(n, 1) + 4 * (n - len(values)) + \
+			          sum(len(dumpJSON(val)) for val in values)
+		return length
+
+	def sparseColumnJSON(self, indices, values):
+		parts = []
+		prev = -1
+		for idx, val in zip(indices, values):
+			if idx - prev > 1:
+				parts.append(('null,' * (idx - prev - 1))[:-1])
+			parts.append(dumpJSON(val))
+			prev = idx
+		if self.num_features - prev > 1:
+			parts.append(('null,' * (self.num_features - prev - 1))[:-1])
+		return '[' + ','.join(parts) + ']'
+
+	def writeHierarchy(self):
+		""" Return the batch table JSON, with every column that all features
+			have a value for as a plain array, and the rest split into one
+			3DTILES_batch_table_hierarchy class per distinct set of keys """
+		n = self.num_features
 		data_out = {}
-		# TODO: Add proper encoding to JSON + binary, rather than just
-		# punting to the naive method
-		data_out = self.batch_in
-		self.batch_json = bytearray(json.dumps(data_out, separators=(',', ':'), sort_keys=True), encoding='utf8')
+		columns = {}
+		for key, column in self.batch_in.items():
+			if isinstance(column, dict):
+				data_out[key] = column			# Binary, so never sparse
+				continue
+			indices = [i for i, val in enumerate(column) if val is not None]
+			if len(indices) == n:
+				data_out[key] = column
+			else:
+				columns[key] = (indices, [column[i] for i in indices])
+		columns.update(self.sparse_in)
+		if not columns:
+			return data_out
+
+		# Group the features exactly by a bitmap of the keys they have:
+		# np.unique sorts the bitmaps, so its inverse is each class ID
+		keys = sorted(columns)
+		bitmaps = np.zeros((n, (len(keys) + 7) // 8), dtype = np.uint8)
+		for bit, key in enumerate(keys):
+			indices = np.asarray(columns[key][0], dtype = np.int64)
+			bitmaps[indices, bit >> 3] |= np.uint8(0x80 >> (bit & 7))
+		rows = np.ascontiguousarray(bitmaps).view(np.dtype((np.void, bitmaps.shape[1]))).reshape(n)
+		class_bitmaps, class_ids = np.unique(rows, return_inverse = True)
+		class_ids = class_ids.reshape(n)
+		lengths = np.bincount(class_ids, minlength = len(class_bitmaps))
+		classes = [{'name': 'class%d' % class_id, 'length': int(length), 'instances': {}} \
+		           for class_id, length in enumerate(lengths)]
+
+		# Sort each key's values by class, then by feature, so that every
+		# class's values are one contiguous run
+		for key in keys:
+			indices, values = columns[key]
+			indices = np.asarray(indices, dtype = np.int64)
+			key_classes = class_ids[indices]
+			order = np.lexsort((indices, key_classes))
+			ordered = [values[i] for i in order.tolist()]
+			sorted_classes = key_classes[order]
+			starts = np.flatnonzero(np.diff(sorted_classes, prepend = -1)).tolist() + [len(order)]
+			for start, end in zip(starts, starts[1:]):
+				classes[sorted_classes[start]]['instances'][key] = ordered[start:end]
+
+		# Class IDs go in the binary body, in the smallest type that fits
+		class_ids = class_ids.astype(np.uint8 if len(classes) <= 0xFF else \
+		                             np.uint16 if len(classes) <= 0xFFFF else np.uint32)
+		offset = len(self.batch_bin) + class_ids.itemsize - 1 & ~(class_ids.itemsize - 1)
+		self.batch_bin.extend(bytes(offset - len(self.batch_bin)))
+		self.batch_bin.extend(class_ids.astype(class_ids.dtype.newbyteorder('<')).tobytes())
+		component_type = {1: 'UNSIGNED_BYTE', 2: 'UNSIGNED_SHORT', 4: 'UNSIGNED_INT'}[class_ids.itemsize]
+
+		data_out['extensions'] = {HIERARCHY_EXTENSION: {
+			'classes': classes,
+			'instancesLength': n,
+			'classIds': {'byteOffset': offset, 'componentType': component_type},
+		}}
+		return data_out
 
-		# TODO: Why do we clear this?
-		self.batch_in = bytearray()
+	def reset(self):
+		""" Clear all loaded data and output, so that this table can be
+			used to encode another tile """
+		self.batch_in = {}
+		self.sparse_in = {}
+		self.batch_json.clear()
+		self.batch_bin.clear()
 		self.num_features = 0
 
 	def finalize(self):
@@ -75,24 +233,56 @@ class BatchTable:
 
 		# Pad with spaces to a multiple of 4 bytes
 		padded_batch_json_len = len(self.batch_json) + 3 & ~3
-		self.batch_json.extend([ord(' ')] * (padded_batch_json_len - len(self.batch_json)))
+		self.batch_json.extend(b' ' * (padded_batch_json_len - len(self.batch_json)))
 
 		padded_batch_bin_len = len(self.batch_bin) + 3 & ~3
-		self.batch_bin.extend([ord(' ')] * (padded_batch_bin_len - len(self.batch_bin)))
+		self.batch_bin.extend(b' ' * (padded_batch_bin_len - len(self.batch_bin)))
+
+	def setOutput(self, batch_json, batch_bin):
+		""" Adopt output finalized elsewhere, such as by finalizeTable() in
+			another process """
+		if batch_json is not self.batch_json:
+			self.batch_json.assign(batch_json.view())
+			self.batch_bin.assign(batch_bin.view())
 
 	"""
-	Returns a bytearray of the JSON for the batch, ready to embed in another binary stream
+	Returns a copy of the JSON for the batch, ready to embed in another binary stream
 	"""
 	def getBatchJSON(self):
-		return self.batch_json
+		return bytes(self.batch_json)
 
 	def getBatchBin(self):
-		return self.batch_bin
+		return bytes(self.batch_bin)
 
 	def getNumFeatures(self):
 		return self.num_features
 
 	""" A few utilities """
+	@staticmethod
+	def expandHierarchy(batch, batch_bin):
+		""" Flatten a batch table JSON dict that uses
+			3DTILES_batch_table_hierarchy into plain dense columns, with
+			None for missing values. Parent classes are not followed. """
+		extension = batch.get('extensions', {}).get(HIERARCHY_EXTENSION)
+		if extension is None:
+			return batch
+		n = extension['instancesLength']
+		class_ids = extension['classIds']
+		if isinstance(class_ids, dict):
+			dtype = {'UNSIGNED_BYTE': '<u1', 'UNSIGNED_SHORT': '<u2', 'UNSIGNED_INT': '<u4'}[ \
+			         class_ids.get('componentType', 'UNSIGNED_SHORT')]
+			class_ids = np.frombuffer(batch_bin, dtype = dtype, count = n, offset = class_ids['byteOffset'])
+		class_ids = np.asarray(class_ids)
+
+		flat = {key: val for key, val in batch.items() if key != 'extensions'}
+		for class_id, cls in enumerate(extension['classes']):
+			features = np.flatnonzero(class_ids == class_id)
+			for key, values in cls['instances'].items():
+				column = flat.setdefault(key, [None] * n)
+				for feature, val in zip(features.tolist(), values):
+					column[feature] = val
+		return flat
+
 	def nestedListToBin(self, val, val_type):
 		val_codes = {'f32' : 'f', 'u16' : 'H', 'u8' : 'B'}
 		if val_type not in val_codes:
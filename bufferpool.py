@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------
+# bufferpool.py: Component of GLTF to GLB converter
+# Reusable output buffers for encoding many tiles
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#--------------------------------------------------
+
+import threading
+
+class BufferPool:
+	""" A pool of bytearrays that are handed out for encoder output
+		and returned once the caller is done with the encoded tile.
+		Buffers only ever grow, so a loop encoding similar tiles
+		reaches a steady state with no large allocations per tile.
+	"""
+	def __init__(self, max_buffers = 8):
+		self.max_buffers = max_buffers
+		self.free = []
+		self.lock = threading.Lock()
+
+	def acquire(self, size):
+		""" Returns a bytearray of at least size bytes. Its contents
+			are undefined.
+		"""
+		with self.lock:
+			# Prefer the smallest free buffer that is already big enough
+			fits = [buf for buf in self.free if len(buf) >= size]
+			if fits:
+				buf = min(fits, key = len)
+			elif self.free:
+				buf = max(self.free, key = len)
+			else:
+				buf = None
+			if buf is not None:
+				self.free.remove(buf)
+
+		if buf is None:
+			buf = bytearray(size)
+		elif len(buf) < size:
+			buf.extend(bytes(size - len(buf)))
+		return buf
+
+	def release(self, buf):
+		""" Returns a buffer (or a memoryview obtained from assemble())
+			to the pool. Views must not be used after this.
+		"""
+		if isinstance(buf, memoryview):
+			view, buf = buf, buf.obj
+			view.release()
+		with self.lock:
+			if len(self.free) < self.max_buffers:
+				self.free.append(buf)
+
+class OutputBuffer:
+	""" A bytearray with an explicit length, for the sections an encoder
+		writes. A bytearray frees its memory when it is truncated, so
+		clear() only resets the length, and later writes overwrite the
+		old contents in place; an encoder that is reset() for each tile
+		then stops allocating once its buffers fit the largest tile.
+	"""
+	def __init__(self, data = b''):
+		self.buf = bytearray(data)
+		self.length = len(self.buf)
+
+	def __len__(self):
+		return self.length
+
+	def __bytes__(self):
+		with self.view() as view:
+			return bytes(view)
+
+	def __getstate__(self):
+		# Only the contents are pickled, not the spare capacity
+		return bytes(self)
+
+	def __setstate__(self, state):
+		self.__init__(state)
+
+	def clear(self):
+		self.length = 0
+
+	def extend(self, data):
+		""" Append bytes-like data. Slice assignment to a bytearray
+			copies anything that is not a bytearray first, so data is
+			written through a memoryview instead, and only the part
+			that does not fit is appended. """
+		data = memoryview(data).cast('B')
+		end = self.length + len(data)
+		fits = min(end, len(self.buf)) - self.length
+		with memoryview(self.buf) as view:
+			view[self.length : self.length + fits] = data[:fits]
+		if fits < len(data):
+			self.buf.extend(data[fits:])
+		self.length = end
+
+	def assign(self, data):
+		""" Replace the contents with data """
+		self.length = 0
+		self.extend(data)
+
+	def view(self):
+		""" Returns a memoryview of the contents. The buffer cannot grow
+			while the view is alive, so release it (or drop it) before
+			writing more. """
+		return memoryview(self.buf)[:self.length]
+
+def assemble(sections, pool = None):
+	""" Concatenates the sections of a tile. Without a pool this returns
+		a new bytearray; with one it fills a pooled buffer and returns a
+		memoryview of exactly the tile's length, which should be handed
+		back to pool.release() after it has been written out. Sections
+		that are OutputBuffers are read through views, released before
+		this returns, so the buffers can be written again.
+	"""
+	views = [section.view() if isinstance(section, OutputBuffer) else section for section in sections]
+	try:
+		if pool is None:
+			return bytearray().join(views)
+
+		length = sum(len(view) for view in views)
+		buf = memoryview(pool.acquire(length))
+		offset = 0
+		for view in views:
+			buf[offset : offset + len(view)] = view
+			offset += len(view)
+		output = buf[:length]
+		buf.release()
+		return output
+	finally:
+		for view, section in zip(views, sections):
+			if view is not section:
+				view.release()
@@ -9,16 +9,25 @@
 
 import struct
 import json
-from batchtable import BatchTable
+from collections import namedtuple
+import numpy as np
+
+from batchtable import BatchTable, finalizeTable
+from bufferpool import OutputBuffer
 
 class FeatureTable(BatchTable):
 	def __init__(self):
 		BatchTable.__init__(self)
 		self.features_global = {}
-		self.features_json = bytearray()
-		self.features_bin  = bytearray()
+		self.features_json = OutputBuffer()
+		self.features_bin  = OutputBuffer()
 		self.num_global_features = 0
 
+	def loadJSONBatch(self, data_in, object_wise = True):
+		# Feature semantics always have a value for every feature
+		BatchTable.loadJSONBatch(self, data_in, object_wise)
+		self.densify()
+
 	def addGlobal(self, key, value):
 		self.features_global[key] = value
 		self.num_global_features += 1
@@ -27,14 +36,15 @@ class FeatureTable(BatchTable):
 		data_out = {}
 		# TODO: Add proper encoding to JSON + binary, rather than just
 		# punting to the naive method
-		data_out = self.features_global
+		data_out = dict(self.features_global)
 		data_out.update(self.batch_in)
-		self.features_json = bytearray(json.dumps(data_out, separators=(',', ':'), sort_keys=True), encoding='utf-8')
-		
-		# TODO: Why do we clear these?
-		self.batch_in = bytearray()
-		self.features_global = bytearray()
-		self.num_features = 0
+		self.features_json.assign(json.dumps(data_out, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+	def reset(self):
+		BatchTable.reset(self)
+		self.features_global = {}
+		self.features_json.clear()
+		self.features_bin.clear()
 		self.num_global_features = 0
 
 	def finalize(self):
@@ -43,39 +53,216 @@ class FeatureTable(BatchTable):
 
 		# Pad with spaces to a multiple of 4 bytes
 		padded_features_json_len = len(self.features_json) + 3 & ~3
-		self.features_json.extend([ord(' ')] * (padded_features_json_len - len(self.features_json)))
+		self.features_json.extend(b' ' * (padded_features_json_len - len(self.features_json)))
 
 		padded_features_bin_len = len(self.features_bin) + 3 & ~3
-		self.features_bin.extend([ord(' ')] * (padded_features_bin_len - len(self.features_bin)))
+		self.features_bin.extend(b' ' * (padded_features_bin_len - len(self.features_bin)))
 
 	"""
-	Returns a bytearray of the JSON for the features, ready to embed in another binary stream
+	Returns a copy of the JSON for the features, ready to embed in another binary stream
 	"""
 	def getFeatureJSON(self):
-		return self.features_json
+		return bytes(self.features_json)
 
 	def getFeatureBin(self):
-		return self.features_bin
+		return bytes(self.features_bin)
+
+""" Component types that can appear in a feature table binary body,
+	keyed by the short names used by the semantics registries below. """
+COMPONENT_TYPES = {
+	'i8'  : ('BYTE', '<i1'),
+	'u8'  : ('UNSIGNED_BYTE', '<u1'),
+	'i16' : ('SHORT', '<i2'),
+	'u16' : ('UNSIGNED_SHORT', '<u2'),
+	'i32' : ('INT', '<i4'),
+	'u32' : ('UNSIGNED_INT', '<u4'),
+	'f32' : ('FLOAT', '<f4'),
+	'f64' : ('DOUBLE', '<f8'),
+}
+COMPONENT_TYPE_NAMES = {name: short for short, (name, _) in COMPONENT_TYPES.items()}
+
+class Semantic(namedtuple('Semantic', ['component_types', 'components', 'is_global'])):
+	""" An entry in a semantics registry. component_types lists the legal
+		component types for the semantic, default first; components is
+		the number of components per feature (or for the global value);
+		is_global marks semantics that apply to the whole tile rather
+		than to each feature.
+	"""
+	def dtype(self, component_type = None):
+		return np.dtype(COMPONENT_TYPES[component_type or self.component_types[0]][1])
+
+	def pickComponentType(self, values):
+		""" Choose the smallest legal component type that can hold all of
+			values. Only integer semantics with alternatives (BATCH_ID)
+			actually have a choice to make. """
+		if len(self.component_types) == 1:
+			return self.component_types[0]
+		values = np.asarray(values)
+		if not values.size:
+			return self.component_types[0]
+		lo, hi = values.min(), values.max()
+		for component_type in sorted(self.component_types, key = lambda ct: self.dtype(ct).itemsize):
+			info = np.iinfo(self.dtype(component_type))
+			if info.min <= lo and hi <= info.max:
+				return component_type
+		raise ValueError("Values [%s, %s] do not fit any of %s" % (lo, hi, self.component_types))
+
+	def pack(self, values, component_type = None):
+		""" Convert a (nested) list or array of values into a contiguous
+			little-endian array of the given component type """
+		packed = np.ascontiguousarray(values, dtype = self.dtype(component_type))
+		if packed.size % self.components:
+			raise ValueError("%d values is not a multiple of %d components" % (packed.size, self.components))
+		return packed
+
+""" Keys that any feature table may have besides its semantics, which
+	are passed through to the JSON unchanged """
+PASSTHROUGH_KEYS = ('extensions', 'extras')
+
+def packColumn(semantic, values):
+	""" Pick the component type for a feature semantic's values, and pack
+		them. This is a module-level function so that it can run in a
+		process pool; NumPy releases the GIL for most of the work, so a
+		thread pool also runs columns in parallel. """
+	component_type = semantic.pickComponentType(values)
+	return component_type, semantic.pack(values, component_type)
+
+def finalizeTables(batch_table, feature_table, executor = None):
+	""" Finalize a tile's batch and feature tables. With an executor, the
+		batch table is serialized while the feature columns are packed;
+		the output is identical either way. JSON serialization holds the
+		GIL, so with a thread pool only the NumPy packing runs alongside
+		it; a process pool runs both at once, but pickles the tables. """
+	if executor is None:
+		batch_table.finalize()
+		feature_table.finalize()
+		return
+	batch_output = executor.submit(finalizeTable, batch_table)
+	feature_table.finalize(executor)
+	batch_table.setOutput(*batch_output.result())
 
 class InstanceFeatureTable(FeatureTable):
-	def __init__(self, instance_semantics):
+	""" A feature table whose contents are validated and laid out according
+		to a semantics registry, mapping names to Semantic entries. Feature
+		semantics are packed into the binary body; global semantics go in
+		the JSON unless they are added with addGlobal(..., binary = True).
+		length_key names the global holding the number of features.
+	"""
+	def __init__(self, instance_semantics, length_key = None):
 		FeatureTable.__init__(self)
 		self.instance_semantics = instance_semantics
-		
-	def finalize(self):
-		new_batch_in = {}
-		for key, val in self.batch_in.items():
-			offset = len(self.features_bin)
-			
-			buf_bin = None
-			if key in self.instance_semantics:
-				buf_bin = self.nestedListToBin(val, self.instance_semantics[key])
-			else:
-				raise KeyError("'%s' is not a valid instance semantic" % key)
+		self.length_key = length_key
+		self.binary_globals = set()
 
-			new_batch_in[key] = {'byteOffset': offset}
-			self.features_bin.extend(buf_bin)
-			
+	def reset(self):
+		FeatureTable.reset(self)
+		self.binary_globals = set()
+
+	def lookupSemantic(self, key):
+		if key not in self.instance_semantics:
+			raise KeyError("'%s' is not a valid instance semantic" % key)
+		return self.instance_semantics[key]
+
+	def loadJSONBatch(self, data_in, object_wise = True):
+		FeatureTable.loadJSONBatch(self, data_in, object_wise)
+
+		# Global semantics in the input are hoisted out of the features,
+		# as are extensions and extras
+		for key in list(self.batch_in):
+			if key in PASSTHROUGH_KEYS or self.lookupSemantic(key).is_global:
+				self.addGlobal(key, self.batch_in.pop(key))
+		self.num_features = self.countFeatures()
+
+	def countFeatures(self):
+		""" The number of features in the loaded columns, which may be
+			nested per feature or flat lists of components """
+		counts = {}
+		for key, values in self.batch_in.items():
+			semantic = self.lookupSemantic(key)
+			size = np.size(values)
+			if size % semantic.components:
+				raise ValueError("'%s' has %d values, not a multiple of %d components" % (key, size, semantic.components))
+			counts[key] = size // semantic.components
+		if len(set(counts.values())) > 1:
+			raise ValueError("Semantics have differing numbers of features: %s" % \
+			                 ', '.join('%s %d' % item for item in sorted(counts.items())))
+		return next(iter(counts.values()), 0)
+
+	def addGlobal(self, key, value, binary = False):
+		if binary:
+			if not self.lookupSemantic(key).is_global:
+				raise KeyError("'%s' is not a global semantic" % key)
+			self.binary_globals.add(key)
+		else:
+			self.binary_globals.discard(key)
+		FeatureTable.addGlobal(self, key, value)
+
+	def appendBinary(self, semantic, values, component_type):
+		""" Pack values at a correctly aligned offset in the binary body,
+			and return the JSON reference to them """
+		packed = semantic.pack(values, component_type)
+		offset = len(self.features_bin) + packed.itemsize - 1 & ~(packed.itemsize - 1)
+		self.features_bin.extend(bytes(offset - len(self.features_bin)))
+		self.features_bin.extend(packed.reshape(-1).view(np.uint8).data)
+
+		ref = {'byteOffset': offset}
+		if component_type != semantic.component_types[0]:
+			ref['componentType'] = COMPONENT_TYPES[component_type][0]
+		return ref
+
+	def finalize(self, executor = None):
+		# Pick component types and pack the feature columns, concurrently
+		# if an executor is given. Packing again in appendBinary() is then
+		# a no-op, as the columns already have the right dtype.
+		if executor is not None:
+			futures = {key: executor.submit(packColumn, self.lookupSemantic(key), val) \
+			           for key, val in self.batch_in.items()}
+			columns = {key: future.result() for key, future in futures.items()}
+		else:
+			columns = {key: (self.lookupSemantic(key).pickComponentType(val), val) \
+			           for key, val in self.batch_in.items()}
+
+		# Lay out the widest component types first, so that no alignment
+		# padding is needed, and by name within a width for determinism
+		layout = sorted(columns, key = lambda key: \
+		                (-np.dtype(COMPONENT_TYPES[columns[key][0]][1]).itemsize, key))
+
+		new_batch_in = {}
+		for key in layout:
+			component_type, values = columns[key]
+			new_batch_in[key] = self.appendBinary(self.lookupSemantic(key), values, component_type)
 		self.batch_in = new_batch_in
 
+		new_globals = {}
+		for key, val in self.features_global.items():
+			if key in self.binary_globals:
+				semantic = self.lookupSemantic(key)
+				val = self.appendBinary(semantic, val, semantic.component_types[0])
+			new_globals[key] = val
+		self.features_global = new_globals
+
 		FeatureTable.finalize(self)
+
+	def loadBinary(self, feature_json, feature_bin):
+		""" Load a feature table as read from a tile. Binary semantics
+			become NumPy arrays viewing feature_bin without copying it;
+			feature semantics are shaped (features, components). """
+		data = json.loads(bytes(feature_json).decode('utf-8'))
+		length = data.get(self.length_key, 0) if self.length_key else 0
+
+		self.batch_in = {}
+		for key, val in data.items():
+			semantic = self.instance_semantics.get(key)
+			if semantic and isinstance(val, dict) and 'byteOffset' in val:
+				component_type = COMPONENT_TYPE_NAMES.get(val.get('componentType'), semantic.component_types[0])
+				count = semantic.components * (1 if semantic.is_global else length)
+				val = np.frombuffer(feature_bin, dtype = semantic.dtype(component_type), \
+				                    count = count, offset = val['byteOffset'])
+				if not semantic.is_global and semantic.components > 1:
+					val = val.reshape(-1, semantic.components)
+
+			if semantic and not semantic.is_global:
+				self.batch_in[key] = val
+			else:
+				self.addGlobal(key, val, isinstance(val, np.ndarray))
+		self.num_features = length
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------
+# glb.py: Component of GLTF to GLB converter
+# Reading, editing, and writing binary glTF 2.0
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#--------------------------------------------
+
+import struct
+import json
+import numpy as np
+
+from bufferpool import assemble
+
+GLB_MAGIC = 'glTF'
+GLB_VERSION = 2
+GLB_HEADER_LEN = 12
+GLB_CHUNK_HEADER_LEN = 8
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+""" glTF accessor componentType codes, and the accessor types' component counts """
+GLTF_COMPONENT_TYPES = {
+	5120 : np.dtype('<i1'),
+	5121 : np.dtype('<u1'),
+	5122 : np.dtype('<i2'),
+	5123 : np.dtype('<u2'),
+	5125 : np.dtype('<u4'),
+	5126 : np.dtype('<f4'),
+}
+GLTF_COMPONENT_CODES = {dtype: code for code, dtype in GLTF_COMPONENT_TYPES.items()}
+GLTF_TYPES = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT2': 4, 'MAT3': 9, 'MAT4': 16}
+GLTF_TYPE_NAMES = {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4', 16: 'MAT4'}
+
+class GLB:
+	""" A binary glTF 2.0 asset: the parsed JSON in self.gltf, and a
+		BIN chunk that is kept as a list of segments. Segments read from
+		an input are views into that input; data added with
+		addBufferView() is appended as new segments. Nothing is copied
+		until writeBinary() lays the chunks out.
+	"""
+	def __init__(self):
+		self.gltf = {'asset': {'version': '2.0'}}
+		self.bin_parts = []
+		self.bin_length = 0
+
+	def readBinary(self, data):
+		data = memoryview(data)
+		magic, version, length = struct.unpack('<4sII', data[0:GLB_HEADER_LEN])
+		magic = magic.decode('utf-8')
+		if magic != GLB_MAGIC or version != GLB_VERSION:
+			raise IOError("Unrecognized magic %s or bad version %d" % (magic, version))
+
+		self.gltf = None
+		self.bin_parts = []
+		self.bin_length = 0
+		offset = GLB_HEADER_LEN
+		while offset < length:
+			chunk_len, chunk_type = struct.unpack('<II', data[offset : offset + GLB_CHUNK_HEADER_LEN])
+			offset += GLB_CHUNK_HEADER_LEN
+			chunk = data[offset : offset + chunk_len]
+			if chunk_type == GLB_CHUNK_JSON:
+				self.gltf = json.loads(bytes(chunk).decode('utf-8'))
+			elif chunk_type == GLB_CHUNK_BIN and not self.bin_parts:
+				self.bin_parts.append(chunk)
+				self.bin_length = chunk_len
+			offset += chunk_len
+
+		if self.gltf is None:
+			raise IOError("GLB has no JSON chunk")
+		if self.gltf.get('buffers') and 'uri' in self.gltf['buffers'][0]:
+			raise IOError("GLBs referencing external buffers are not supported")
+
+	def writeBinary(self, pool = None):
+		""" Returns the GLB as a bytearray, or as a memoryview of a pooled
+			buffer if pool is given """
+		if self.bin_length:
+			buffers = self.gltf.setdefault('buffers', [{}])
+			buffers[0]['byteLength'] = self.bin_length
+		elif 'buffers' in self.gltf:
+			del self.gltf['buffers']
+
+		gltf_json = bytearray(json.dumps(self.gltf, separators=(',', ':'), sort_keys=True), encoding='utf-8')
+		gltf_json.extend(b' ' * ((len(gltf_json) + 3 & ~3) - len(gltf_json)))
+		bin_pad = bytes((self.bin_length + 3 & ~3) - self.bin_length)
+
+		length = GLB_HEADER_LEN + GLB_CHUNK_HEADER_LEN + len(gltf_json)
+		if self.bin_length:
+			length += GLB_CHUNK_HEADER_LEN + self.bin_length + len(bin_pad)
+
+		sections = [struct.pack('<4sII', GLB_MAGIC.encode('utf-8'), GLB_VERSION, length),
+		            struct.pack('<II', len(gltf_json), GLB_CHUNK_JSON), gltf_json]
+		if self.bin_length:
+			sections.append(struct.pack('<II', self.bin_length + len(bin_pad), GLB_CHUNK_BIN))
+			sections.extend(self.bin_parts)
+			sections.append(bin_pad)
+		return assemble(sections, pool)
+
+	def appendBin(self, data, alignment = 4):
+		""" Append data (any buffer, kept by reference) to the BIN chunk,
+			aligned to alignment bytes, and return its offset """
+		pad = (self.bin_length + alignment - 1 & ~(alignment - 1)) - self.bin_length
+		if pad:
+			self.bin_parts.append(bytes(pad))
+			self.bin_length += pad
+
+		data = memoryview(data).cast('B')
+		offset = self.bin_length
+		self.bin_parts.append(data)
+		self.bin_length += len(data)
+		self.gltf.setdefault('buffers', [{}])
+		return offset
+
+	def addBufferView(self, data, target = None, byte_stride = None, alignment = 4):
+		""" Append data to the BIN chunk, aligned to alignment bytes, and
+			return the new bufferView's index """
+		data = memoryview(data).cast('B')
+		buffer_view = {'buffer': 0, 'byteOffset': self.appendBin(data, alignment), 'byteLength': len(data)}
+		if target is not None:
+			buffer_view['target'] = target
+		if byte_stride is not None:
+			buffer_view['byteStride'] = byte_stride
+
+		buffer_views = self.gltf.setdefault('bufferViews', [])
+		buffer_views.append(buffer_view)
+		return len(buffer_views) - 1
+
+	def addAccessor(self, array, target = ARRAY_BUFFER, normalized = False, bounds = False):
+		""" Add a (count, components) or (count,) array as a new accessor,
+			and return its index """
+		array = np.ascontiguousarray(array)
+		if array.dtype not in GLTF_COMPONENT_CODES:
+			raise TypeError("No glTF component type for dtype '%s'" % array.dtype)
+		components = 1 if array.ndim == 1 else array.shape[1]
+		accessor = {
+			'bufferView': self.addBufferView(array, target),
+			'componentType': GLTF_COMPONENT_CODES[array.dtype],
+			'count': array.shape[0],
+			'type': GLTF_TYPE_NAMES[components],
+		}
+		if normalized:
+			accessor['normalized'] = True
+		if bounds and array.shape[0]:
+			accessor['min'] = np.atleast_1d(array.min(axis = 0)).tolist()
+			accessor['max'] = np.atleast_1d(array.max(axis = 0)).tolist()
+
+		accessors = self.gltf.setdefault('accessors', [])
+		accessors.append(accessor)
+		return len(accessors) - 1
+
+	def bufferData(self, offset, length):
+		""" Return a view of length bytes at offset in the BIN chunk """
+		part_offset = 0
+		for part in self.bin_parts:
+			if part_offset <= offset and offset + length <= part_offset + len(part):
+				return part[offset - part_offset : offset - part_offset + length]
+			part_offset += len(part)
+		raise IndexError("Buffer range %d+%d spans segments or is out of bounds" % (offset, length))
+
+	def readAccessor(self, index):
+		""" Return an accessor's data as an array of shape (count,) or
+			(count, components). Tightly packed and strided data are both
+			returned as views of the BIN chunk, without copying. """
+		accessor = self.gltf['accessors'][index]
+		if 'sparse' in accessor:
+			raise NotImplementedError("Sparse accessors are not supported")
+		dtype = GLTF_COMPONENT_TYPES[accessor['componentType']]
+		components = GLTF_TYPES[accessor['type']]
+		count = accessor['count']
+		shape = (count, components) if components > 1 else (count,)
+		if 'bufferView' not in accessor:
+			return np.zeros(shape, dtype = dtype)
+
+		buffer_view = self.gltf['bufferViews'][accessor['bufferView']]
+		data = self.bufferData(buffer_view.get('byteOffset', 0), buffer_view['byteLength'])
+		offset = accessor.get('byteOffset', 0)
+		stride = buffer_view.get('byteStride', dtype.itemsize * components)
+		strides = (stride, dtype.itemsize) if components > 1 else (stride,)
+		return np.ndarray(shape, dtype = dtype, buffer = data, offset = offset, strides = strides)
+
+	def addExtension(self, name, required = False):
+		used = self.gltf.setdefault('extensionsUsed', [])
+		if name not in used:
+			used.append(name)
+		if required:
+			required_list = self.gltf.setdefault('extensionsRequired', [])
+			if name not in required_list:
+				required_list.append(name)
+
+	def removeExtension(self, name):
+		for key in ('extensionsUsed', 'extensionsRequired'):
+			if name in self.gltf.get(key, []):
+				self.gltf[key].remove(name)
+				if not self.gltf[key]:
+					del self.gltf[key]
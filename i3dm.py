@@ -19,30 +19,50 @@
 import struct
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 
+import instancestream
+import precompress
 from batchtable import BatchTable
-from featuretable import InstanceFeatureTable
+from bufferpool import assemble
+from featuretable import InstanceFeatureTable, Semantic, finalizeTables
 
 I3DM_MAGIC = 'i3dm'
 I3DM_VERSION = 1
 I3DM_HEADER_LEN = 32
 
 I3DM_SEMANTICS = {
-	'POSITION' : 'f32',
-	'NORMAL_UP' : 'f32',
-	'NORMAL_RIGHT' : 'f32',
-	'SCALE' : 'f32',
-	'SCALE_NON_UNIFORM' : 'f32',
-	'POSITION_QUANTIZED' : 'u16',
-	'NORMAL_UP_OCT32P' : 'u16',
-	'NORMAL_RIGHT_OCT32P' : 'u16',
-	'BATCH_ID' : 'u16'
+	# Per-instance semantics
+	'POSITION' : Semantic(('f32',), 3, False),
+	'POSITION_QUANTIZED' : Semantic(('u16',), 3, False),
+	'NORMAL_UP' : Semantic(('f32',), 3, False),
+	'NORMAL_RIGHT' : Semantic(('f32',), 3, False),
+	'NORMAL_UP_OCT32P' : Semantic(('u16',), 2, False),
+	'NORMAL_RIGHT_OCT32P' : Semantic(('u16',), 2, False),
+	'SCALE' : Semantic(('f32',), 1, False),
+	'SCALE_NON_UNIFORM' : Semantic(('f32',), 3, False),
+	'BATCH_ID' : Semantic(('u16', 'u8', 'u32'), 1, False),
+
+	# Global semantics
+	'INSTANCES_LENGTH' : Semantic(('u32',), 1, True),
+	'BATCH_LENGTH' : Semantic(('u32',), 1, True),
+	'RTC_CENTER' : Semantic(('f32',), 3, True),
+	'QUANTIZED_VOLUME_OFFSET' : Semantic(('f32',), 3, True),
+	'QUANTIZED_VOLUME_SCALE' : Semantic(('f32',), 3, True),
+	'EAST_NORTH_UP' : Semantic(('u8',), 1, True),		# Boolean; JSON only
 }
 
 class I3DM(object):
 	def __init__(self):
 		self.batch_table = BatchTable()
-		self.feature_table = InstanceFeatureTable(I3DM_SEMANTICS)
+		self.feature_table = InstanceFeatureTable(I3DM_SEMANTICS, 'INSTANCES_LENGTH')
+		self.gltf_bin = bytearray()
+
+	def reset(self):
+		""" Discard all loaded and encoded data so that this encoder can be
+			reused for another tile. Call this between writeBinary() calls. """
+		self.batch_table.reset()
+		self.feature_table.reset()
 		self.gltf_bin = bytearray()
 
 	def loadJSONBatch(self, data_in, object_wise = True):
@@ -54,8 +74,12 @@ class I3DM(object):
 	def loadJSONFeatures(self, data_in, object_wise = True):
 		self.feature_table.loadJSONBatch(data_in, object_wise)
 
+	def loadInstanceStream(self, path, chunk_size = instancestream.DEFAULT_CHUNK):
+		""" Load instances from an NDJSON, CSV, or column file stream; see instancestream.py """
+		instancestream.loadFeatureTable(self.feature_table, path, chunk_size)
+
 	# If embed_gltf is false, gltf_bin is a URI string instead of GLTF data
-	def writeBinary(self, gltf_bin, embed_gltf = True, num_batches = 0, num_feature_features = 0):
+	def writeBinary(self, gltf_bin, embed_gltf = True, num_batches = 0, num_feature_features = 0, pool = None, executor = None):
 		self.embed_gltf = embed_gltf
 
 		# Make sure that it's a byte array, not a string
@@ -68,39 +92,26 @@ class I3DM(object):
 		num_feature_features = max(num_feature_features, self.feature_table.getNumFeatures())
 		self.feature_table.addGlobal('INSTANCES_LENGTH', num_feature_features)
 
-		self.batch_table.finalize()
-		self.feature_table.finalize()
+		finalizeTables(self.batch_table, self.feature_table, executor)
 
 		# Generate the header
-		output = self.writeHeader(gltf_bin, num_batch_features, num_feature_features)
-
-		# Add the feature table JSON to the output
-		feature_json = self.feature_table.getFeatureJSON()
-		output.extend(feature_json)
-
-		# Add the feature table binary to the output
-		feature_bin  = self.feature_table.getFeatureBin()
-		output.extend(feature_bin)
-
-		# Add the batch table JSON to the output
-		batch_json = self.batch_table.getBatchJSON()
-		output.extend(batch_json)
+		header = self.writeHeader(gltf_bin, num_batch_features, num_feature_features)
 
-		# Add the batch table binary to the output
-		batch_bin  = self.batch_table.getBatchBin()
-		output.extend(batch_bin)
+		# Lay out the feature table JSON and binary, the batch table JSON
+		# and binary, and the GLTF model body
+		sections = [header,
+		            self.feature_table.features_json, self.feature_table.features_bin,
+		            self.batch_table.batch_json, self.batch_table.batch_bin,
+		            gltf_bin]
 
-		# Add the GLTF model body to the output
-		output.extend(gltf_bin)
-
-		return output
+		return assemble(sections, pool)
 
 	# If embed_gltf is false, gltf_bin is a URI string instead of GLTF data
 	def writeHeader(self, gltf_bin, num_batch_features, num_feature_features):
-		len_feature_json = len(self.feature_table.getFeatureJSON())
-		len_feature_bin  = len(self.feature_table.getFeatureBin())
-		len_batch_json   = len(self.batch_table.getBatchJSON())
-		len_batch_bin    = len(self.batch_table.getBatchBin())
+		len_feature_json = len(self.feature_table.features_json)
+		len_feature_bin  = len(self.feature_table.features_bin)
+		len_batch_json   = len(self.batch_table.batch_json)
+		len_batch_bin    = len(self.batch_table.batch_bin)
 
 		length = I3DM_HEADER_LEN + \
 		         len_feature_json + len_feature_bin + \
@@ -152,6 +163,14 @@ class I3DM(object):
 	def getGLTFBin(self):
 		return self.gltf_bin
 
+	def readFeatureTable(self):
+		""" Decode the feature table read by readBinary() into
+			self.feature_table, with binary semantics as NumPy arrays
+			that view the tile data rather than copying it """
+		self.feature_table.reset()
+		self.feature_table.loadBinary(self.feature_json, self.feature_bin)
+		return self.feature_table
+
 	def unpackString(self, data, length):
 		self.offset += length
 		return data[self.offset - length : self.offset]
@@ -167,7 +186,7 @@ def main():
 	# Parse options and get results
 	parser = argparse.ArgumentParser(description='Converts GLTF to GLB')
 	parser.add_argument("-i", "--i3dm", type=str, required=True, \
-	                    help="Export i3dm, with required path to input JSON instance table data. Supports only embedded GLBs")
+	                    help="Export i3dm, with required path to input JSON instance table data, or an NDJSON, CSV, or column file instance stream. Supports only embedded GLBs")
 	parser.add_argument("-b", "--batch", type=str, required=False, \
 	                    help="Optional path to batch table JSON")
 	parser.add_argument("-g", "--glb", type=str, required=True, \
@@ -176,28 +195,40 @@ def main():
 	                    help="Specify to embed the GLB file instead of referencing it")
 	parser.add_argument("-o", "--output", required=True, \
 	                    help="Output i3dm path")
+	parser.add_argument("-j", "--jobs", type=int, default=1, \
+	                    help="Threads packing instance semantics while the batch table is serialized. Only the NumPy packing runs in parallel, as JSON serialization holds the GIL")
+	precompress.addArguments(parser)
 	args = parser.parse_args()
 	
 	i3dm_encoder = I3DM()
 	if not(len(args.i3dm)):
 		raise ValueError("-i/--i3dm requires a JSON instance table")
 	else:
-		with open(args.i3dm, 'r') as f:
-			i3dm_json = json.loads(f.read())
-		i3dm_encoder.loadJSONInstances(i3dm_json)
-		if len(args.batch):
+		if instancestream.isStream(args.i3dm):
+			i3dm_encoder.loadInstanceStream(args.i3dm)
+		else:
+			with open(args.i3dm, 'r') as f:
+				i3dm_json = json.loads(f.read())
+			i3dm_encoder.loadJSONInstances(i3dm_json)
+		if args.batch:
 			with open(args.batch, 'r') as f:
 				batch_json = json.loads(f.read())
 			i3dm_encoder.loadJSONBatch(batch_json, False)
 
-	with open(args.output, 'wb') as f:
-		if args.embed:
-			with open(args.glb, 'rb') as glb:
-				f.write(i3dm_encoder.writeBinary(glb.read(), True))		# Second arg: embed gltf
-		else:
-			while len(args.glb) % 8:
-				args.glb += ' '
-			f.write(i3dm_encoder.writeBinary(args.glb, False))
+	precompressor = precompress.fromArguments(args, parser)
+	executor = ThreadPoolExecutor(max_workers = args.jobs) if args.jobs > 1 else None
+	if args.embed:
+		with open(args.glb, 'rb') as glb:
+			output = i3dm_encoder.writeBinary(glb.read(), True, executor = executor)		# Second arg: embed gltf
+	else:
+		while len(args.glb) % 8:
+			args.glb += ' '
+		output = i3dm_encoder.writeBinary(args.glb, False, executor = executor)
+	if executor:
+		executor.shutdown()
+	precompress.writeFile(args.output, output, precompressor)
+	if precompressor:
+		precompressor.close()
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------
+# instancestream.py: Component of GLTF to GLB converter
+# Reads per-instance feature data from NDJSON, CSV,
+# or per-semantic binary column files, in chunks,
+# straight into typed arrays
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# Supported inputs:
+# - .ndjson/.jsonl: one JSON object per instance, each
+#   with the same semantics, e.g.
+#   {"POSITION":[1,2,3],"SCALE":2}
+# - .csv: a header row naming one column per component,
+#   as SEMANTIC.i for vector semantics, e.g.
+#   POSITION.0,POSITION.1,POSITION.2,SCALE
+# - a directory of SEMANTIC.npy files, or raw little-
+#   endian SEMANTIC.bin files in the semantic's default
+#   component type (or SEMANTIC.<type>.bin, with <type>
+#   a short name like u32). These are memory-mapped
+#   rather than read, and may hold global semantics.
+#--------------------------------------------------
+
+import os
+import csv
+import json
+from itertools import islice
+import numpy as np
+
+from featuretable import COMPONENT_TYPES
+
+STREAM_EXTS = {'.ndjson', '.jsonl', '.csv'}
+DEFAULT_CHUNK = 65536			# Instances parsed at once
+
+def isStream(path):
+	""" True if path is an instance stream, rather than a JSON document """
+	return os.path.isdir(path) or os.path.splitext(path)[1].lower() in STREAM_EXTS
+
+def parseDtype(semantic):
+	""" The widest legal component type, so values are not truncated
+		before InstanceFeatureTable picks the smallest one that fits """
+	return max((semantic.dtype(ct) for ct in semantic.component_types), key = lambda dtype: dtype.itemsize)
+
+def featureSemantic(semantics, key):
+	if key not in semantics:
+		raise KeyError("'%s' is not a valid instance semantic" % key)
+	if semantics[key].is_global:
+		raise ValueError("Global semantic '%s' must be given once, in a column file, not per instance" % key)
+	return semantics[key]
+
+def allocateColumns(semantics, keys, count):
+	columns = {}
+	for key in keys:
+		semantic = featureSemantic(semantics, key)
+		shape = (count, semantic.components) if semantic.components > 1 else (count,)
+		columns[key] = np.empty(shape, dtype = parseDtype(semantic))
+	return columns
+
+def nonBlankLines(f):
+	for line in f:
+		if line.strip():
+			yield line
+
+def countLines(path):
+	with open(path, 'rb') as f:
+		return sum(1 for _ in nonBlankLines(f))
+
+def readNDJSON(path, semantics, chunk_size = DEFAULT_CHUNK):
+	""" Returns a dict mapping semantics to arrays. The file is read
+		twice: once to count the instances, so each column is allocated
+		exactly once, and once to parse them a chunk at a time. """
+	count = countLines(path)
+	columns = None
+	start = 0
+	with open(path, 'r', encoding = 'utf-8') as f:
+		lines = nonBlankLines(f)
+		while start < count:
+			records = [json.loads(line) for line in islice(lines, chunk_size)]
+			if columns is None:
+				columns = allocateColumns(semantics, sorted(records[0]), count)
+			end = start + len(records)
+			for key, column in columns.items():
+				try:
+					column[start:end] = [record[key] for record in records]
+				except KeyError:
+					raise ValueError("%s: every instance must have '%s'" % (path, key))
+			if any(len(record) != len(columns) for record in records):
+				raise ValueError("%s: every instance must have the same semantics" % path)
+			start = end
+	return columns or {}
+
+def parseCSVHeader(path, header, semantics):
+	""" Returns [(semantic, component, CSV column)], checking that every
+		component of every semantic is present """
+	fields = []
+	for idx, name in enumerate(header):
+		key, _, component = name.strip().partition('.')
+		fields.append((key, int(component or 0), idx))
+	for key in set(key for key, _, _ in fields):
+		components = sorted(component for k, component, _ in fields if k == key)
+		if components != list(range(featureSemantic(semantics, key).components)):
+			raise ValueError("%s: columns for '%s' must be %s.0 through %s.%d" % \
+			                 (path, key, key, key, featureSemantic(semantics, key).components - 1))
+	return fields
+
+def readCSV(path, semantics, chunk_size = DEFAULT_CHUNK):
+	""" Returns a dict mapping semantics to arrays, reading the file a
+		chunk of rows at a time (and once beforehand to count them) """
+	count = countLines(path) - 1		# Less the header
+	with open(path, 'r', newline = '') as f:
+		rows = csv.reader(nonBlankLines(f))
+		try:
+			header = next(rows)
+		except StopIteration:
+			raise ValueError("%s: empty CSV instance file" % path)
+		fields = parseCSVHeader(path, header, semantics)
+		columns = allocateColumns(semantics, sorted(set(key for key, _, _ in fields)), max(count, 0))
+		start = 0
+		while start < count:
+			chunk = np.array(list(islice(rows, chunk_size)), dtype = np.float64)
+			end = start + len(chunk)
+			for key, component, idx in fields:
+				column = columns[key]
+				if column.ndim > 1:
+					column[start:end, component] = chunk[:, idx]
+				else:
+					column[start:end] = chunk[:, idx]
+			start = end
+	return columns
+
+def readColumnFiles(path, semantics):
+	""" Returns (features, globals) from a directory of per-semantic
+		.npy or .bin files, memory-mapped so they are never read whole """
+	features = {}
+	global_values = {}
+	for filename in sorted(os.listdir(path)):
+		name, ext = os.path.splitext(filename)
+		if ext not in ('.npy', '.bin'):
+			continue
+		key, _, component_type = name.partition('.')
+		if key not in semantics:
+			raise KeyError("'%s' is not a valid instance semantic" % key)
+		full_path = os.path.join(path, filename)
+		if ext == '.npy':
+			values = np.load(full_path, mmap_mode = 'r')
+		else:
+			dtype = np.dtype(COMPONENT_TYPES[component_type][1]) if component_type else semantics[key].dtype()
+			if os.path.getsize(full_path):
+				values = np.memmap(full_path, dtype = dtype, mode = 'r')
+			else:
+				values = np.zeros(0, dtype = dtype)
+
+		semantic = semantics[key]
+		if values.size % semantic.components:
+			raise ValueError("%s: %d values is not a multiple of %d components" % \
+			                 (full_path, values.size, semantic.components))
+		if semantic.is_global:
+			value = values.reshape(-1).tolist()
+			global_values[key] = value[0] if semantic.components == 1 else value
+		else:
+			features[key] = values.reshape(-1, semantic.components) if semantic.components > 1 else values.reshape(-1)
+	return features, global_values
+
+def readInstances(path, semantics, chunk_size = DEFAULT_CHUNK):
+	""" Returns (features, globals) for any supported instance stream """
+	if os.path.isdir(path):
+		features, global_values = readColumnFiles(path, semantics)
+	elif path.lower().endswith('.csv'):
+		features, global_values = readCSV(path, semantics, chunk_size), {}
+	else:
+		features, global_values = readNDJSON(path, semantics, chunk_size), {}
+
+	lengths = set(len(column) for column in features.values())
+	if len(lengths) > 1:
+		raise ValueError("%s: semantics have differing numbers of instances %s" % (path, sorted(lengths)))
+	return features, global_values
+
+def loadFeatureTable(feature_table, path, chunk_size = DEFAULT_CHUNK):
+	""" Load an instance stream into an InstanceFeatureTable """
+	features, global_values = readInstances(path, feature_table.instance_semantics, chunk_size)
+	feature_table.loadJSONBatch(features, False)
+	for key, value in global_values.items():
+		feature_table.addGlobal(key, value)
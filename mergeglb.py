@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# mergeglb.py: Merge many GLBs into one, tagging each source's vertices
+# with a _BATCHID, and pack the result as a batched b3dm. Component of
+# gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import json
+
+import numpy as np
+
+import b3dm
+from glb import GLB, ARRAY_BUFFER
+import precompress
+
+""" Top-level glTF arrays that are concatenated across sources """
+MERGED_ARRAYS = ('accessors', 'bufferViews', 'meshes', 'nodes', 'materials', 'textures', \
+                 'images', 'samplers', 'cameras', 'skins', 'animations')
+
+""" Extensions that hold no indices into the glTF's arrays, other than
+	textureInfos (which remapTextures() offsets), and so merge as they are """
+INDEX_FREE_EXTENSIONS = {'KHR_materials_anisotropy', 'KHR_materials_clearcoat', 'KHR_materials_dispersion', \
+                         'KHR_materials_emissive_strength', 'KHR_materials_ior', 'KHR_materials_iridescence', \
+                         'KHR_materials_pbrSpecularGlossiness', 'KHR_materials_sheen', 'KHR_materials_specular', \
+                         'KHR_materials_transmission', 'KHR_materials_unlit', 'KHR_materials_volume', \
+                         'KHR_mesh_quantization', 'KHR_texture_transform'}
+
+""" Texture extensions whose 'source' is an image index """
+TEXTURE_SOURCE_EXTENSIONS = {'KHR_texture_basisu', 'EXT_texture_webp', 'EXT_texture_avif', 'MSFT_texture_dds'}
+
+""" Extensions whose indices GLBMerger.add() offsets. Sources that use any
+	other extension are rejected, since its indices would be left pointing
+	into the first source's objects. """
+MERGEABLE_EXTENSIONS = INDEX_FREE_EXTENSIONS | TEXTURE_SOURCE_EXTENSIONS | \
+                       {'KHR_draco_mesh_compression', 'EXT_meshopt_compression', 'EXT_mesh_gpu_instancing', \
+                        'KHR_lights_punctual'}
+
+LIGHTS_EXTENSION = 'KHR_lights_punctual'
+
+BATCHID_ATTRIBUTE = '_BATCHID'
+BATCHID_STRIDE = 4
+
+def remapTextures(value, base):
+	""" Offset every textureInfo index (any '...Texture' object) in a material """
+	if isinstance(value, dict):
+		for key, item in value.items():
+			if key.endswith('Texture') and isinstance(item, dict) and 'index' in item:
+				item['index'] += base['textures']
+			remapTextures(item, base)
+	elif isinstance(value, list):
+		for item in value:
+			remapTextures(item, base)
+
+class GLBMerger:
+	""" Accumulates GLBs into a single GLB. Every source keeps its own
+		nodes, meshes, materials, and so on, with indices offset into the
+		merged arrays; its BIN chunk is appended by reference. Each
+		primitive gains a _BATCHID attribute holding the source's index,
+		written in a single pass once all sources have been added. """
+	def __init__(self):
+		self.glb = GLB()
+		self.glb.gltf['scenes'] = [{'nodes': []}]
+		self.glb.gltf['scene'] = 0
+		self.batch_primitives = []		# (primitive, vertex count, batch ID)
+		self.num_sources = 0
+
+	def add(self, data):
+		""" Add one GLB, returning its batch ID """
+		src = GLB()
+		src.readBinary(data)
+		gltf = src.gltf
+		if len(gltf.get('buffers', [])) > 1:
+			raise IOError("GLBs with more than one buffer cannot be merged")
+		unsupported = (set(gltf.get('extensionsUsed', [])) | set(gltf.get('extensions', {}))) - MERGEABLE_EXTENSIONS
+		if unsupported:
+			raise ValueError("GLBs using %s cannot be merged" % ', '.join(sorted(unsupported)))
+
+		out = self.glb.gltf
+		base = {key: len(out.get(key, [])) for key in MERGED_ARRAYS}
+		bin_base = self.glb.appendBin(src.bufferData(0, src.bin_length), 8) if src.bin_length else 0
+
+		for buffer_view in gltf.get('bufferViews', []):
+			buffer_view['buffer'] = 0
+			buffer_view['byteOffset'] = buffer_view.get('byteOffset', 0) + bin_base
+			meshopt = buffer_view.get('extensions', {}).get('EXT_meshopt_compression')
+			if meshopt is not None:
+				meshopt['buffer'] = 0
+				meshopt['byteOffset'] = meshopt.get('byteOffset', 0) + bin_base
+		for accessor in gltf.get('accessors', []):
+			if 'bufferView' in accessor:
+				accessor['bufferView'] += base['bufferViews']
+			for part in ('indices', 'values'):
+				if part in accessor.get('sparse', {}):
+					accessor['sparse'][part]['bufferView'] += base['bufferViews']
+		for image in gltf.get('images', []):
+			if 'bufferView' in image:
+				image['bufferView'] += base['bufferViews']
+		for texture in gltf.get('textures', []):
+			if 'source' in texture:
+				texture['source'] += base['images']
+			if 'sampler' in texture:
+				texture['sampler'] += base['samplers']
+			for name, extension in texture.get('extensions', {}).items():
+				if name in TEXTURE_SOURCE_EXTENSIONS and 'source' in extension:
+					extension['source'] += base['images']
+		for material in gltf.get('materials', []):
+			remapTextures(material, base)
+
+		batch_id = self.num_sources
+		for mesh in gltf.get('meshes', []):
+			for primitive in mesh['primitives']:
+				attributes = primitive['attributes']
+				for key in attributes:
+					attributes[key] += base['accessors']
+				for target in primitive.get('targets', []):
+					for key in target:
+						target[key] += base['accessors']
+				if 'indices' in primitive:
+					primitive['indices'] += base['accessors']
+				if 'material' in primitive:
+					primitive['material'] += base['materials']
+				draco = primitive.get('extensions', {}).get('KHR_draco_mesh_compression')
+				if draco is not None:
+					draco['bufferView'] += base['bufferViews']
+				count = gltf['accessors'][attributes['POSITION'] - base['accessors']]['count']
+				self.batch_primitives.append((primitive, count, batch_id))
+
+		lights = gltf.get('extensions', {}).get(LIGHTS_EXTENSION, {}).get('lights', [])
+		out_lights = out.setdefault('extensions', {}).setdefault(LIGHTS_EXTENSION, {'lights': []})['lights'] \
+		             if lights else []
+		light_base = len(out_lights)
+		out_lights.extend(lights)
+
+		for node in gltf.get('nodes', []):
+			for key in ('mesh', 'camera', 'skin'):
+				if key in node:
+					node[key] += base[key + ('es' if key == 'mesh' else 's')]
+			extensions = node.get('extensions', {})
+			if LIGHTS_EXTENSION in extensions:
+				extensions[LIGHTS_EXTENSION]['light'] += light_base
+			if 'EXT_mesh_gpu_instancing' in extensions:
+				attributes = extensions['EXT_mesh_gpu_instancing']['attributes']
+				for key in attributes:
+					attributes[key] += base['accessors']
+			if 'children' in node:
+				node['children'] = [child + base['nodes'] for child in node['children']]
+		for skin in gltf.get('skins', []):
+			skin['joints'] = [joint + base['nodes'] for joint in skin['joints']]
+			if 'skeleton' in skin:
+				skin['skeleton'] += base['nodes']
+			if 'inverseBindMatrices' in skin:
+				skin['inverseBindMatrices'] += base['accessors']
+		for animation in gltf.get('animations', []):
+			for channel in animation['channels']:
+				if 'node' in channel['target']:
+					channel['target']['node'] += base['nodes']
+			for sampler in animation['samplers']:
+				sampler['input'] += base['accessors']
+				sampler['output'] += base['accessors']
+
+		for key in MERGED_ARRAYS:
+			if gltf.get(key):
+				out.setdefault(key, []).extend(gltf[key])
+		scenes = gltf.get('scenes', [])
+		if scenes:
+			scene = scenes[gltf.get('scene', 0)]
+			out['scenes'][0]['nodes'].extend(node + base['nodes'] for node in scene.get('nodes', []))
+		for key in ('extensionsUsed', 'extensionsRequired'):
+			for extension in gltf.get(key, []):
+				if extension not in out.setdefault(key, []):
+					out[key].append(extension)
+
+		self.num_sources += 1
+		return batch_id
+
+	def finish(self):
+		""" Write the _BATCHID attributes, and return the merged GLB. All
+			primitives' batch IDs share one bufferView, filled with a
+			single np.repeat(); they are floats so that a 4-byte stride
+			packs them tightly, and are exact up to 2^24 sources. """
+		if self.batch_primitives:
+			_, counts, batch_ids = zip(*self.batch_primitives)
+			values = np.repeat(np.array(batch_ids, dtype = '<f4'), counts)
+			buffer_view = self.glb.addBufferView(values, ARRAY_BUFFER, BATCHID_STRIDE)
+			accessors = self.glb.gltf.setdefault('accessors', [])
+			offset = 0
+			for primitive, count, batch_id in self.batch_primitives:
+				accessors.append({
+					'bufferView': buffer_view,
+					'byteOffset': offset * BATCHID_STRIDE,
+					'componentType': 5126,
+					'count': count,
+					'type': 'SCALAR',
+					'min': [batch_id],
+					'max': [batch_id],
+				})
+				primitive['attributes'][BATCHID_ATTRIBUTE] = len(accessors) - 1
+				offset += count
+			self.batch_primitives = []
+		return self.glb
+
+def mergeToB3DM(glbs, properties = None, pool = None):
+	""" Merge a sequence of GLBs into one b3dm. properties, if given, is a
+		list with one dict of batch table properties per GLB. """
+	merger = GLBMerger()
+	for data in glbs:
+		merger.add(data)
+	merged = merger.finish()
+
+	encoder = b3dm.B3DM()
+	if properties:
+		if len(properties) != merger.num_sources:
+			raise ValueError("Got %d property objects for %d GLBs" % (len(properties), merger.num_sources))
+		encoder.loadJSONBatch(properties, True)
+	return encoder.writeBinary(merged.writeBinary(), merger.num_sources, pool = pool)
+
+def main():
+	""" Merge GLBs into a single batched b3dm """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Merges many GLBs into one batched b3dm')
+	parser.add_argument("-o", "--output", type=str, required=True, \
+	                    help="Output b3dm path")
+	parser.add_argument("-p", "--properties", type=str, \
+	                    help="Optional JSON list with one object of batch table properties per input GLB")
+	parser.add_argument("input_files", nargs='+')
+	precompress.addArguments(parser)
+	args = parser.parse_args()
+
+	properties = None
+	if args.properties:
+		with open(args.properties, 'r') as f:
+			properties = json.loads(f.read())
+
+	def readGLBs():
+		for fname in args.input_files:
+			with open(fname, 'rb') as f:
+				yield f.read()
+
+	precompressor = precompress.fromArguments(args, parser)
+	precompress.writeFile(args.output, mergeToB3DM(readGLBs(), properties), precompressor)
+	if precompressor:
+		precompressor.close()
+
+if __name__ == "__main__":
+	main()
@@ -8,13 +8,22 @@
 
 import sys, os
 import argparse
+import mmap
 import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import b3dm
+import i3dm
+import precompress
 
 CMPT_EXT = '.cmpt'
 CMPT_MAGIC = 'cmpt'
 CMPT_VERSION = 1
 CMPT_HEADER_LEN = 16
 VALID_INTERIOR_TILES = {'b3dm', 'i3dm', 'cmpt', 'pnts'}
+DEFAULT_WRITE_THREADS = 4
+MAX_PENDING_WRITES = 64
 
 class CmptEncoder:
 	""" Pack multiple Tile3D file(s) into a single unit """
@@ -57,7 +66,13 @@ class CmptEncoder:
 		else:
 			self.header = header
 
-	def export(self, filename):
+	def export(self, filename, precompressor = None):
+		if precompressor is not None:
+			self.composeHeader()
+			# Joined straight into bytes, which the precompressor keeps
+			# without copying again
+			precompressor.write(filename, b''.join((self.header, self.body)))
+			return
 		with open(filename, 'wb') as f:
 			self.export_to_handle(f)
 			
@@ -83,6 +98,13 @@ class CmptDecoder:
 			raise IOError
 
 	def decode(self):
+		self.tiles = list(self.iterTiles())
+		del self.data
+
+	def iterTiles(self):
+		""" Yield the interior tiles one at a time, in order. Each tile's
+			'data' is a slice of the input, which is a zero-copy view if
+			the input was a memoryview or mmap """
 		# Grab the header
 		self.offset = 0;
 		magic = self.unpack('4s', self.data).decode('utf-8')
@@ -95,7 +117,6 @@ class CmptDecoder:
 		self.count = self.unpack('<I', self.data)
 
 		# Now grab all the body items
-		self.tiles = []
 		for i in range(self.count):
 			start_idx = self.offset
 
@@ -106,16 +127,14 @@ class CmptDecoder:
 			inner_version = self.unpack('<I', self.data)
 			inner_length = self.unpack('<I', self.data)
 
-			self.tiles.append({ \
+			yield { \
 				'magic': inner_magic, \
 				'version': inner_version, \
 				'length': inner_length, \
 				'data': self.data[start_idx : start_idx + inner_length] \
-			});
+			}
 			self.offset = start_idx + inner_length
 
-		del self.data
-
 	def getTiles(self):
 		return self.tiles
 			
@@ -124,6 +143,74 @@ class CmptDecoder:
 		self.offset += calc_len
 		return struct.unpack(fmt, data[self.offset - calc_len : self.offset])[0]
 
+class CmptUnpacker:
+	""" Write out the interior tiles of a cmpt file, in order, without
+		holding them all in memory. Nested cmpt tiles can be unpacked
+		recursively, and b3dm/i3dm tiles can be split into their GLB
+		plus feature and batch table JSON. File writes are handed to a
+		thread pool, with a bound on the number of pending writes. """
+	def __init__(self, output_dir, recursive = False, split = False, threads = DEFAULT_WRITE_THREADS):
+		self.output_dir = output_dir
+		self.recursive = recursive
+		self.split = split
+		self.threads = threads
+
+	def unpackFile(self, filename):
+		prefix = os.path.basename(filename)
+		with open(filename, 'rb') as f:
+			with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+				with memoryview(mapped) as data:
+					self.unpack(data, prefix)
+
+	def unpack(self, data, prefix):
+		self.pending = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+		self.futures = []
+		with ThreadPoolExecutor(max_workers = self.threads) as executor:
+			self.executor = executor
+			self.unpackCmpt(data, prefix)
+		for future in self.futures:
+			future.result()		# Raise any write errors
+		del self.executor
+
+	def unpackCmpt(self, data, prefix):
+		decoder = CmptDecoder()
+		decoder.add(data = data)
+		for idx, tile in enumerate(decoder.iterTiles()):
+			name = prefix + '-' + str(idx)
+			if self.recursive and tile['magic'] == CMPT_MAGIC:
+				self.unpackCmpt(tile['data'], name)
+			elif self.split and tile['magic'] in (b3dm.B3DM_MAGIC, i3dm.I3DM_MAGIC):
+				self.splitTile(tile, name)
+			else:
+				self.write(name + '.' + tile['magic'], tile['data'])
+
+	def splitTile(self, tile, name):
+		decoder = b3dm.B3DM() if tile['magic'] == b3dm.B3DM_MAGIC else i3dm.I3DM()
+		decoder.readBinary(tile['data'])
+		name += '.' + tile['magic']
+		self.write(name + '.feature.json', decoder.feature_json)
+		if len(decoder.feature_bin):
+			self.write(name + '.feature.bin', decoder.feature_bin)
+		if len(decoder.batch_json):
+			self.write(name + '.batch.json', decoder.batch_json)
+		if len(decoder.batch_bin):
+			self.write(name + '.batch.bin', decoder.batch_bin)
+		if getattr(decoder, 'embed_gltf', 1):
+			self.write(name + '.glb', decoder.gltf_bin)
+		else:
+			self.write(name + '.uri', decoder.gltf_bin)
+
+	def write(self, fname, data):
+		self.pending.acquire()
+		future = self.executor.submit(self.writeFile, os.path.join(self.output_dir, fname), data)
+		future.add_done_callback(lambda _: self.pending.release())
+		self.futures.append(future)
+
+	@staticmethod
+	def writeFile(path, data):
+		with open(path, 'wb') as f:
+			f.write(data)
+
 def main():
 	""" Pack one or more i3dm and/or b3dm files into a cmpt"""
 
@@ -133,29 +220,36 @@ def main():
 						help="Output cmpt file")
 	parser.add_argument("-u", "--unpack", action='store_true', \
 	                    help="Unpack, rather than pack. Give input cmpt file as -o, output dir as input file")
+	parser.add_argument("-r", "--recursive", action='store_true', \
+	                    help="When unpacking, also unpack nested cmpt tiles")
+	parser.add_argument("-s", "--split", action='store_true', \
+	                    help="When unpacking, split b3dm and i3dm tiles into GLB and feature/batch table files")
+	parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_WRITE_THREADS, \
+	                    help="Number of threads writing unpacked files")
 	parser.add_argument('input_files', nargs='*')
+	precompress.addArguments(parser)
 	args = parser.parse_args()
 
 	if args.unpack:
-		decoder = CmptDecoder()
-		decoder.add(filename = args.output)
-		decoder.decode()
-
-		tiles = decoder.getTiles()
-		idx = 0
-		for tile in tiles:
-			output_fname = os.path.basename(args.output) + '-' + str(idx) + '.' + tile['magic']
-			with open(os.path.join(args.input_files[0], output_fname), 'wb') as f:
-				f.write(tile['data'])
+		if args.precompress or args.precompressed_only:
+			parser.error("--precompress cannot be used with --unpack")
+		if len(args.input_files) != 1:
+			print("Unpacking requires exactly one output directory!")
+			sys.exit(-1)
+		unpacker = CmptUnpacker(args.input_files[0], args.recursive, args.split, args.jobs)
+		unpacker.unpackFile(args.output)
 	else:
 		if not len(args.input_files):
 			print("At least one input tile file must be specified!")
 
 		else:
+			precompressor = precompress.fromArguments(args, parser)
 			encoder = CmptEncoder()
 			for fname in args.input_files:
 				encoder.add(fname)
-			encoder.export(args.output + ('' if args.output.endswith(CMPT_EXT) else CMPT_EXT))
+			encoder.export(args.output + ('' if args.output.endswith(CMPT_EXT) else CMPT_EXT), precompressor)
+			if precompressor:
+				precompressor.close()
 
 if __name__ == "__main__":
 	main()
@@ -14,6 +14,9 @@ import re
 import struct
 
 import b3dm, i3dm
+import batchtable
+import instancestream
+import precompress
 
 def main():
 	""" Pack GLB into another container, with optional additional I3DM or B3DM encoding"""
@@ -21,16 +24,19 @@ def main():
 	# Parse options and get results
 	parser = argparse.ArgumentParser(description='Converts GLTF to GLB')
 	parser.add_argument("-i", "--i3dm", type=str, \
-	                    help="Export i3dm, with required path to input JSON instance table data. Supports only embedded GLTFs")
+	                    help="Export i3dm, with required path to input JSON instance table data, or an NDJSON, CSV, or column file instance stream. Supports only embedded GLTFs")
 	parser.add_argument("-b", "--b3dm", type=str, \
 	                    help="Export b3dm, with optional path to input JSON batch table data")
 	parser.add_argument("--objectwise", action='store_true', \
 	                    help="If b3dm is specified and this is set, assume list of dicts. Defaults otherwise to dict of lists")
+	parser.add_argument("--sparse-encoding", choices=batchtable.SPARSE_ENCODINGS, default=batchtable.SPARSE_NULLS, \
+	                    help="How to write keys that only some objects have: as nulls, or with 3DTILES_batch_table_hierarchy (which clients must support). auto uses a hierarchy when it is smaller")
 	parser.add_argument("-o", "--output", required=False, default=None, \
 	                    help="Optional output path (defaults to the path of the input file")
 	parser.add_argument("-u", "--unpack", action='store_true', \
 	                    help="Unpack rather than create b3dm file")
 	parser.add_argument("filename")
+	precompress.addArguments(parser)
 	args = parser.parse_args()
 
 	if args.unpack and args.filename:
@@ -78,33 +84,37 @@ def main():
 	else:
 		fname_out = os.path.join(os.path.dirname(args.filename), fname_out)
 
+	precompressor = precompress.fromArguments(args, parser)
 	if args.b3dm != None:
 		b3dm_encoder = b3dm.B3DM()
+		b3dm_encoder.batch_table.sparse_encoding = args.sparse_encoding
 		if len(args.b3dm):
 			with open(args.b3dm, 'r') as f:
 				b3dm_json = json.loads(f.read())
 				#print b3dm_json
 				b3dm_encoder.loadJSONBatch(b3dm_json, args.objectwise)
 
-		with open(fname_out, 'wb') as f:
-			f.write(b3dm_encoder.writeBinary(glb))
+		precompress.writeFile(fname_out, b3dm_encoder.writeBinary(glb), precompressor)
 
 	elif args.i3dm != None:
 		i3dm_encoder = i3dm.I3DM()
 		if not(len(args.i3dm)):
 			raise ValueError("-i/--i3dm requires a JSON instance table")
+		elif instancestream.isStream(args.i3dm):
+			i3dm_encoder.loadInstanceStream(args.i3dm)
 		else:
 			with open(args.i3dm, 'r') as f:
 				i3dm_json = json.loads(f.read())
 			i3dm_encoder.loadJSONInstances(i3dm_json, False)
 
-		with open(fname_out, 'wb') as f:
-			f.write(i3dm_encoder.writeBinary(glb, True))		# Second arg: embed gltf
+		precompress.writeFile(fname_out, i3dm_encoder.writeBinary(glb, True), precompressor)		# Second arg: embed gltf
 
 	else:
 		# This is kinda pointless
-		with open(fname_out, 'wb') as f:
-			f.write(glb)
+		precompress.writeFile(fname_out, glb, precompressor)
+
+	if precompressor:
+		precompressor.close()
 
 if __name__ == "__main__":
 	main()
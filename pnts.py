@@ -8,30 +8,43 @@
 
 import struct
 from batchtable import BatchTable
-from featuretable import InstanceFeatureTable
+from bufferpool import assemble
+from featuretable import InstanceFeatureTable, Semantic, finalizeTables
 
 PNTS_MAGIC = 'pnts'
 PNTS_VERSION = 1
 PNTS_HEADER_LEN = 28
 
 PNTS_SEMANTICS = {
-	'POSITION' : 'f32',
-	'NORMAL' : 'f32',
-	
-	'POSITION_QUANTIZED' : 'u16',
-	# this might get us in to trouble since it can actually also be u8 or u32
-	'BATCH_ID' : 'u16',
-	'RGB565' : 'u16',
-	
-	'NORMAL_OCT16P' : 'u8',
-	'RGBA' : 'u8',
-	'RGB' : 'u8'	
+	# Per-point semantics
+	'POSITION' : Semantic(('f32',), 3, False),
+	'POSITION_QUANTIZED' : Semantic(('u16',), 3, False),
+	'RGBA' : Semantic(('u8',), 4, False),
+	'RGB' : Semantic(('u8',), 3, False),
+	'RGB565' : Semantic(('u16',), 1, False),
+	'NORMAL' : Semantic(('f32',), 3, False),
+	'NORMAL_OCT16P' : Semantic(('u8',), 2, False),
+	'BATCH_ID' : Semantic(('u16', 'u8', 'u32'), 1, False),
+
+	# Global semantics
+	'POINTS_LENGTH' : Semantic(('u32',), 1, True),
+	'BATCH_LENGTH' : Semantic(('u32',), 1, True),
+	'RTC_CENTER' : Semantic(('f32',), 3, True),
+	'QUANTIZED_VOLUME_OFFSET' : Semantic(('f32',), 3, True),
+	'QUANTIZED_VOLUME_SCALE' : Semantic(('f32',), 3, True),
+	'CONSTANT_RGBA' : Semantic(('u8',), 4, True),
 }
 
 class PNTS(object):
 	def __init__(self):
 		self.batch_table = BatchTable()
-		self.feature_table = InstanceFeatureTable(PNTS_SEMANTICS)
+		self.feature_table = InstanceFeatureTable(PNTS_SEMANTICS, 'POINTS_LENGTH')
+
+	def reset(self):
+		""" Discard all loaded and encoded data so that this encoder can be
+			reused for another tile. Call this between writeBinary() calls. """
+		self.batch_table.reset()
+		self.feature_table.reset()
 
 	def loadJSONBatch(self, data_in, object_wise = True):
 		self.batch_table.loadJSONBatch(data_in, object_wise)
@@ -39,7 +52,7 @@ class PNTS(object):
 	def loadJSONFeature(self, data_in, object_wise = True):
 		self.feature_table.loadJSONBatch(data_in, object_wise)
 
-	def writeBinary(self, num_batch_features = 0, num_feature_features = 0):
+	def writeBinary(self, num_batch_features = 0, num_feature_features = 0, pool = None, executor = None):
 
 		# Add the required field BATCH_LENGTH to the feature table,
 		# as well as any other required globals
@@ -48,35 +61,24 @@ class PNTS(object):
 		num_feature_features = max(num_feature_features, self.feature_table.getNumFeatures())
 		self.feature_table.addGlobal('POINTS_LENGTH', num_feature_features)
 
-		self.batch_table.finalize()
-		self.feature_table.finalize()
+		finalizeTables(self.batch_table, self.feature_table, executor)
 
 		# Generate the header
-		output = self.writeHeader(num_batch_features, num_feature_features)
-
-		# Add the feature table JSON to the output
-		feature_json = self.feature_table.getFeatureJSON()
-		output.extend(feature_json)
+		header = self.writeHeader(num_batch_features, num_feature_features)
 
-		# Add the feature table binary to the output
-		feature_bin  = self.feature_table.getFeatureBin()
-		output.extend(feature_bin)
+		# Lay out the feature table JSON and binary, the batch table JSON
+		# and binary
+		sections = [header,
+		            self.feature_table.features_json, self.feature_table.features_bin,
+		            self.batch_table.batch_json, self.batch_table.batch_bin]
 
-		# Add the batch table JSON to the output
-		batch_json = self.batch_table.getBatchJSON()
-		output.extend(batch_json)
-
-		# Add the batch table binary to the output
-		batch_bin  = self.batch_table.getBatchBin()
-		output.extend(batch_bin)
-
-		return output
+		return assemble(sections, pool)
 
 	def writeHeader(self, num_feature_features, num_batch_features):
-		len_feature_json = len(self.feature_table.getFeatureJSON())
-		len_feature_bin  = len(self.feature_table.getFeatureBin())
-		len_batch_json   = len(self.batch_table.getBatchJSON())
-		len_batch_bin    = len(self.batch_table.getBatchBin())
+		len_feature_json = len(self.feature_table.features_json)
+		len_feature_bin  = len(self.feature_table.features_bin)
+		len_batch_json   = len(self.batch_table.batch_json)
+		len_batch_bin    = len(self.batch_table.batch_bin)
 
 		length = PNTS_HEADER_LEN + \
 		         len_feature_json + len_feature_bin + \
@@ -108,7 +110,7 @@ class PNTS(object):
 		self.batch_bin = self.unpackString(data, self.len_batch_bin)
 
 	def readHeader(self, data):
-		self.magic = self.unpack('4s', data)
+		self.magic = self.unpack('4s', data).decode('utf-8')
 		self.version = self.unpack('<I', data)
 
 		if self.magic != PNTS_MAGIC or self.version > PNTS_VERSION:
@@ -120,6 +122,14 @@ class PNTS(object):
 		self.len_batch_json   = self.unpack('<I', data)
 		self.len_batch_bin    = self.unpack('<I', data)
 
+	def readFeatureTable(self):
+		""" Decode the feature table read by readBinary() into
+			self.feature_table, with binary semantics as NumPy arrays
+			that view the tile data rather than copying it """
+		self.feature_table.reset()
+		self.feature_table.loadBinary(self.feature_json, self.feature_bin)
+		return self.feature_table
+
 	def unpackString(self, data, length):
 		self.offset += length
 		return data[self.offset - length : self.offset]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# pntslod.py: Subsample a point cloud into nested levels of detail, for
+# the coarser parent tiles of a pnts tileset. Component of gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# Each level keeps one point per cell of a voxel grid, with the cell size
+# doubling from each level to the next coarser one. All grids share one
+# origin, so every coarse cell is exactly eight finer cells, and the point
+# kept in a cell is the one with the lowest priority, a hash of its
+# index. A coarse level's points are therefore a subset of every finer
+# level's, and the same input always gives the same levels.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import json
+
+import numpy as np
+
+import pnts
+import precompress
+from batchtable import BatchTable
+
+""" Globals that PNTS.writeBinary() fills in itself """
+DERIVED_GLOBALS = ('POINTS_LENGTH', 'BATCH_LENGTH')
+
+def pointPriorities(count, seed = 0):
+	""" Stable pseudorandom priorities: the SplitMix64 hash of each
+		point's index, so that a point's priority does not depend on how
+		many other points there are """
+	with np.errstate(over = 'ignore'):
+		z = np.arange(count, dtype = np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+		z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+		z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+		return z ^ (z >> np.uint64(31))
+
+def pointPositions(features):
+	""" Returns float64 positions for a dict of PNTS semantics, dequantizing
+		POSITION_QUANTIZED. RTC_CENTER is left out: it moves every point
+		by the same amount. """
+	if 'POSITION' in features:
+		return np.asarray(features['POSITION'], dtype = np.float64).reshape(-1, 3)
+	if 'POSITION_QUANTIZED' in features:
+		quantized = np.asarray(features['POSITION_QUANTIZED'], dtype = np.float64).reshape(-1, 3)
+		offset = np.asarray(features['QUANTIZED_VOLUME_OFFSET'], dtype = np.float64)
+		scale = np.asarray(features['QUANTIZED_VOLUME_SCALE'], dtype = np.float64)
+		return quantized * (scale / 65535.) + offset
+	raise KeyError("Points need a POSITION or POSITION_QUANTIZED semantic")
+
+def voxelKeys(positions, origin, size):
+	""" Returns one int64 key per point, identifying its voxel """
+	cells = np.floor((positions - origin) / size).astype(np.int64)
+	dims = cells.max(axis = 0) + 1 if len(cells) else np.ones(3, dtype = np.int64)
+	if float(dims[0]) * float(dims[1]) * float(dims[2]) >= 2**63:
+		raise ValueError("Voxel size %g is too small for a grid this large" % size)
+	return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+def voxelLevels(positions, voxel_size, levels, priorities):
+	""" Returns, coarsest first, one sorted index array per level, the
+		finest with voxels of voxel_size. Each level is selected from the
+		next finer level's points rather than all of them, which gives
+		the same result since the levels are nested, but is cheaper. """
+	origin = positions.min(axis = 0) if len(positions) else np.zeros(3)
+	selected = np.arange(len(positions))
+	result = []
+	for level in range(levels):
+		keys = voxelKeys(positions[selected], origin, voxel_size * 2**level)
+		order = np.lexsort((priorities[selected], keys))
+		sorted_keys = keys[order]
+		first = np.ones(len(order), dtype = bool)
+		first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+		selected = np.sort(selected[order[first]])
+		result.append(selected)
+	return result[::-1]
+
+def subsample(features, indices, semantics = pnts.PNTS_SEMANTICS):
+	""" Returns the per-point semantics of features at indices, plus the
+		global semantics, ready for PNTS.loadJSONFeature(..., False) """
+	output = {}
+	for key, values in features.items():
+		if key in DERIVED_GLOBALS:
+			continue
+		if key not in semantics or semantics[key].is_global:
+			output[key] = values			# Globals, extensions, and extras
+		else:
+			output[key] = np.asarray(values)[indices]
+	return output
+
+def buildLevels(features, voxel_size, levels, seed = 0, additive = False, full_detail = False):
+	""" Subsample a dict of PNTS semantics into levels of detail, coarsest
+		first. Returns (feature dicts, index arrays into the input). With
+		full_detail, a last level holds every point. With additive, each
+		level holds only the points that coarser levels do not, as for
+		ADD refinement. """
+	positions = pointPositions(features)
+	indices = voxelLevels(positions, voxel_size, levels, pointPriorities(len(positions), seed))
+	if full_detail:
+		indices.append(np.arange(len(positions)))
+	if additive:
+		indices = [indices[0]] + [np.setdiff1d(fine, coarse, assume_unique = True) \
+		                          for coarse, fine in zip(indices, indices[1:])]
+	return [subsample(features, idx) for idx in indices], indices
+
+def readPoints(data):
+	""" Returns (features, batch table, BATCH_LENGTH) from a pnts tile, with
+		every semantic as an array or list and the batch table flattened
+		to dense JSON columns """
+	decoder = pnts.PNTS()
+	decoder.readBinary(data)
+	table = decoder.readFeatureTable()
+	features = dict(table.batch_in)
+	for key, value in table.features_global.items():
+		features[key] = value.tolist() if isinstance(value, np.ndarray) else value
+
+	batch_json = bytes(decoder.batch_json).decode('utf-8').strip()
+	batch = BatchTable.expandHierarchy(json.loads(batch_json), decoder.batch_bin) if batch_json else {}
+	if any(isinstance(column, dict) for column in batch.values()):
+		raise ValueError("Binary batch table columns are not supported")
+	return features, batch, features.get('BATCH_LENGTH', 0)
+
+def main():
+	""" Write levels of detail for a pnts tile """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Subsamples a pnts tile into nested levels of detail')
+	parser.add_argument("-v", "--voxel-size", type=float, required=True, \
+	                    help="Voxel size of the finest level; each coarser level doubles it")
+	parser.add_argument("-l", "--levels", type=int, default=4, \
+	                    help="Number of subsampled levels")
+	parser.add_argument("-f", "--full-detail", action='store_true', \
+	                    help="Also write a last level with every point")
+	parser.add_argument("-a", "--additive", action='store_true', \
+	                    help="Write only the points coarser levels lack, for ADD refinement")
+	parser.add_argument("-s", "--seed", type=int, default=0, \
+	                    help="Seed for choosing which point represents each voxel")
+	parser.add_argument("-o", "--output", type=str, default=None, \
+	                    help="Output path prefix (defaults to the input path); levels are written to <prefix>_<level>.pnts")
+	parser.add_argument("input_file")
+	precompress.addArguments(parser)
+	args = parser.parse_args()
+	precompressor = precompress.fromArguments(args, parser)
+
+	with open(args.input_file, 'rb') as f:
+		features, batch, batch_length = readPoints(f.read())
+	levels, indices = buildLevels(features, args.voxel_size, args.levels, args.seed, \
+	                              args.additive, args.full_detail)
+
+	prefix = args.output or os.path.splitext(args.input_file)[0]
+	encoder = pnts.PNTS()
+	for level, (level_features, idx) in enumerate(zip(levels, indices)):
+		encoder.reset()
+		encoder.loadJSONFeature(level_features, False)
+		if batch:
+			# A batch table indexed by BATCH_ID is shared by every level;
+			# one with a row per point is subsampled with the points
+			per_point = 'BATCH_ID' not in features
+			idx_list = idx.tolist()
+			encoder.loadJSONBatch({key: [column[i] for i in idx_list] if per_point else column \
+			                       for key, column in batch.items()}, False)
+		num_batches = batch_length if 'BATCH_ID' in features else 0
+		precompress.writeFile('%s_%d.pnts' % (prefix, level), encoder.writeBinary(num_batches), precompressor)
+	if precompressor:
+		precompressor.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------
+# precompress.py: Component of GLTF to GLB converter
+# Writes gzip/brotli copies of encoded tiles, for
+# serving with an HTTP Content-Encoding
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#--------------------------------------------------
+
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+DEFAULT_THREADS = 4
+
+def gzipCompress(data):
+	# mtime = 0 keeps the output identical across runs
+	return gzip.compress(data, compresslevel = 9, mtime = 0)
+
+def brotliCompress(data):
+	return brotli.compress(data)
+
+""" Supported encodings: file suffix and compressor """
+ENCODINGS = {
+	'gzip' : ('.gz', gzipCompress),
+	'br'   : ('.br', brotliCompress),
+}
+
+class Precompressor:
+	""" Writes tiles along with .gz/.br siblings (or only the siblings,
+		if keep_original is False). Compression and writing happen on a
+		bounded thread pool; zlib and brotli release the GIL, so this
+		overlaps with encoding the next tile. write() blocks once
+		max_pending tiles are queued, bounding memory use. """
+	def __init__(self, encodings = ('gzip',), keep_original = True, threads = DEFAULT_THREADS, max_pending = None):
+		for encoding in encodings:
+			if encoding not in ENCODINGS:
+				raise ValueError("Unknown encoding '%s'" % encoding)
+			if encoding == 'br' and brotli is None:
+				raise ImportError("The brotli module is required for 'br' precompression")
+		self.encodings = encodings
+		self.keep_original = keep_original
+		self.executor = ThreadPoolExecutor(max_workers = threads)
+		self.pending = threading.BoundedSemaphore(max_pending or 2 * threads)
+		self.futures = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def write(self, path, data):
+		""" Queue data to be written to path and its compressed siblings.
+			data is copied unless it is immutable bytes, so the caller may
+			reuse or release its buffer as soon as this returns. """
+		if type(data) is not bytes:
+			data = bytes(data)
+		self.pending.acquire()
+		future = self.executor.submit(self.writeAll, path, data)
+		future.add_done_callback(lambda _: self.pending.release())
+		self.futures.append(future)
+
+	def writeAll(self, path, data):
+		if self.keep_original:
+			writeFile(path, data)
+		for encoding in self.encodings:
+			suffix, compress = ENCODINGS[encoding]
+			writeFile(path + suffix, compress(data))
+
+	def close(self):
+		""" Wait for all queued writes, raising the first error """
+		self.executor.shutdown(wait = True)
+		futures, self.futures = self.futures, []
+		for future in futures:
+			future.result()
+
+def writeFile(path, data, precompressor = None):
+	""" Write data to path, through precompressor if one is given """
+	if precompressor is not None:
+		precompressor.write(path, data)
+	else:
+		with open(path, 'wb') as f:
+			f.write(data)
+
+def addArguments(parser):
+	""" Add the precompression options to an ArgumentParser """
+	parser.add_argument("--precompress", type=str, default=None, \
+	                    help="Comma-separated encodings (gzip, br) to also write as .gz/.br siblings")
+	parser.add_argument("--precompressed-only", action='store_true', \
+	                    help="With --precompress, write only the compressed siblings")
+
+def fromArguments(args, parser = None):
+	""" Returns a Precompressor for parsed arguments, or None. Invalid
+		options, such as an unknown encoding or asking for only the
+		precompressed files without any encodings, are reported with
+		parser.error(), or raised without a parser. """
+	try:
+		if args.precompressed_only and not args.precompress:
+			raise ValueError("--precompressed-only requires --precompress")
+		if not args.precompress:
+			return None
+		encodings = tuple(encoding.strip() for encoding in args.precompress.split(','))
+		return Precompressor(encodings, not args.precompressed_only)
+	except (ValueError, ImportError) as e:
+		if parser is None:
+			raise
+		parser.error(str(e))
@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# roundtrip.py: Randomized round-trip harness for the tile readers and
+# writers. Generates a corpus of random b3dm/i3dm/pnts/cmpt tiles, encodes
+# and decodes each, checks that nothing was lost, and times every stage.
+# The corpus is also run through the tile server, merger, instance
+# streams, precompressor, level-of-detail builder, and tree differ.
+# Component of gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# Each iteration uses its own seed (the base seed plus the iteration), so a
+# failure can be reproduced with -s <failing seed> -n 1.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+import numpy as np
+
+import b3dm
+import i3dm
+import pnts
+import instancestream
+import mergeglb
+import packcmpt as cmpt
+import pntslod
+import precompress
+import tile3dinfo
+import tilearchive
+import tilediff
+import tileserver
+import transcode
+from batchtable import BatchTable, SPARSE_AUTO, SPARSE_ENCODINGS
+from bufferpool import BufferPool
+from featuretable import COMPONENT_TYPES
+from glb import GLB
+
+THREADS = ThreadPoolExecutor(max_workers = 4)
+
+class Timer:
+	""" Accumulates wall time per named stage """
+	def __init__(self):
+		self.totals = defaultdict(float)
+		self.counts = defaultdict(int)
+
+	@contextlib.contextmanager
+	def time(self, stage):
+		start = time.perf_counter()
+		yield
+		self.totals[stage] += time.perf_counter() - start
+		self.counts[stage] += 1
+
+	def report(self):
+		print("%-24s %8s %12s %12s" % ('stage', 'count', 'total ms', 'mean us'))
+		for stage in sorted(self.totals):
+			total, count = self.totals[stage], self.counts[stage]
+			print("%-24s %8d %12.2f %12.1f" % (stage, count, total * 1e3, total / count * 1e6))
+
+""" Random inputs """
+def randomValue(rng):
+	kind = rng.integers(6)
+	if kind == 0:
+		return int(rng.integers(-1000, 1000))
+	elif kind == 1:
+		return float(rng.normal())
+	elif kind == 2:
+		return ''.join(chr(c) for c in rng.integers(32, 0x3ff, rng.integers(0, 8)))
+	elif kind == 3:
+		return bool(rng.integers(2))
+	elif kind == 4:
+		return [int(v) for v in rng.integers(0, 10, 3)]
+	return None
+
+def randomBatch(rng, n):
+	""" Object-wise batch data, with keys present for random subsets """
+	keys = ['key%d' % i for i in range(rng.integers(1, 6))] + ['Spaced key']
+	objs = []
+	for _ in range(n):
+		objs.append({key: randomValue(rng) for key in keys if rng.random() < 0.7})
+	return objs
+
+def denseBatch(objs):
+	keys = set(key for obj in objs for key in obj)
+	return {key: [obj.get(key) for obj in objs] for key in keys}
+
+def withoutNullColumns(batch):
+	# A hierarchy has no class to hold a property that is null for every
+	# feature, so such columns are equivalent to absent ones
+	return {key: column for key, column in batch.items() if any(v is not None for v in column)}
+
+def randomGLB(rng, num_batches = 0):
+	glb = GLB()
+	n = int(rng.integers(3, 64))
+	attributes = {'POSITION': glb.addAccessor(rng.random((n, 3)).astype('<f4'), bounds = True)}
+	if num_batches:
+		attributes['_BATCHID'] = glb.addAccessor(rng.integers(0, num_batches, n).astype('<u2'))
+	primitive = {'attributes': attributes}
+	if rng.random() < 0.5:
+		primitive['indices'] = glb.addAccessor(rng.integers(0, n, 3 * n).astype('<u2'), target = 34963)
+	glb.gltf['meshes'] = [{'primitives': [primitive]}]
+	glb.gltf['nodes'] = [{'mesh': 0}]
+	glb.gltf['scenes'] = [{'nodes': [0]}]
+	glb.gltf['scene'] = 0
+	return bytes(glb.writeBinary())
+
+def randomColumn(rng, n, semantic):
+	shape = (n, semantic.components) if semantic.components > 1 else (n,)
+	dtype = semantic.dtype()
+	if dtype.kind == 'f':
+		return rng.normal(size = shape).astype(dtype)
+	return rng.integers(0, np.iinfo(dtype).max, shape, endpoint = True).astype(dtype)
+
+def randomFeatures(rng, n, semantics, required):
+	""" A random subset of a registry's per-feature semantics """
+	features = {key: randomColumn(rng, n, semantics[key]) for key in required}
+	for key, semantic in semantics.items():
+		if not semantic.is_global and key not in features and key != 'BATCH_ID' and rng.random() < 0.4:
+			features[key] = randomColumn(rng, n, semantic)
+	if rng.random() < 0.5:
+		# Exercise every BATCH_ID width
+		high = [2**8, 2**16, 2**24][rng.integers(3)]
+		features['BATCH_ID'] = rng.integers(0, high, n)
+	return features
+
+def randomFrames(rng, n):
+	""" Orthonormal NORMAL_UP and NORMAL_RIGHT vectors """
+	up = rng.normal(size = (n, 3))
+	up /= np.linalg.norm(up, axis = 1, keepdims = True)
+	right = np.cross(up, rng.normal(size = (n, 3)))
+	right /= np.linalg.norm(right, axis = 1, keepdims = True)
+	return up.astype('<f4'), right.astype('<f4')
+
+""" Checks """
+class RoundTripError(AssertionError):
+	pass
+
+def check(condition, message):
+	if not condition:
+		raise RoundTripError(message)
+
+def parseJSON(data):
+	return transcode.parseJSON(data)
+
+def checkBatch(decoder, objs):
+	batch = BatchTable.expandHierarchy(parseJSON(decoder.batch_json), decoder.batch_bin)
+	check(withoutNullColumns(batch) == withoutNullColumns(denseBatch(objs)), "Batch table mismatch")
+
+def checkFeatures(decoder, features):
+	table = decoder.readFeatureTable()
+	for key, expected in features.items():
+		check(key in table.batch_in, "Semantic %s missing" % key)
+		actual = table.batch_in[key]
+		check(np.array_equal(np.asarray(actual).reshape(np.shape(expected)), expected), "Semantic %s mismatch" % key)
+	if 'BATCH_ID' in features and len(features['BATCH_ID']):
+		width = np.asarray(table.batch_in['BATCH_ID']).dtype.itemsize
+		limit = int(np.max(features['BATCH_ID']))
+		check(width == min(w for w in (1, 2, 4) if limit < 2**(8 * w)), "BATCH_ID not in its smallest width")
+
+def encodeRepeatedly(timer, name, make, encode):
+	""" Encode with a fresh encoder, then again after reset() into a
+		pooled buffer, and again with a thread pool finalizing the tables;
+		every result must be identical """
+	encoder = make()
+	with timer.time(name + ' encode'):
+		first = bytes(encode(encoder, None, None))
+	pool = BufferPool()
+	encoder.reset()
+	output = encode(encoder, pool, None)
+	second = bytes(output)
+	pool.release(output)
+	check(first == second, "%s output differs after reset()" % name)
+	encoder.reset()
+	with timer.time(name + ' threaded encode'):
+		third = bytes(encode(encoder, None, THREADS))
+	check(first == third, "%s output differs when encoded with an executor" % name)
+	return first
+
+def caseB3DM(rng, timer):
+	n = int(rng.integers(0, 40))
+	objs = randomBatch(rng, n)
+	gltf = randomGLB(rng, n)
+	encoding = SPARSE_ENCODINGS[rng.integers(len(SPARSE_ENCODINGS))]
+	extras = {'extras': {'seed': int(rng.integers(1000))}, 'extensions': {'EXT_example': {'n': n}}} \
+	         if rng.random() < 0.5 else {}
+	def encode(encoder, pool, executor):
+		encoder.batch_table.sparse_encoding = encoding
+		encoder.loadJSONBatch(objs, True)
+		if extras:
+			encoder.loadJSONFeature(dict(extras), False)
+		return encoder.writeBinary(gltf, pool = pool, executor = executor)
+	data = encodeRepeatedly(timer, 'b3dm', b3dm.B3DM, encode)
+
+	decoder = b3dm.B3DM()
+	with timer.time('b3dm decode'):
+		decoder.readBinary(data)
+	check(bytes(decoder.getGLTFBin()) == gltf, "b3dm GLB mismatch")
+	check(parseJSON(decoder.feature_json)['BATCH_LENGTH'] == n, "b3dm BATCH_LENGTH mismatch")
+	for key, value in extras.items():
+		check(parseJSON(decoder.feature_json).get(key) == value, "b3dm feature table %s mismatch" % key)
+	checkBatch(decoder, objs)
+
+	if n:
+		with timer.time('b3dm transcode'):
+			back = bytes(transcode.glbToTile(transcode.tileToGLB(data))[1])
+		decoder = b3dm.B3DM()
+		decoder.readBinary(back)
+		checkBatch(decoder, objs)
+	return 'b3dm', data
+
+def caseI3DM(rng, timer):
+	n = int(rng.integers(1, 200))
+	features = randomFeatures(rng, n, i3dm.I3DM_SEMANTICS, ['POSITION'])
+	gltf = randomGLB(rng)
+	def encode(encoder, pool, executor):
+		encoder.loadJSONInstances(features, False)
+		return encoder.writeBinary(gltf, True, pool = pool, executor = executor)
+	data = encodeRepeatedly(timer, 'i3dm', i3dm.I3DM, encode)
+
+	decoder = i3dm.I3DM()
+	with timer.time('i3dm decode'):
+		decoder.readBinary(data)
+	check(bytes(decoder.getGLTFBin()) == gltf, "i3dm GLB mismatch")
+	check(parseJSON(decoder.feature_json)['INSTANCES_LENGTH'] == n, "INSTANCES_LENGTH mismatch")
+	checkFeatures(decoder, features)
+
+	# The random semantics above are not valid transforms, so transcode a
+	# tile whose instances are
+	up, right = randomFrames(rng, n)
+	instances = {'POSITION': rng.normal(size = (n, 3)).astype('<f4'), 'NORMAL_UP': up, 'NORMAL_RIGHT': right, \
+	             'SCALE_NON_UNIFORM': rng.uniform(0.5, 2, (n, 3)).astype('<f4'), 'BATCH_ID': rng.integers(0, 2**16, n)}
+	east_north_up = bool(rng.random() < 0.3)
+	if east_north_up:
+		# Oriented by their place on the globe instead
+		del instances['NORMAL_UP'], instances['NORMAL_RIGHT']
+	encoder = i3dm.I3DM()
+	encoder.loadJSONInstances(instances, False)
+	if east_north_up:
+		encoder.feature_table.addGlobal('EAST_NORTH_UP', True)
+		encoder.feature_table.addGlobal('RTC_CENTER', (6378137. * up[0].astype(np.float64)).tolist())
+	original = bytes(encoder.writeBinary(gltf, True))
+	with timer.time('i3dm transcode'):
+		magic, back = transcode.glbToTile(transcode.tileToGLB(original))
+	check(magic == i3dm.I3DM_MAGIC, "i3dm transcoded back to %s" % magic)
+	decoder = i3dm.I3DM()
+	decoder.readBinary(original)
+	expected = transcode.instanceMatrices(decoder.readFeatureTable())
+	decoder = i3dm.I3DM()
+	decoder.readBinary(bytes(back))
+	table = decoder.readFeatureTable()
+	check(np.allclose(transcode.instanceMatrices(table), expected, atol = 1e-4), "i3dm transcoded transforms mismatch")
+	check(np.array_equal(table.batch_in['BATCH_ID'], instances['BATCH_ID']), "i3dm transcoded BATCH_ID mismatch")
+	return 'i3dm', data
+
+def casePNTS(rng, timer):
+	n = 0 if rng.random() < 0.05 else int(rng.integers(1, 2000))		# Empty tiles too
+	features = randomFeatures(rng, n, pnts.PNTS_SEMANTICS, ['POSITION'])
+	rtc_center = rng.normal(size = 3).astype('<f4')
+	binary_rtc = bool(rng.random() < 0.5)
+	def encode(encoder, pool, executor):
+		encoder.loadJSONFeature(features, False)
+		encoder.feature_table.addGlobal('RTC_CENTER', rtc_center if binary_rtc else rtc_center.tolist(), binary_rtc)
+		return encoder.writeBinary(pool = pool, executor = executor)
+	data = encodeRepeatedly(timer, 'pnts', pnts.PNTS, encode)
+
+	decoder = pnts.PNTS()
+	with timer.time('pnts decode'):
+		decoder.readBinary(data)
+	check(parseJSON(decoder.feature_json)['POINTS_LENGTH'] == n, "POINTS_LENGTH mismatch")
+	checkFeatures(decoder, features)
+	check(np.array_equal(np.asarray(decoder.feature_table.features_global['RTC_CENTER'], dtype = '<f4'), rtc_center), \
+	      "RTC_CENTER mismatch")
+	if n:
+		with timer.time('pnts transcode'):
+			magic, back = transcode.glbToTile(transcode.tileToGLB(data))
+		check(magic == pnts.PNTS_MAGIC, "pnts transcoded back to %s" % magic)
+		checkTranscodedPoints(bytes(back), features, rtc_center)
+	return 'pnts', data
+
+def checkTranscodedPoints(data, features, rtc_center):
+	""" Points come back with POSITION, with colors as RGB or RGBA, and
+		with normals and BATCH_IDs, whatever they were encoded as """
+	decoder = pnts.PNTS()
+	decoder.readBinary(data)
+	table = decoder.readFeatureTable()
+	actual = table.batch_in
+	check(np.allclose(actual['POSITION'], features['POSITION'], atol = 1e-6), "pnts transcoded POSITION mismatch")
+	check(np.allclose(table.features_global['RTC_CENTER'], rtc_center), "pnts transcoded RTC_CENTER mismatch")
+	if 'RGBA' in features:
+		check(np.array_equal(actual.get('RGBA'), features['RGBA']), "pnts transcoded RGBA mismatch")
+	elif 'RGB' in features:
+		check(np.array_equal(actual.get('RGB'), features['RGB']), "pnts transcoded RGB mismatch")
+	elif 'RGB565' in features:
+		check(np.array_equal(actual.get('RGB'), transcode.rgb565ToRGB(features['RGB565'])), "pnts transcoded RGB565 mismatch")
+	normals = features['NORMAL'] if 'NORMAL' in features else \
+	          transcode.octDecode(features['NORMAL_OCT16P'], 8) if 'NORMAL_OCT16P' in features else None
+	if normals is not None:
+		check(np.allclose(actual['NORMAL'], normals, atol = 1e-6), "pnts transcoded NORMAL mismatch")
+	if 'BATCH_ID' in features:
+		check(np.array_equal(actual['BATCH_ID'], features['BATCH_ID']), "pnts transcoded BATCH_ID mismatch")
+
+def caseCMPT(rng, timer, tiles):
+	inner = [tiles[i] for i in rng.integers(0, len(tiles), rng.integers(1, 5))]
+	encoder = cmpt.CmptEncoder()
+	with timer.time('cmpt encode'):
+		for _, data in inner:
+			encoder.add_content(data)
+		encoder.composeHeader()
+		data = bytes(encoder.header + encoder.body)
+
+	decoder = cmpt.CmptDecoder()
+	with timer.time('cmpt decode'):
+		decoder.add(data = data)
+		decoder.decode()
+	decoded = decoder.getTiles()
+	check([(t['magic'], bytes(t['data'])) for t in decoded] == [(m, d) for m, d in inner], "cmpt tile mismatch")
+	return 'cmpt', data
+
+def checkMerge(rng, timer):
+	""" Merged GLBs keep their geometry, with each source's _BATCHID set to
+		its index """
+	k = int(rng.integers(1, 6))
+	sources = [randomGLB(rng) for _ in range(k)]
+	objs = randomBatch(rng, k)
+	with timer.time('mergeglb'):
+		data = bytes(mergeglb.mergeToB3DM(sources, objs))
+	decoder = b3dm.B3DM()
+	decoder.readBinary(data)
+	check(parseJSON(decoder.feature_json)['BATCH_LENGTH'] == k, "merged BATCH_LENGTH mismatch")
+	checkBatch(decoder, objs)
+
+	merged = GLB()
+	merged.readBinary(bytes(decoder.getGLTFBin()))
+	check(len(merged.gltf['meshes']) == k, "merged GLB has %d meshes for %d sources" % (len(merged.gltf['meshes']), k))
+	for batch_id, (source, mesh) in enumerate(zip(sources, merged.gltf['meshes'])):
+		glb = GLB()
+		glb.readBinary(source)
+		expected = glb.readAccessor(glb.gltf['meshes'][0]['primitives'][0]['attributes']['POSITION'])
+		attributes = mesh['primitives'][0]['attributes']
+		check(np.array_equal(merged.readAccessor(attributes['POSITION']), expected), "merged POSITION mismatch")
+		check(np.all(merged.readAccessor(attributes['_BATCHID']) == batch_id), "merged _BATCHID mismatch")
+
+def checkServer(rng, timer, client, corpus):
+	""" The tile server's output must match encoding in process """
+	n = int(rng.integers(1, 20))
+	gltf = randomGLB(rng, n)
+	batch = denseBatch(randomBatch(rng, n))
+	with timer.time('tileserver b3dm'):
+		served = bytes(client.packB3DM(gltf, batch))
+	encoder = b3dm.B3DM()
+	encoder.loadJSONBatch(batch, False)
+	check(served == bytes(encoder.writeBinary(gltf)), "tileserver b3dm mismatch")
+
+	positions = rng.normal(size = (n, 3)).astype('<f4').tolist()
+	with timer.time('tileserver i3dm'):
+		served = bytes(client.packI3DM(gltf, {'POSITION': positions}))
+	encoder = i3dm.I3DM()
+	encoder.loadJSONInstances({'POSITION': positions}, False)
+	check(served == bytes(encoder.writeBinary(gltf, True)), "tileserver i3dm mismatch")
+
+	with timer.time('tileserver pnts'):
+		served = bytes(client.packPNTS({'POSITION': positions}))
+	encoder = pnts.PNTS()
+	encoder.loadJSONFeature({'POSITION': positions}, False)
+	check(served == bytes(encoder.writeBinary()), "tileserver pnts mismatch")
+
+	tiles = [data for magic, data in corpus if magic != cmpt.CMPT_MAGIC]
+	for data in tiles:
+		with timer.time('tileserver unpack'):
+			header, parts = client.unpack(data)
+		decoder = {b3dm.B3DM_MAGIC: b3dm.B3DM, i3dm.I3DM_MAGIC: i3dm.I3DM, pnts.PNTS_MAGIC: pnts.PNTS}[header['magic']]()
+		decoder.readBinary(data)
+		check(header['feature_json'] == bytes(decoder.feature_json).decode('utf-8').rstrip(), "tileserver unpacked feature table mismatch")
+		check(header['batch_json'] == bytes(decoder.batch_json).decode('utf-8').rstrip(), "tileserver unpacked batch table mismatch")
+		if hasattr(decoder, 'gltf_bin'):
+			check(bytes(parts[0]) == bytes(decoder.gltf_bin), "tileserver unpacked GLB mismatch")
+	if tiles:
+		with timer.time('tileserver cmpt'):
+			served = bytes(client.packCMPT(tiles))
+		encoder = cmpt.CmptEncoder()
+		for data in tiles:
+			encoder.add_content(data)
+		encoder.composeHeader()
+		check(served == bytes(encoder.header + encoder.body), "tileserver cmpt mismatch")
+
+def startServer(directory):
+	""" A tile server on a Unix socket in directory, serving from a thread """
+	server = tileserver.makeServer(os.path.join(directory, 'tileserver.sock'), workers = 2)
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	return server
+
+def checkStreams(rng, directory, timer):
+	""" Instances written as NDJSON, CSV, and column files all read back
+		the same """
+	n = int(rng.integers(1, 100))
+	semantics = i3dm.I3DM_SEMANTICS
+	features = randomFeatures(rng, n, semantics, ['POSITION'])
+	keys = sorted(features)
+
+	ndjson_path = os.path.join(directory, 'instances.ndjson')
+	with open(ndjson_path, 'w') as f:
+		for i in range(n):
+			f.write(json.dumps({key: features[key][i].tolist() for key in keys}) + '\n')
+
+	csv_path = os.path.join(directory, 'instances.csv')
+	header, columns = [], []
+	for key in keys:
+		values = np.asarray(features[key]).reshape(n, -1)
+		for component in range(values.shape[1]):
+			header.append('%s.%d' % (key, component) if semantics[key].components > 1 else key)
+			columns.append(values[:, component].tolist())
+	with open(csv_path, 'w') as f:
+		f.write(','.join(header) + '\n')
+		for row in zip(*columns):
+			f.write(','.join(repr(v) for v in row) + '\n')
+
+	column_dir = os.path.join(directory, 'instances')
+	os.mkdir(column_dir)
+	short_names = {np.dtype(code): short for short, (_, code) in COMPONENT_TYPES.items()}
+	for key in keys:
+		dtype = instancestream.parseDtype(semantics[key])
+		values = np.asarray(features[key]).astype(dtype)
+		if rng.random() < 0.5:
+			np.save(os.path.join(column_dir, key + '.npy'), values)
+		else:
+			values.tofile(os.path.join(column_dir, '%s.%s.bin' % (key, short_names[dtype])))
+
+	for path in (ndjson_path, csv_path, column_dir):
+		with timer.time('instancestream read'):
+			read, _ = instancestream.readInstances(path, semantics, chunk_size = int(rng.integers(1, 64)))
+		check(sorted(read) == keys, "%s: semantics %s, expected %s" % (path, sorted(read), keys))
+		for key in keys:
+			check(np.array_equal(np.asarray(read[key]).reshape(np.shape(features[key])), features[key]), \
+			      "%s: semantic %s mismatch" % (path, key))
+
+def checkPrecompress(rng, corpus, paths, directory, timer):
+	""" Compressed siblings decompress to the tile, with or without the
+		original alongside """
+	encodings = ('gzip', 'br') if precompress.brotli is not None else ('gzip',)
+	keep_original = bool(rng.random() < 0.5)
+	out_dir = os.path.join(directory, 'precompressed')
+	os.mkdir(out_dir)
+	out_paths = [os.path.join(out_dir, os.path.basename(path)) for path in paths]
+	with timer.time('precompress'):
+		with precompress.Precompressor(encodings, keep_original) as precompressor:
+			for path, (_, data) in zip(out_paths, corpus):
+				precompressor.write(path, data)
+
+	for path, (_, data) in zip(out_paths, corpus):
+		check(os.path.exists(path) == keep_original, "%s: original %s" % (path, 'missing' if keep_original else 'written'))
+		with open(path + '.gz', 'rb') as f:
+			check(gzip.decompress(f.read()) == data, "%s.gz mismatch" % path)
+		if 'br' in encodings:
+			with open(path + '.br', 'rb') as f:
+				check(precompress.brotli.decompress(f.read()) == data, "%s.br mismatch" % path)
+
+def checkLevels(corpus, timer):
+	""" Levels of detail are nested, keep one point per voxel, and encode """
+	for magic, data in corpus:
+		if magic != pnts.PNTS_MAGIC:
+			continue
+		features, _, _ = pntslod.readPoints(data)
+		positions = pntslod.pointPositions(features)
+		if not len(positions):
+			continue
+		voxel_size = float(np.ptp(positions, axis = 0).max()) / 16 or 1.
+		with timer.time('pntslod'):
+			levels, indices = pntslod.buildLevels(features, voxel_size, 3, full_detail = True)
+		check(np.array_equal(indices[-1], np.arange(len(positions))), "pntslod full detail level mismatch")
+		for coarse, fine in zip(indices, indices[1:]):
+			check(np.isin(coarse, fine).all(), "pntslod levels are not nested")
+		origin = positions.min(axis = 0)
+		for level, idx in enumerate(indices[:-1]):
+			keys = pntslod.voxelKeys(positions[idx], origin, voxel_size * 2**(len(indices) - 2 - level))
+			check(len(np.unique(keys)) == len(keys), "pntslod kept two points in one voxel")
+
+		_, additive = pntslod.buildLevels(features, voxel_size, 3, additive = True, full_detail = True)
+		check(np.array_equal(np.sort(np.concatenate(additive)), np.arange(len(positions))), \
+		      "pntslod additive levels do not partition the points")
+
+		encoder = pnts.PNTS()
+		for level_features, idx in zip(levels, indices):
+			encoder.reset()
+			encoder.loadJSONFeature(level_features, False)
+			decoder = pnts.PNTS()
+			decoder.readBinary(bytes(encoder.writeBinary()))
+			check(parseJSON(decoder.feature_json)['POINTS_LENGTH'] == len(idx), "pntslod level POINTS_LENGTH mismatch")
+
+def checkDiff(rng, directory, paths, timer):
+	""" An unchanged tree rehashes to the same manifest; a corrupted tile
+		is reported with only its changed section """
+	with timer.time('tilediff hash'):
+		manifest = tilediff.hashTree(directory)
+	check(tilediff.hashTree(directory, manifest) == manifest, "tilediff manifest changed with no changes")
+
+	path = paths[int(rng.integers(len(paths)))]
+	stat = os.stat(path)
+	with open(path, 'r+b') as f:
+		f.seek(-1, os.SEEK_END)
+		last = f.read(1)[0]
+		f.seek(-1, os.SEEK_END)
+		f.write(bytes([last ^ 0xff]))
+	os.utime(path, ns = (stat.st_atime_ns, stat.st_mtime_ns + 1000))
+	with timer.time('tilediff rehash'):
+		changed = tilediff.hashTree(directory, manifest)
+	added, removed, modified = tilediff.diffManifests(manifest, changed)
+	rel_path = os.path.relpath(path, directory).replace(os.sep, '/')
+	check(not added and not removed and list(modified) == [rel_path], \
+	      "tilediff reported %s for a change to %s" % ((added, removed, sorted(modified)), rel_path))
+	check(len(modified[rel_path]) == 1 and not modified[rel_path][0].endswith('header'), \
+	      "tilediff reported sections %s for a change to the last byte" % modified[rel_path])
+
+def checkFiles(corpus, directory, timer, rng):
+	""" Checks that need the corpus on disk: header probes, tile3dinfo,
+		cmpt unpacking, archives, instance streams, precompression, levels
+		of detail, and tree diffs """
+	paths = []
+	for i, (magic, data) in enumerate(corpus):
+		path = os.path.join(directory, 'tile%d.%s' % (i, magic))
+		with open(path, 'wb') as f:
+			f.write(data)
+		paths.append(path)
+
+	for path, (magic, data) in zip(paths, corpus):
+		with timer.time('probe'):
+			record = tile3dinfo.probeFile(path)
+		check(record.magic == magic and record.length == len(data), "%s: probe mismatch" % path)
+		with contextlib.redirect_stdout(io.StringIO()):
+			with timer.time('tile3dinfo parse'):
+				tile3dinfo.parseFile(data)
+
+		if magic == cmpt.CMPT_MAGIC:
+			out_dir = path + '.unpacked'
+			os.mkdir(out_dir)
+			with timer.time('cmpt unpack'):
+				cmpt.CmptUnpacker(out_dir).unpackFile(path)
+			check(len(os.listdir(out_dir)) == len(record.tiles), "%s: unpacked tiles overwrote each other" % path)
+
+	archive = os.path.join(directory, 'corpus.3tz')
+	with timer.time('archive write'):
+		with tilearchive.TileArchiveWriter(archive) as writer:
+			for path, (_, data) in zip(paths, corpus):
+				writer.add(os.path.basename(path), data)
+	with tilearchive.TileArchiveReader(archive) as reader:
+		for path, (_, data) in zip(paths, corpus):
+			with timer.time('archive read'):
+				found = reader.read(os.path.basename(path))
+			check(found == data, "%s: archive mismatch" % path)
+
+	checkStreams(rng, directory, timer)
+	checkPrecompress(rng, corpus, paths, directory, timer)
+	checkLevels(corpus, timer)
+	if paths:
+		checkDiff(rng, directory, paths, timer)
+
+def checkSparseScaling(timer, n = 5000, keys = 500, per_object = 3):
+	""" An auto-encoded batch table of objects with a few keys each, out
+		of many, must grow with the values present, not features times keys """
+	rng = np.random.default_rng(0)
+	sizes = []
+	for num_keys in (keys, 4 * keys):
+		objs = [{'key%d' % k: i for k in rng.integers(0, num_keys, per_object)} for i in range(n)]
+		table = BatchTable(SPARSE_AUTO)
+		table.loadJSONBatch(objs, True)
+		with timer.time('sparse batch x%d keys' % num_keys):
+			table.finalize()
+		sizes.append(len(table.getBatchJSON()) + len(table.getBatchBin()))
+		batch = BatchTable.expandHierarchy(parseJSON(table.getBatchJSON()), table.getBatchBin())
+		check(withoutNullColumns(batch) == denseBatch(objs), "Sparse batch table mismatch")
+	check(sizes[1] < 1.5 * sizes[0], "Sparse batch table grew from %d to %d bytes with 4x the keys" % tuple(sizes))
+
+CASES = {
+	'b3dm': caseB3DM,
+	'i3dm': caseI3DM,
+	'pnts': casePNTS,
+}
+
+def runIteration(seed, timer, cases, corpus_dir = None, client = None):
+	rng = np.random.default_rng(seed)
+	corpus = [CASES[name](rng, timer) for name in cases]
+	if corpus:
+		corpus.append(caseCMPT(rng, timer, corpus))
+	checkMerge(rng, timer)
+	if client:
+		checkServer(rng, timer, client, corpus)
+
+	directory = corpus_dir or tempfile.mkdtemp(prefix = 'roundtrip')
+	directory = os.path.join(directory, 'seed%d' % seed)
+	os.makedirs(directory, exist_ok = True)
+	try:
+		checkFiles(corpus, directory, timer, rng)
+	finally:
+		if not corpus_dir:
+			shutil.rmtree(os.path.dirname(directory))
+
+def main():
+	""" Run randomized round trips over every tile format """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Round-trips random tiles through every reader and writer')
+	parser.add_argument("-n", "--iterations", type=int, default=100, \
+	                    help="Number of random corpora to generate")
+	parser.add_argument("-s", "--seed", type=int, default=0, \
+	                    help="Seed of the first iteration")
+	parser.add_argument("-c", "--cases", type=str, default=','.join(CASES), \
+	                    help="Comma-separated formats to generate")
+	parser.add_argument("-o", "--output", type=str, default=None, \
+	                    help="Keep the generated corpus in this directory")
+	args = parser.parse_args()
+
+	cases = [name for name in args.cases.split(',') if name]
+	timer = Timer()
+	failures = 0
+	try:
+		checkSparseScaling(timer)
+	except Exception:
+		failures += 1
+		print("Sparse batch table scaling failed:")
+		traceback.print_exc()
+	server_dir = tempfile.mkdtemp(prefix = 'tileserver')
+	server = startServer(server_dir)
+	client = tileserver.TileClient(os.path.join(server_dir, 'tileserver.sock'))
+	try:
+		for seed in range(args.seed, args.seed + args.iterations):
+			try:
+				runIteration(seed, timer, cases, args.output, client)
+			except Exception:
+				failures += 1
+				print("Seed %d failed:" % seed)
+				traceback.print_exc()
+	finally:
+		client.close()
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(server_dir)
+
+	timer.report()
+	print("%d of %d iterations failed" % (failures, args.iterations))
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
@@ -8,12 +8,31 @@
 
 import sys, os
 import argparse
+import itertools
 import struct
+from collections import namedtuple, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import packcmpt as cmpt
 import packglb
 import b3dm
 import i3dm
+import pnts
+
+PROBE_LEN = 32                  # Longest header we need to read: i3dm
+PROBE_BATCH = 4096              # Files in flight at once during bulk probes
+PROBE_EXTS = {'.b3dm', '.i3dm', '.pnts', '.cmpt'}
+SECTIONS = ('feature_json', 'feature_bin', 'batch_json', 'batch_bin', 'gltf')
+
+""" Header layouts after the magic, version, and byte length """
+HEADER_FORMATS = {
+    b3dm.B3DM_MAGIC: ('<IIII', b3dm.B3DM_HEADER_LEN),
+    i3dm.I3DM_MAGIC: ('<IIIII', i3dm.I3DM_HEADER_LEN),
+    pnts.PNTS_MAGIC: ('<IIII', pnts.PNTS_HEADER_LEN),
+    cmpt.CMPT_MAGIC: ('<I', cmpt.CMPT_HEADER_LEN),
+}
+
+ProbeRecord = namedtuple('ProbeRecord', ['path', 'magic', 'version', 'length'] + list(SECTIONS) + ['tiles'])
 
 def printFeatureBatch(decoder, s_indent):
     print("%s\tFeature JSON length: %d" % (s_indent, decoder.len_feature_json))
@@ -38,6 +57,17 @@ def parseI3DM(data, indent = 0):
     print("%sI3DM File:" % (s_indent))
     printFeatureBatch(i3dm_decoder, s_indent)
 
+def parsePNTS(data, indent = 0):
+    s_indent = '\t' * indent
+    pnts_decoder = pnts.PNTS()
+    pnts_decoder.readBinary(data)
+
+    print("%sPNTS File:" % (s_indent))
+    print("%s\tFeature JSON length: %d" % (s_indent, pnts_decoder.len_feature_json))
+    print("%s\tFeature binary length: %d" % (s_indent, pnts_decoder.len_feature_bin))
+    print("%s\tBatch JSON length: %d" % (s_indent, pnts_decoder.len_batch_json))
+    print("%s\tBatch binary length: %d" % (s_indent, pnts_decoder.len_batch_bin))
+
 def parseCMPT(data, indent = 0):
     print("%sCMPT File:" % ('\t' * indent))
     decoder = cmpt.CmptDecoder()
@@ -50,25 +80,164 @@ def parseCMPT(data, indent = 0):
 def parseFile(data, indent = 0):
     if len(data) < 4:
         raise ValueError('Binary is fewer than 4 bytes; no magic fits')
-    if data[0:4] == cmpt.CMPT_MAGIC:
+    magic = data[0:4].decode('utf-8', 'replace')
+    if magic == cmpt.CMPT_MAGIC:
         parseCMPT(data, indent)
-    elif data[0:4] == b3dm.B3DM_MAGIC:
+    elif magic == b3dm.B3DM_MAGIC:
         parseB3DM(data, indent)
-    elif data[0:4] == i3dm.I3DM_MAGIC:
+    elif magic == i3dm.I3DM_MAGIC:
         parseI3DM(data, indent)
+    elif magic == pnts.PNTS_MAGIC:
+        parsePNTS(data, indent)
     else:
-        raise ValueError('Unknown magic "%s"' % (data[0:4]))
+        raise ValueError('Unknown magic "%s"' % (magic))
+
+def probeHeader(header, path):
+    """ Build a ProbeRecord from the first bytes of a tile. Inner tiles of
+        a cmpt are left as an empty list for the caller to fill in. """
+    if len(header) < 12:
+        raise ValueError('%s: too short for a tile header' % (path))
+    magic, version, length = struct.unpack('<4sII', header[0:12])
+    magic = magic.decode('utf-8', 'replace')
+    if magic not in HEADER_FORMATS:
+        raise ValueError('%s: unknown magic "%s"' % (path, magic))
+    fmt, header_len = HEADER_FORMATS[magic]
+    if len(header) < header_len:
+        raise ValueError('%s: truncated %s header' % (path, magic))
+    fields = struct.unpack(fmt, header[12:12 + struct.calcsize(fmt)])
+
+    if magic == cmpt.CMPT_MAGIC:
+        return ProbeRecord(path, magic, version, length, 0, 0, 0, 0, 0, [])
+    sections = fields[0:4]
+    gltf = 0 if magic == pnts.PNTS_MAGIC else length - header_len - sum(sections)
+    return ProbeRecord(path, magic, version, length, *sections, gltf, None)
+
+def probeHandle(f, path, offset = 0):
+    """ Probe the tile at offset in an open file, seeking past the bodies
+        of any cmpt's inner tiles rather than reading them """
+    f.seek(offset)
+    record = probeHeader(f.read(PROBE_LEN), path)
+    if record.magic == cmpt.CMPT_MAGIC:
+        f.seek(offset + 12)
+        count = struct.unpack('<I', f.read(4))[0]
+        inner_offset = offset + cmpt.CMPT_HEADER_LEN
+        for i in range(count):
+            inner = probeHandle(f, '%s#%d' % (path, i), inner_offset)
+            record.tiles.append(inner)
+            inner_offset += inner.length
+    return record
+
+def probeFile(path):
+    """ Returns a ProbeRecord for a b3dm, i3dm, pnts, or cmpt file,
+        reading only its header(s) """
+    with open(path, 'rb', buffering = 0) as f:
+        return probeHandle(f, path)
+
+def scanTiles(root):
+    """ Yield the paths of all tile files under root """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks = False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in PROBE_EXTS:
+                    yield entry.path
+
+def safeProbeFile(path):
+    try:
+        return probeFile(path)
+    except (ValueError, struct.error, OSError) as e:
+        return e
+
+def probeTree(root, workers = 32):
+    """ Probe every tile under root on a thread pool, yielding ProbeRecords
+        (or the exception raised for an unreadable file) as they finish,
+        in scan order. Only PROBE_BATCH files are in flight at a time. """
+    paths = scanTiles(root)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        while True:
+            batch = list(itertools.islice(paths, PROBE_BATCH))
+            if not batch:
+                break
+            for result in executor.map(safeProbeFile, batch):
+                yield result
+
+class ProbeStats:
+    """ Aggregate counts, byte totals, and per-section size histograms
+        (in power-of-two buckets) over many ProbeRecords """
+    def __init__(self):
+        self.counts = Counter()
+        self.bytes = Counter()
+        self.histograms = defaultdict(Counter)
+        self.errors = 0
+
+    def add(self, record, top_level = True):
+        """ Add a record; inner tiles of a cmpt are counted per format and
+            per section, but only whole files count towards the totals """
+        if isinstance(record, Exception):
+            self.errors += 1
+            return
+        self.counts[record.magic] += 1
+        self.bytes[record.magic] += record.length
+        if top_level:
+            self.bytes['total'] += record.length
+            self.histograms['total'][record.length.bit_length()] += 1
+        if record.tiles is not None:
+            for tile in record.tiles:
+                self.add(tile, False)
+            return
+        for section in SECTIONS:
+            size = getattr(record, section)
+            self.bytes[section] += size
+            self.histograms[section][size.bit_length()] += 1
+
+    def report(self):
+        for magic in sorted(self.counts):
+            print("%s: %d tiles, %d bytes" % (magic, self.counts[magic], self.bytes[magic]))
+        if self.errors:
+            print("Unreadable files: %d" % (self.errors))
+        for name in ('total',) + SECTIONS:
+            histogram = self.histograms[name]
+            if not histogram:
+                continue
+            print("%s sizes (%d bytes):" % (name, self.bytes[name]))
+            for bucket in sorted(histogram):
+                lo = 0 if bucket == 0 else 1 << (bucket - 1)
+                print("\t[%d, %d): %d" % (lo, 1 << bucket, histogram[bucket]))
+
+def printProbe(record, indent = 0):
+    s_indent = '\t' * indent
+    print("%s%s File (%s, %d bytes):" % (s_indent, record.magic.upper(), record.path, record.length))
+    if record.tiles is not None:
+        for tile in record.tiles:
+            printProbe(tile, indent + 1)
+        return
+    for section in SECTIONS:
+        print("%s\t%s length: %d" % (s_indent, section, getattr(record, section)))
 
 def main():
     """ Pack one or more i3dm and/or b3dm files into a cmpt"""
 
     # Parse options and get results
-    parser = argparse.ArgumentParser(description='Parses a cmpt, b3dm, i3dm, or glb file, and prints info about it')
-    parser.add_argument('input_file')
+    parser = argparse.ArgumentParser(description='Parses a cmpt, b3dm, i3dm, pnts, or glb file, and prints info about it')
+    parser.add_argument('-p', '--probe', action='store_true', \
+                        help='Read only the tile headers, rather than decoding the whole file')
+    parser.add_argument('-j', '--jobs', type=int, default=32, \
+                        help='Threads probing files when the input is a directory')
+    parser.add_argument('input_file', help='Tile file, or a directory of tiles to summarize')
     args = parser.parse_args()
 
-    with open(args.input_file, 'rb') as f:
-        parseFile(f.read(), indent = 0)
+    if os.path.isdir(args.input_file):
+        stats = ProbeStats()
+        for record in probeTree(args.input_file, args.jobs):
+            stats.add(record)
+        stats.report()
+    elif args.probe:
+        printProbe(probeFile(args.input_file))
+    else:
+        with open(args.input_file, 'rb') as f:
+            parseFile(f.read(), indent = 0)
 
 if __name__ == '__main__':
     main()
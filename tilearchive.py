@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# tilearchive.py: Pack many tiles into a single 3TZ archive, and read any
+# tile back out of one by path without extracting it. Component of
+# gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# A 3TZ archive is a zip file whose last entry, '@3dtilesIndex1@', is an
+# uncompressed index of (MD5 of entry path, offset of local file header)
+# pairs: 16 bytes of hash and a little-endian uint64 each, sorted by the
+# hash read as two little-endian uint64s, low half first.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import hashlib
+import mmap
+import struct
+import zipfile
+import zlib
+
+ARCHIVE_EXT = '.3tz'
+INDEX_NAME = '@3dtilesIndex1@'
+INDEX_ENTRY = struct.Struct('<16sQ')
+LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+ZIP64_EXTRA_ID = 0x0001
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)		# Fixed, so archives are reproducible
+
+def normalizePath(path):
+	return path.replace(os.sep, '/').lstrip('/')
+
+def pathHash(path):
+	return hashlib.md5(normalizePath(path).encode('utf-8')).digest()
+
+def indexOrder(entry):
+	lo, hi = struct.unpack('<QQ', entry[0])
+	return (lo, hi)
+
+class TileArchiveWriter:
+	""" Write tiles into a 3TZ archive. Tiles are stored uncompressed (so
+		that readers can return them without copying), unless compress
+		is set. Use add() for encoded tiles already in memory, such as the
+		output of writeBinary(), or open() to get a file handle that
+		encoders like CmptEncoder.export_to_handle() can write into. """
+	def __init__(self, filename, compress = False):
+		self.compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+		self.zip = zipfile.ZipFile(filename, 'w', self.compression, allowZip64 = True)
+		self.entries = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def newEntry(self, path):
+		path = normalizePath(path)
+		if path == INDEX_NAME:
+			raise NameError("'%s' is reserved for the archive index" % path)
+		info = zipfile.ZipInfo(path, ZIP_DATE_TIME)
+		info.compress_type = self.compression
+		self.entries.append((pathHash(path), info))
+		return info
+
+	def add(self, path, data):
+		self.zip.writestr(self.newEntry(path), data)
+
+	def addFile(self, path, filename):
+		with open(filename, 'rb') as f:
+			with self.open(path) as handle:
+				while True:
+					chunk = f.read(1 << 20)
+					if not chunk:
+						break
+					handle.write(chunk)
+
+	def open(self, path):
+		return self.zip.open(self.newEntry(path), 'w', force_zip64 = True)
+
+	def close(self):
+		if self.zip is None:
+			return
+		index = sorted(((digest, info.header_offset) for digest, info in self.entries), key = indexOrder)
+		info = zipfile.ZipInfo(INDEX_NAME, ZIP_DATE_TIME)
+		info.compress_type = zipfile.ZIP_STORED
+		self.zip.writestr(info, b''.join(INDEX_ENTRY.pack(*entry) for entry in index))
+		self.zip.close()
+		self.zip = None
+
+class TileArchiveReader:
+	""" Random access to the tiles in a 3TZ archive. The archive is
+		mmapped and its index loaded into a dict, so each get() is a
+		hash lookup plus parsing one local file header. Stored tiles are
+		returned by get() as zero-copy memoryviews of the mapping, which
+		must all be released (or dropped) before close(); read() returns
+		a copy instead, which outlives the reader. """
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		self.mmap = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		self.data = memoryview(self.mmap)
+		self.index = {}
+		self.loadIndex()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		""" Close the archive. The mapping cannot be closed while views
+			from get() are alive, which raises BufferError, but the file
+			is closed regardless. """
+		try:
+			self.data.release()
+			self.mmap.close()
+		finally:
+			self.file.close()
+
+	def loadIndex(self):
+		with zipfile.ZipFile(self.file) as z:
+			try:
+				info = z.getinfo(INDEX_NAME)
+			except KeyError:
+				info = None
+			if info is None:
+				# Not a 3TZ, just a zip: index it from the central directory
+				for entry in z.infolist():
+					self.index[pathHash(entry.filename)] = entry.header_offset
+				return
+		_, index = self.entryData(info.header_offset)
+		for offset in range(0, len(index) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+			digest, header_offset = INDEX_ENTRY.unpack_from(index, offset)
+			self.index[digest] = header_offset
+
+	def entryData(self, offset):
+		""" Returns (path, data) for the entry whose local header is at offset """
+		(magic, _, flags, method, _, _, _, compressed_size, size, name_len, extra_len) = \
+			LOCAL_HEADER.unpack_from(self.data, offset)
+		if magic != LOCAL_HEADER_MAGIC:
+			raise IOError("No zip local file header at offset %d" % offset)
+		name_start = offset + LOCAL_HEADER.size
+		path = bytes(self.data[name_start : name_start + name_len]).decode('utf-8')
+		extra = self.data[name_start + name_len : name_start + name_len + extra_len]
+		if 0xFFFFFFFF in (compressed_size, size):
+			size, compressed_size = self.zip64Sizes(extra)
+		elif flags & 0x08 and not compressed_size:
+			raise IOError("'%s' has its size only in a data descriptor" % path)
+
+		start = name_start + name_len + extra_len
+		data = self.data[start : start + compressed_size]
+		if method == zipfile.ZIP_STORED:
+			return path, data
+		elif method == zipfile.ZIP_DEFLATED:
+			return path, zlib.decompress(data, -15)
+		raise IOError("'%s' uses unsupported compression method %d" % (path, method))
+
+	@staticmethod
+	def zip64Sizes(extra):
+		offset = 0
+		while offset + 4 <= len(extra):
+			extra_id, extra_size = struct.unpack_from('<HH', extra, offset)
+			if extra_id == ZIP64_EXTRA_ID:
+				return struct.unpack_from('<QQ', extra, offset + 4)
+			offset += 4 + extra_size
+		raise IOError("Missing zip64 sizes")
+
+	def get(self, path):
+		""" Returns the tile at path as a memoryview (or bytes, if it was
+			compressed); raises KeyError if there is no such tile. The view
+			is only valid until close(). """
+		offset = self.index.get(pathHash(path))
+		if offset is None:
+			raise KeyError(path)
+		found, data = self.entryData(offset)
+		if found != normalizePath(path):
+			raise KeyError(path)
+		return data
+
+	def read(self, path):
+		""" Returns a copy of the tile at path as bytes, which stays
+			valid after close() """
+		data = self.get(path)
+		if isinstance(data, memoryview):
+			with data:
+				return bytes(data)
+		return data
+
+	def __contains__(self, path):
+		return pathHash(path) in self.index
+
+	def __len__(self):
+		return len(self.index)
+
+def main():
+	""" Pack a directory of tiles into a 3TZ archive, or extract one tile """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Packs tiles into a 3TZ archive, or extracts one tile from it')
+	parser.add_argument("-o", "--output", type=str, required=True, \
+	                    help="Archive to create (or to read, with -x)")
+	parser.add_argument("-x", "--extract", type=str, \
+	                    help="Path of a tile in the archive to write to the input path")
+	parser.add_argument("-z", "--compress", action='store_true', \
+	                    help="Deflate tiles rather than storing them")
+	parser.add_argument("input", help="Directory to pack (or, with -x, file to extract to)")
+	args = parser.parse_args()
+
+	if args.extract:
+		with TileArchiveReader(args.output) as reader:
+			with open(args.input, 'wb') as f:
+				f.write(reader.get(args.extract))
+		return
+
+	if not os.path.isdir(args.input):
+		print("Input must be a directory of tiles!")
+		sys.exit(-1)
+
+	output = args.output + ('' if args.output.endswith(ARCHIVE_EXT) else ARCHIVE_EXT)
+	with TileArchiveWriter(output, args.compress) as writer:
+		for dirpath, _, filenames in os.walk(args.input):
+			for filename in sorted(filenames):
+				full_path = os.path.join(dirpath, filename)
+				writer.addFile(os.path.relpath(full_path, args.input), full_path)
+
+if __name__ == "__main__":
+	main()
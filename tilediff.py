@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# tilediff.py: Compare two builds of a tile tree section by section, and
+# report only the tiles that really changed. Component of gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# Every tile is split into its header, feature table JSON and binary,
+# batch table JSON and binary, and GLB, each hashed with BLAKE2b; the
+# inner tiles of a cmpt are split the same way, with their sections named
+# '<index>/<section>'. Any bytes after the last section are hashed as a
+# 'trailing' section. Any other file is hashed whole. Hashes are kept in
+# a JSON manifest keyed by path, along with each file's size and mtime,
+# so that a later run only rehashes files that have been touched.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import hashlib
+import itertools
+import json
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import packcmpt as cmpt
+import tile3dinfo
+
+MANIFEST_VERSION = 1
+DIGEST_SIZE = 16
+HASH_BATCH = 4096				# Files in flight at once
+
+def digest(data):
+	return hashlib.blake2b(data, digest_size = DIGEST_SIZE).hexdigest()
+
+def hashSections(data, path, prefix = ''):
+	""" Returns {section name: digest} for the tile in data """
+	record = tile3dinfo.probeHeader(bytes(data[0:tile3dinfo.PROBE_LEN]), path)
+	_, header_len = tile3dinfo.HEADER_FORMATS[record.magic]
+	hashes = {prefix + 'header': digest(data[0:header_len])}
+	offset = header_len
+
+	if record.magic == cmpt.CMPT_MAGIC:
+		count = struct.unpack_from('<I', data, 12)[0]
+		for i in range(count):
+			length = struct.unpack_from('<I', data, offset + 8)[0]
+			hashes.update(hashSections(data[offset : offset + length], path, '%s%d/' % (prefix, i)))
+			offset += length
+	else:
+		for section in tile3dinfo.SECTIONS:
+			size = getattr(record, section)
+			if size:
+				hashes[prefix + section] = digest(data[offset : offset + size])
+			offset += size
+
+	# Bytes past the sections, such as junk after the declared length,
+	# would otherwise change nothing
+	if offset < len(data):
+		hashes[prefix + 'trailing'] = digest(data[offset:])
+	return hashes
+
+def hashFile(path):
+	""" Returns the section hashes of a file: a tile's sections, or a
+		single 'data' hash for anything else (including broken tiles) """
+	with open(path, 'rb') as f:
+		if not os.fstat(f.fileno()).st_size:
+			return {'data': digest(b'')}
+		with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+			data = memoryview(m)
+			try:
+				if os.path.splitext(path)[1].lower() in tile3dinfo.PROBE_EXTS:
+					try:
+						return hashSections(data, path)
+					except (ValueError, struct.error):
+						pass
+				return {'data': digest(data)}
+			finally:
+				data.release()
+
+def scanFiles(root):
+	""" Yield (relative path, os.stat_result) for every file under root """
+	stack = [root]
+	while stack:
+		with os.scandir(stack.pop()) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks = False):
+					stack.append(entry.path)
+				elif entry.is_file():
+					rel_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+					yield rel_path, entry.stat()
+
+def hashTree(root, manifest = None, workers = 8):
+	""" Returns a manifest of every file under root. Files whose size and
+		mtime match their entry in a previous manifest keep its hashes,
+		rather than being read again. """
+	previous = manifest['files'] if manifest else {}
+	files = {}
+
+	def hashEntry(item):
+		rel_path, stat = item
+		entry = previous.get(rel_path)
+		if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+			entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, \
+			         'sections': hashFile(os.path.join(root, rel_path))}
+		return rel_path, entry
+
+	items = scanFiles(root)
+	with ThreadPoolExecutor(max_workers = workers) as executor:
+		while True:
+			batch = list(itertools.islice(items, HASH_BATCH))
+			if not batch:
+				break
+			files.update(executor.map(hashEntry, batch))
+	return {'version': MANIFEST_VERSION, 'files': dict(sorted(files.items()))}
+
+def loadManifest(path):
+	with open(path, 'r') as f:
+		manifest = json.loads(f.read())
+	if manifest.get('version') != MANIFEST_VERSION:
+		raise ValueError("%s: unsupported manifest version %s" % (path, manifest.get('version')))
+	return manifest
+
+def saveManifest(manifest, path):
+	# Written beside the target and renamed, so an interrupted run never
+	# leaves a truncated manifest behind
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		f.write(json.dumps(manifest, separators=(',', ':'), sort_keys=True))
+	os.replace(tmp_path, path)
+
+def diffManifests(old, new):
+	""" Returns (added, removed, modified), where modified maps each
+		changed path to the sorted names of its changed sections """
+	old_files, new_files = old['files'], new['files']
+	added = sorted(set(new_files) - set(old_files))
+	removed = sorted(set(old_files) - set(new_files))
+	modified = {}
+	for rel_path in sorted(set(old_files) & set(new_files)):
+		old_sections = old_files[rel_path]['sections']
+		new_sections = new_files[rel_path]['sections']
+		if old_sections != new_sections:
+			modified[rel_path] = sorted(name for name in set(old_sections) | set(new_sections) \
+			                            if old_sections.get(name) != new_sections.get(name))
+	return added, removed, modified
+
+def main():
+	""" Report the tiles that differ between two builds """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Lists the files that changed between two tile trees, by section')
+	parser.add_argument('-m', '--manifest', type=str, default=None, \
+	                    help='Manifest of the new tree: reused to skip unchanged files if it exists, then updated')
+	parser.add_argument('-o', '--output', type=str, default=None, \
+	                    help='Write the changes as JSON to this path, rather than listing them')
+	parser.add_argument('-j', '--jobs', type=int, default=8, \
+	                    help='Threads hashing files')
+	parser.add_argument('old', help='Previous tree, or a manifest of it')
+	parser.add_argument('new', help='New tree')
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.new):
+		print("New tree must be a directory!")
+		sys.exit(-1)
+
+	old = hashTree(args.old, None, args.jobs) if os.path.isdir(args.old) else loadManifest(args.old)
+	cached = loadManifest(args.manifest) if args.manifest and os.path.exists(args.manifest) else None
+	new = hashTree(args.new, cached, args.jobs)
+	if args.manifest:
+		saveManifest(new, args.manifest)
+
+	added, removed, modified = diffManifests(old, new)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(json.dumps({'added': added, 'removed': removed, 'modified': modified}, indent = 1, sort_keys = True))
+	else:
+		for rel_path in added:
+			print("A %s" % rel_path)
+		for rel_path in removed:
+			print("D %s" % rel_path)
+		for rel_path, sections in modified.items():
+			print("M %s (%s)" % (rel_path, ', '.join(sections)))
+
+	# Like diff(1): nonzero when anything changed
+	sys.exit(1 if added or removed or modified else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# tileserver.py: Resident tile encoding service. Accepts encode, decode,
+# and pack jobs over a Unix socket (or localhost TCP) and runs them on a
+# pool of warm worker processes. Component of gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# Wire protocol (both directions): a little-endian uint32 giving the
+# length of a UTF-8 JSON header, the header itself, and then the binary
+# parts whose lengths are listed in the header's 'parts' array.
+#
+# Requests carry an 'op' of 'b3dm', 'i3dm', 'pnts', 'cmpt', or 'unpack':
+# - b3dm:   parts [glb], optional 'batch' and 'objectwise'
+# - i3dm:   parts [glb], required 'instances', optional 'batch'
+# - pnts:   no parts, required 'features', optional 'batch'
+# - cmpt:   parts [tile, tile, ...]
+# - unpack: parts [b3dm/i3dm/pnts], responds with the feature and batch
+#           JSON in the header and the GLB (if any) as the only part
+# Responses carry 'ok' and either 'error' or the encoded tile as a part.
+# A request whose header is malformed or larger than the server's limit
+# gets an error response, and its connection is closed.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import contextlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import b3dm
+import i3dm
+import pnts
+import packcmpt as cmpt
+from bufferpool import assemble
+
+PROTOCOL_HEADER_LEN = 4
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_QUEUE_LEN = 64
+DEFAULT_MAX_CONNECTIONS = 128
+DEFAULT_MAX_MESSAGE = 1 << 30		# Bytes of header and parts in one request
+MAX_HEADER_LEN = 1 << 26
+DISCARD_CHUNK = 1 << 16
+INITIAL_BLOCK_SIZE = 1 << 20		# Bytes of shared memory per output block, at first
+
+def recvExactly(sock, buf, length):
+	""" Receive exactly length bytes into the bytearray buf, growing
+		it if needed, and return a memoryview of the received bytes """
+	if len(buf) < length:
+		buf.extend(bytes(length - len(buf)))
+	view = memoryview(buf)[:length]
+	received = 0
+	while received < length:
+		count = sock.recv_into(view[received:], length - received)
+		if not count:
+			raise EOFError("Connection closed mid-message")
+		received += count
+	return view
+
+class ProtocolError(ValueError):
+	pass
+
+def recvHeader(sock, buf, max_message = None):
+	""" Read a message's header, checking that neither it nor the parts
+		it announces are larger than max_message bytes in total """
+	header_len = struct.unpack('<I', recvExactly(sock, buf, PROTOCOL_HEADER_LEN))[0]
+	limit = MAX_HEADER_LEN if max_message is None else min(MAX_HEADER_LEN, max_message)
+	if header_len > limit:
+		raise ProtocolError("Header of %d bytes is too large" % header_len)
+	header = json.loads(bytes(recvExactly(sock, buf, header_len)))
+	if not isinstance(header, dict):
+		raise ProtocolError("Header must be a JSON object")
+	part_lens = header.get('parts', [])
+	if not isinstance(part_lens, list) or not all(isinstance(n, int) and n >= 0 for n in part_lens):
+		raise ProtocolError("'parts' must be a list of lengths")
+	if max_message is not None and header_len + sum(part_lens) > max_message:
+		raise ProtocolError("Message of %d bytes is too large" % (header_len + sum(part_lens)))
+	return header
+
+def recvParts(sock, buf, header):
+	""" Read the parts announced by a header. Parts are copied out of the
+		reusable receive buffer so they can be shipped to a worker
+		process """
+	return [bytes(recvExactly(sock, buf, part_len)) for part_len in header.get('parts', [])]
+
+def skipParts(sock, buf, header):
+	""" Read and drop the parts announced by a header, a chunk at a time """
+	remaining = sum(header.get('parts', []))
+	while remaining:
+		count = min(remaining, DISCARD_CHUNK)
+		recvExactly(sock, buf, count)
+		remaining -= count
+
+def recvMessage(sock, buf):
+	""" Read one message; returns (header, [parts]) """
+	header = recvHeader(sock, buf)
+	return header, recvParts(sock, buf, header)
+
+def sendMessage(sock, header, parts = ()):
+	header = dict(header)
+	header['parts'] = [len(part) for part in parts]
+	header_json = json.dumps(header, separators=(',', ':')).encode('utf-8')
+	sock.sendall(struct.pack('<I', len(header_json)) + header_json)
+	for part in parts:
+		sock.sendall(part)
+
+""" Job implementations. These run inside the worker processes, and
+	write their output tile straight into a shared memory block that the
+	server lends to the job, so that the tile is never pickled or copied
+	on its way back to the server. """
+worker_encoders = {}
+worker_blocks = OrderedDict()
+worker_max_blocks = DEFAULT_QUEUE_LEN
+
+def workerInit(max_blocks):
+	""" Runs once in each worker process as it starts. The server has at
+		most one output block per queue slot, so a worker keeps no more
+		than max_blocks of them attached. """
+	global worker_max_blocks
+	worker_max_blocks = max_blocks
+
+def workerEncoder(encoder_class):
+	""" Returns this worker's (reset) instance of an encoder class """
+	if encoder_class not in worker_encoders:
+		worker_encoders[encoder_class] = encoder_class()
+	encoder = worker_encoders[encoder_class]
+	encoder.reset()
+	return encoder
+
+def workerBlock(name):
+	""" Returns this worker's attachment to a server output block. Blocks
+		the server has since replaced fall out of the cache and are
+		detached once more than worker_max_blocks are attached. """
+	if name in worker_blocks:
+		worker_blocks.move_to_end(name)
+	else:
+		worker_blocks[name] = shared_memory.SharedMemory(name)
+		while len(worker_blocks) > worker_max_blocks:
+			worker_blocks.popitem(last = False)[1].close()
+	return worker_blocks[name]
+
+class BlockOutput:
+	""" Stands in for a BufferPool in assemble(), handing out the job's
+		output block if the tile fits in it, and a new bytearray (along
+		with the size the server should grow the block to) if not """
+	def __init__(self, name, size):
+		self.name = name
+		self.size = size
+		self.needed = 0
+
+	def acquire(self, size):
+		if size > self.size:
+			self.needed = size
+			return bytearray(size)
+		return workerBlock(self.name).buf
+
+	def result(self, output):
+		""" Returns the (header, parts) for a job whose tile is output """
+		if self.needed:
+			return {'block_needed': self.needed}, [output.obj]
+		length = len(output)
+		output.release()
+		return {'block_length': length}, []
+
+def jobB3DM(header, parts, output):
+	encoder = workerEncoder(b3dm.B3DM)
+	if header.get('batch') is not None:
+		encoder.loadJSONBatch(header['batch'], header.get('objectwise', False))
+	return output.result(encoder.writeBinary(parts[0], pool = output))
+
+def jobI3DM(header, parts, output):
+	encoder = workerEncoder(i3dm.I3DM)
+	encoder.loadJSONInstances(header['instances'], header.get('objectwise', False))
+	if header.get('batch') is not None:
+		encoder.loadJSONBatch(header['batch'], False)
+	return output.result(encoder.writeBinary(parts[0], True, pool = output))
+
+def jobPNTS(header, parts, output):
+	encoder = workerEncoder(pnts.PNTS)
+	encoder.loadJSONFeature(header['features'], header.get('objectwise', False))
+	if header.get('batch') is not None:
+		encoder.loadJSONBatch(header['batch'], False)
+	return output.result(encoder.writeBinary(pool = output))
+
+def jobCMPT(header, parts, output):
+	encoder = cmpt.CmptEncoder()
+	for part in parts:
+		encoder.add_content(part)
+	encoder.composeHeader()
+	return output.result(assemble([encoder.header, encoder.body], output))
+
+def jobUnpack(header, parts, output):
+	data = parts[0]
+	magic = data[0:4].decode('utf-8')
+	decoders = {b3dm.B3DM_MAGIC: b3dm.B3DM, i3dm.I3DM_MAGIC: i3dm.I3DM, pnts.PNTS_MAGIC: pnts.PNTS}
+	if magic not in decoders:
+		raise ValueError("Cannot unpack tile with magic '%s'" % magic)
+	decoder = decoders[magic]()
+	decoder.readBinary(data)
+	out_header = {
+		'magic': magic,
+		'feature_json': bytes(decoder.feature_json).decode('utf-8').rstrip(),
+		'batch_json': bytes(decoder.batch_json).decode('utf-8').rstrip(),
+	}
+	if not hasattr(decoder, 'gltf_bin'):
+		return out_header, []
+	block_header, block_parts = output.result(assemble([decoder.gltf_bin], output))
+	out_header.update(block_header)
+	return out_header, block_parts
+
+JOBS = {
+	'b3dm': jobB3DM,
+	'i3dm': jobI3DM,
+	'pnts': jobPNTS,
+	'cmpt': jobCMPT,
+	'unpack': jobUnpack,
+}
+
+def runJob(header, parts, block_name, block_size):
+	op = header.get('op')
+	if op not in JOBS:
+		raise ValueError("Unknown op '%s'" % op)
+	return JOBS[op](header, parts, BlockOutput(block_name, block_size))
+
+class OutputBlocks:
+	""" The server's shared memory blocks that jobs write their output
+		into, one per running or queued job. A block is lent to one job
+		at a time and only taken back once its tile has been sent; a
+		block too small for a tile is replaced by a larger one. """
+	def __init__(self, size = INITIAL_BLOCK_SIZE):
+		self.size = size
+		self.free = []
+		self.blocks = set()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			if self.free:
+				return self.free.pop()
+		block = shared_memory.SharedMemory(create = True, size = self.size)
+		with self.lock:
+			self.blocks.add(block)
+		return block
+
+	def release(self, block, needed = 0):
+		if needed > block.size:
+			with self.lock:
+				self.blocks.discard(block)
+			self.destroy(block)
+			block = shared_memory.SharedMemory(create = True, size = max(needed, 2 * block.size))
+			with self.lock:
+				self.blocks.add(block)
+		with self.lock:
+			self.free.append(block)
+
+	@staticmethod
+	def destroy(block):
+		block.close()
+		block.unlink()
+
+	def close(self):
+		with self.lock:
+			blocks, self.blocks, self.free = self.blocks, set(), []
+		for block in blocks:
+			self.destroy(block)
+
+class TileServerMixin:
+	""" Shared state for the Unix and TCP flavors of the server. Jobs
+		beyond the queue length are refused with a 'busy' error (or
+		wait up to queue_timeout seconds) before their parts are read,
+		and connections beyond max_connections are refused outright, so
+		clients see backpressure rather than unbounded memory and thread
+		growth in the server. A worker pool that breaks, such as when a
+		worker is killed, is replaced. """
+	def setupPool(self, workers, queue_len, queue_timeout, \
+	              max_connections = DEFAULT_MAX_CONNECTIONS, max_message = DEFAULT_MAX_MESSAGE):
+		# Workers attach to the output blocks too, and must register them
+		# with the server's resource tracker rather than starting their
+		# own, which would unlink the blocks when the worker exits
+		resource_tracker.ensure_running()
+		self.workers = workers
+		self.queue_len = queue_len
+		self.pool = self.newPool()
+		self.pool_lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(queue_len)
+		self.connections = threading.BoundedSemaphore(max_connections)
+		self.blocks = OutputBlocks()
+		self.queue_timeout = queue_timeout
+		self.max_message = max_message
+
+	def newPool(self):
+		return ProcessPoolExecutor(max_workers = self.workers, initializer = workerInit, \
+		                           initargs = (self.queue_len,))
+
+	def replacePool(self, broken):
+		""" Replace the worker pool, unless another thread already has """
+		with self.pool_lock:
+			if self.pool is broken:
+				self.pool = self.newPool()
+		broken.shutdown(wait = False)
+
+	@contextlib.contextmanager
+	def reserve(self):
+		""" Wait up to queue_timeout for a queue slot, yielding whether
+			one was reserved for the duration of the with block """
+		reserved = self.slots.acquire(timeout = self.queue_timeout)
+		try:
+			yield reserved
+		finally:
+			if reserved:
+				self.slots.release()
+
+	@contextlib.contextmanager
+	def submit(self, header, parts):
+		""" Run a job in a reserved queue slot, yielding its response
+			(header, parts). The encoded tile is a view of the job's
+			output block, so the response is only valid until the with
+			block exits. """
+		block = self.blocks.acquire()
+		needed = 0
+		try:
+			pool = self.pool
+			try:
+				out_header, out_parts = pool.submit(runJob, header, parts, block.name, block.size).result()
+			except BrokenProcessPool as e:
+				self.replacePool(pool)
+				yield {'ok': False, 'error': 'worker failed: %s' % e}, []
+				return
+			except Exception as e:
+				yield {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}, []
+				return
+			needed = out_header.pop('block_needed', 0)
+			length = out_header.pop('block_length', None)
+			out_header['ok'] = True
+			if length is None:
+				yield out_header, out_parts
+			else:
+				with block.buf[:length] as output:
+					yield out_header, out_parts + [output]
+		finally:
+			self.blocks.release(block, needed)
+
+	def process_request(self, request, client_address):
+		if not self.connections.acquire(blocking = False):
+			try:
+				sendMessage(request, {'ok': False, 'error': 'too many connections'})
+			except OSError:
+				pass
+			self.shutdown_request(request)
+			return
+		super().process_request(request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		try:
+			super().process_request_thread(request, client_address)
+		finally:
+			self.connections.release()
+
+	def server_close(self):
+		super().server_close()
+		self.pool.shutdown()
+		self.blocks.close()
+
+class TileRequestHandler(socketserver.BaseRequestHandler):
+	""" Serves any number of requests on one connection """
+	local = threading.local()
+
+	def handle(self):
+		# Each handler thread keeps one receive buffer for its lifetime
+		if not hasattr(self.local, 'buf'):
+			self.local.buf = bytearray()
+		buf = self.local.buf
+		while True:
+			try:
+				header = recvHeader(self.request, buf, self.server.max_message)
+			except EOFError:
+				return
+			except ValueError as e:
+				# The stream cannot be trusted past a bad header
+				sendMessage(self.request, {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)})
+				return
+
+			# A slot is reserved before the parts are read, so that a
+			# refused job never has its parts held in memory
+			with self.server.reserve() as reserved:
+				if not reserved:
+					skipParts(self.request, buf, header)
+					sendMessage(self.request, {'ok': False, 'error': 'busy'})
+					continue
+				parts = recvParts(self.request, buf, header)
+				with self.server.submit(header, parts) as (out_header, out_parts):
+					sendMessage(self.request, out_header, out_parts)
+
+class UnixTileServer(TileServerMixin, socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+class TCPTileServer(TileServerMixin, socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+def makeServer(socket_path = None, port = None, workers = DEFAULT_WORKERS, \
+               queue_len = DEFAULT_QUEUE_LEN, queue_timeout = 0, \
+               max_connections = DEFAULT_MAX_CONNECTIONS, max_message = DEFAULT_MAX_MESSAGE):
+	if socket_path:
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		server = UnixTileServer(socket_path, TileRequestHandler)
+	elif port:
+		server = TCPTileServer(('127.0.0.1', port), TileRequestHandler)
+	else:
+		raise ValueError("Either a socket path or a port is required")
+	server.setupPool(workers, queue_len, queue_timeout, max_connections, max_message)
+	return server
+
+class TileClient:
+	""" Minimal blocking client for the tile server """
+	def __init__(self, socket_path = None, port = None):
+		if socket_path:
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.connect(socket_path)
+		else:
+			self.sock = socket.create_connection(('127.0.0.1', port))
+		self.buf = bytearray()
+
+	def close(self):
+		self.sock.close()
+
+	def request(self, header, parts = ()):
+		sendMessage(self.sock, header, parts)
+		out_header, out_parts = recvMessage(self.sock, self.buf)
+		if not out_header.get('ok'):
+			raise IOError("Tile server error: %s" % out_header.get('error'))
+		return out_header, out_parts
+
+	def packB3DM(self, glb, batch = None, object_wise = False):
+		return self.request({'op': 'b3dm', 'batch': batch, 'objectwise': object_wise}, [glb])[1][0]
+
+	def packI3DM(self, glb, instances, batch = None):
+		return self.request({'op': 'i3dm', 'instances': instances, 'batch': batch}, [glb])[1][0]
+
+	def packPNTS(self, features, batch = None):
+		return self.request({'op': 'pnts', 'features': features, 'batch': batch})[1][0]
+
+	def packCMPT(self, tiles):
+		return self.request({'op': 'cmpt'}, tiles)[1][0]
+
+	def unpack(self, tile):
+		return self.request({'op': 'unpack'}, [tile])
+
+def main():
+	""" Run the tile encoding service until interrupted """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Resident tile encoding service')
+	parser.add_argument("-s", "--socket", type=str, \
+	                    help="Path of the Unix socket to listen on")
+	parser.add_argument("-p", "--port", type=int, \
+	                    help="Localhost TCP port to listen on, instead of a Unix socket")
+	parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, \
+	                    help="Number of worker processes")
+	parser.add_argument("-q", "--queue", type=int, default=DEFAULT_QUEUE_LEN, \
+	                    help="Maximum number of queued or running jobs before clients are refused")
+	parser.add_argument("-t", "--timeout", type=float, default=0, \
+	                    help="Seconds a job may wait for a queue slot before being refused")
+	parser.add_argument("-c", "--connections", type=int, default=DEFAULT_MAX_CONNECTIONS, \
+	                    help="Maximum number of open connections; more are refused")
+	parser.add_argument("-m", "--max-message", type=int, default=DEFAULT_MAX_MESSAGE, \
+	                    help="Maximum size in bytes of one request, including its parts")
+	args = parser.parse_args()
+
+	if not args.socket and not args.port:
+		print("One of -s/--socket or -p/--port must be specified!")
+		sys.exit(-1)
+
+	server = makeServer(args.socket, args.port, args.workers, args.queue, args.timeout, \
+	                    args.connections, args.max_message)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if args.socket and os.path.exists(args.socket):
+			os.unlink(args.socket)
+
+if __name__ == "__main__":
+	main()
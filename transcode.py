@@ -0,0 +1,834 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------
+# transcode.py: Convert 3D Tiles 1.0 b3dm, i3dm, and pnts tiles to and from
+# 3D Tiles 1.1 glTF content, in bulk. Component of gltf2glb.
+# (c) 2021 Geopipe, Inc.
+# All rights reserved. See LICENSE.
+#
+# - b3dm: _BATCHID becomes _FEATURE_ID_0 with EXT_mesh_features, and the
+#   batch table becomes an EXT_structural_metadata property table
+# - i3dm: instances become EXT_mesh_gpu_instancing on every mesh node,
+#   with EXT_instance_features for the batch table. EAST_NORTH_UP
+#   instances get the east/north/up frame of their ECEF position (plus
+#   RTC_CENTER), assuming the tileset does not rotate the tile.
+# - pnts: points become a single point-primitive mesh
+# RTC_CENTER is carried as the translation of a new root node, marked
+# with extras so the reverse direction can restore it. Tile-space (z-up)
+# positions, rotations, and normals are converted to glTF's y-up.
+#--------------------------------------------------------------------------
+
+import sys, os
+import argparse
+import json
+import mmap
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import b3dm
+import i3dm
+import pnts
+from batchtable import BatchTable
+from glb import GLB, GLTF_TYPES
+
+GLB_EXT = '.glb'
+TILE_EXTS = {'.b3dm', '.i3dm', '.pnts'}
+
+""" Rotation taking tile (z-up) coordinates to glTF (y-up) coordinates """
+Z_UP_TO_Y_UP = np.array([[1., 0., 0.], [0., 0., 1.], [0., -1., 0.]])
+
+""" WGS84 ellipsoid radii, for the up direction of EAST_NORTH_UP instances """
+WGS84_RADII = np.array([6378137., 6378137., 6356752.3142451793])
+
+""" Batch table binary component types, as numpy dtypes and as metadata component types """
+BATCH_COMPONENT_TYPES = {
+	'BYTE' : ('<i1', 'INT8'),
+	'UNSIGNED_BYTE' : ('<u1', 'UINT8'),
+	'SHORT' : ('<i2', 'INT16'),
+	'UNSIGNED_SHORT' : ('<u2', 'UINT16'),
+	'INT' : ('<i4', 'INT32'),
+	'UNSIGNED_INT' : ('<u4', 'UINT32'),
+	'FLOAT' : ('<f4', 'FLOAT32'),
+	'DOUBLE' : ('<f8', 'FLOAT64'),
+}
+METADATA_COMPONENT_TYPES = {meta: (dtype, name) for name, (dtype, meta) in BATCH_COMPONENT_TYPES.items()}
+METADATA_COMPONENT_TYPES['INT64'] = ('<i8', None)
+METADATA_COMPONENT_TYPES['UINT64'] = ('<u8', None)
+
+INT32_NO_DATA = -2**31
+FLOAT64_NO_DATA = -np.finfo(np.float64).max
+METADATA_CLASS = 'batch'
+
+""" Property tables """
+def parseJSON(data):
+	data = bytes(data).decode('utf-8').strip()
+	return json.loads(data) if data else {}
+
+def propertyId(key, used):
+	""" Metadata property ids must be identifiers; batch table keys need not be """
+	prop_id = re.sub(r'[^a-zA-Z0-9_]', '_', key)
+	if not re.match(r'[a-zA-Z_]', prop_id):
+		prop_id = '_' + prop_id
+	base, n = prop_id, 1
+	while prop_id in used:
+		prop_id = '%s_%d' % (base, n)
+		n += 1
+	return prop_id
+
+def encodeStrings(glb, strings):
+	encoded = [s.encode('utf-8') for s in strings]
+	offsets = np.zeros(len(encoded) + 1, dtype = '<u4')
+	np.cumsum([len(s) for s in encoded], out = offsets[1:])
+	return {
+		'values': glb.addBufferView(b''.join(encoded), alignment = 8),
+		'stringOffsets': glb.addBufferView(offsets, alignment = 8),
+		'stringOffsetType': 'UINT32',
+	}
+
+def encodeColumn(glb, values):
+	""" Encode one JSON batch table column; returns the class property
+		and the property table property """
+	present = [v for v in values if v is not None]
+	has_nulls = len(present) != len(values)
+
+	if present and not has_nulls and all(type(v) is bool for v in present):
+		bits = np.packbits(np.array(values, dtype = bool), bitorder = 'little')
+		return {'type': 'BOOLEAN'}, {'values': glb.addBufferView(bits, alignment = 8)}
+
+	if present and all(type(v) in (int, float) for v in present):
+		is_int = all(type(v) is int and INT32_NO_DATA < v < 2**31 for v in present)
+		component_type, no_data = ('INT32', INT32_NO_DATA) if is_int else ('FLOAT64', FLOAT64_NO_DATA)
+		column = np.array([no_data if v is None else v for v in values], \
+		                  dtype = METADATA_COMPONENT_TYPES[component_type][0])
+		class_prop = {'type': 'SCALAR', 'componentType': component_type}
+		if has_nulls:
+			class_prop['noData'] = no_data
+		return class_prop, {'values': glb.addBufferView(column, alignment = 8)}
+
+	# Strings, and anything else stored as its JSON
+	class_prop = {'type': 'STRING'}
+	if not all(type(v) is str for v in present):
+		class_prop['extras'] = {'json': True}
+		values = [None if v is None else json.dumps(v, separators=(',', ':'), sort_keys=True) for v in values]
+	no_data = ''
+	if has_nulls:
+		# The sentinel must not collide with a real value, such as ''
+		while no_data in present:
+			no_data += '\0'
+		class_prop['noData'] = no_data
+	return class_prop, encodeStrings(glb, [no_data if v is None else v for v in values])
+
+def addPropertyTable(glb, batch, batch_bin, count):
+	""" Add the batch table as an EXT_structural_metadata property table,
+		and return the table's index """
+	class_props = {}
+	table_props = {}
+	for key, column in sorted(batch.items()):
+		if key in ('extensions', 'extras'):
+			continue
+		prop_id = propertyId(key, class_props)
+		if isinstance(column, dict) and 'byteOffset' in column:
+			dtype, component_type = BATCH_COMPONENT_TYPES[column['componentType']]
+			components = GLTF_TYPES[column['type']]
+			values = np.frombuffer(batch_bin, dtype = dtype, count = count * components, \
+			                       offset = column['byteOffset'])
+			class_prop = {'type': column['type'], 'componentType': component_type, 'extras': {'binary': True}}
+			table_prop = {'values': glb.addBufferView(values, alignment = 8)}
+		else:
+			class_prop, table_prop = encodeColumn(glb, column)
+		if prop_id != key:
+			class_prop['name'] = key
+		class_props[prop_id] = class_prop
+		table_props[prop_id] = table_prop
+
+	extension = glb.gltf.setdefault('extensions', {}).setdefault('EXT_structural_metadata', {})
+	extension['schema'] = {'id': 'batch_table', 'classes': {METADATA_CLASS: {'properties': class_props}}}
+	tables = extension.setdefault('propertyTables', [])
+	tables.append({'class': METADATA_CLASS, 'count': count, 'properties': table_props})
+	glb.addExtension('EXT_structural_metadata')
+	return len(tables) - 1
+
+def bufferViewData(glb, index):
+	buffer_view = glb.gltf['bufferViews'][index]
+	return glb.bufferData(buffer_view.get('byteOffset', 0), buffer_view['byteLength'])
+
+def removePropertyTable(glb):
+	""" Remove the first EXT_structural_metadata property table, and
+		return it as (batch table JSON dict, batch table binary, count) """
+	extension = glb.gltf.get('extensions', {}).pop('EXT_structural_metadata', None)
+	glb.removeExtension('EXT_structural_metadata')
+	if not glb.gltf.get('extensions', True):
+		del glb.gltf['extensions']
+	if not extension or not extension.get('propertyTables'):
+		return {}, bytearray(), 0
+
+	table = extension['propertyTables'][0]
+	class_props = extension['schema']['classes'][table['class']]['properties']
+	count = table['count']
+	batch = {}
+	batch_bin = bytearray()
+	for prop_id, table_prop in table['properties'].items():
+		class_prop = class_props[prop_id]
+		key = class_prop.get('name', prop_id)
+		extras = class_prop.get('extras', {})
+		data = bufferViewData(glb, table_prop['values'])
+		if class_prop['type'] == 'BOOLEAN':
+			bits = np.unpackbits(np.frombuffer(data, dtype = np.uint8), count = count, bitorder = 'little')
+			batch[key] = bits.astype(bool).tolist()
+		elif class_prop['type'] == 'STRING':
+			offsets = np.frombuffer(bufferViewData(glb, table_prop['stringOffsets']), dtype = '<u4')
+			data = bytes(data)
+			values = [data[offsets[i] : offsets[i + 1]].decode('utf-8') for i in range(count)]
+			if 'noData' in class_prop:
+				values = [None if v == class_prop['noData'] else v for v in values]
+			if extras.get('json'):
+				values = [None if v is None else json.loads(v) for v in values]
+			batch[key] = values
+		else:
+			dtype, batch_type = METADATA_COMPONENT_TYPES[class_prop['componentType']]
+			components = GLTF_TYPES[class_prop['type']]
+			values = np.frombuffer(data, dtype = dtype, count = count * components)
+			if extras.get('binary') and batch_type:
+				offset = len(batch_bin) + 7 & ~7
+				batch_bin.extend(bytes(offset - len(batch_bin)))
+				batch_bin.extend(values.tobytes())
+				batch[key] = {'byteOffset': offset, 'componentType': batch_type, 'type': class_prop['type']}
+			else:
+				values = values.reshape(-1, components).tolist() if components > 1 else values.tolist()
+				if 'noData' in class_prop:
+					values = [None if v == class_prop['noData'] else v for v in values]
+				batch[key] = values
+	return batch, batch_bin, count
+
+""" Transforms """
+def zUpToYUp(vectors):
+	return np.asarray(vectors, dtype = np.float64) @ Z_UP_TO_Y_UP.T
+
+def yUpToZUp(vectors):
+	return np.asarray(vectors, dtype = np.float64) @ Z_UP_TO_Y_UP
+
+def quatToMatrix(q):
+	""" (n, 4) xyzw quaternions to (n, 3, 3) rotation matrices """
+	x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+	return np.stack([
+		np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis = -1),
+		np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis = -1),
+		np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis = -1),
+	], axis = 1)
+
+def matrixToQuat(m):
+	""" (n, 3, 3) rotation matrices to (n, 4) xyzw quaternions """
+	trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+	q = np.empty((m.shape[0], 4))
+	# Use whichever of w, x, y, z is largest to avoid dividing by ~0
+	cases = np.argmax(np.stack([trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]], axis = -1), axis = -1)
+	for case in range(4):
+		sel = cases == case
+		r = m[sel]
+		if case == 0:
+			s = np.sqrt(1 + trace[sel]) * 2
+			q[sel] = np.stack([(r[:, 2, 1] - r[:, 1, 2]) / s, (r[:, 0, 2] - r[:, 2, 0]) / s,
+			                   (r[:, 1, 0] - r[:, 0, 1]) / s, s / 4], axis = -1)
+		else:
+			i = case - 1
+			j, k = (i + 1) % 3, (i + 2) % 3
+			s = np.sqrt(1 + r[:, i, i] - r[:, j, j] - r[:, k, k]) * 2
+			out = np.empty((r.shape[0], 4))
+			out[:, i] = s / 4
+			out[:, j] = (r[:, j, i] + r[:, i, j]) / s
+			out[:, k] = (r[:, k, i] + r[:, i, k]) / s
+			out[:, 3] = (r[:, k, j] - r[:, j, k]) / s
+			q[sel] = out
+	return q / np.linalg.norm(q, axis = -1, keepdims = True)
+
+def eastNorthUp(positions):
+	""" (n, 3) east and north unit vectors of the local frame at ECEF
+		positions, whose up is the ellipsoid normal. On the polar axis,
+		where east is undefined, east is +y, as in CesiumJS. """
+	up = positions / WGS84_RADII**2
+	on_axis = (up[:, 0] == 0) & (up[:, 1] == 0)
+	up[on_axis] = [0., 0., 1.]
+	up[on_axis & (positions[:, 2] < 0)] = [0., 0., -1.]
+	up /= np.linalg.norm(up, axis = -1, keepdims = True)
+	east = np.stack([-up[:, 1], up[:, 0], np.zeros(len(up))], axis = -1)
+	east[on_axis] = [0., 1., 0.]
+	east /= np.linalg.norm(east, axis = -1, keepdims = True)
+	return east, np.cross(up, east)
+
+def composeTRS(translation, rotation_matrix, scale):
+	""" Build (n, 4, 4) matrices from translations, rotations, and scales """
+	m = np.zeros((translation.shape[0], 4, 4))
+	m[:, :3, :3] = rotation_matrix * scale[:, np.newaxis, :]
+	m[:, :3, 3] = translation
+	m[:, 3, 3] = 1
+	return m
+
+def decomposeTRS(m):
+	""" Split (n, 4, 4) matrices into translations, rotation matrices,
+		and scales. Any shear is dropped. """
+	scale = np.linalg.norm(m[:, :3, :3], axis = 1)
+	return m[:, :3, 3], m[:, :3, :3] / scale[:, np.newaxis, :], scale
+
+def nodeMatrix(node):
+	if 'matrix' in node:
+		return np.array(node['matrix'], dtype = np.float64).reshape(4, 4).T
+	t = np.array([node.get('translation', [0, 0, 0])], dtype = np.float64)
+	r = quatToMatrix(np.array([node.get('rotation', [0, 0, 0, 1])], dtype = np.float64))
+	s = np.array([node.get('scale', [1, 1, 1])], dtype = np.float64)
+	return composeTRS(t, r, s)[0]
+
+def globalMatrices(gltf):
+	""" Global transform of every node, ignoring an RTC root we added """
+	nodes = gltf.get('nodes', [])
+	parents = {}
+	for i, node in enumerate(nodes):
+		for child in node.get('children', []):
+			parents[child] = i
+	matrices = {}
+	def globalMatrix(i):
+		if i not in matrices:
+			parent = parents.get(i)
+			if nodes[i].get('extras', {}).get('RTC_CENTER') is not None:
+				matrices[i] = np.identity(4)
+			elif parent is None:
+				matrices[i] = nodeMatrix(nodes[i])
+			else:
+				matrices[i] = globalMatrix(parent) @ nodeMatrix(nodes[i])
+		return matrices[i]
+	return [globalMatrix(i) for i in range(len(nodes))]
+
+def addRTC(glb, rtc_center):
+	""" Wrap every scene's root nodes in a node translated to RTC_CENTER """
+	if rtc_center is None:
+		return
+	rtc_center = [float(v) for v in np.asarray(rtc_center)]
+	nodes = glb.gltf.setdefault('nodes', [])
+	for scene in glb.gltf.get('scenes', []):
+		nodes.append({
+			'translation': zUpToYUp(rtc_center).tolist(),
+			'children': scene.get('nodes', []),
+			'extras': {'RTC_CENTER': rtc_center},
+		})
+		scene['nodes'] = [len(nodes) - 1]
+
+def removeRTC(glb):
+	""" Undo addRTC(), returning the RTC_CENTER (or None). The unused root
+		nodes are left in place, rather than renumbering every node. """
+	rtc_center = None
+	nodes = glb.gltf.get('nodes', [])
+	for scene in glb.gltf.get('scenes', []):
+		if len(scene.get('nodes', [])) == 1:
+			root = nodes[scene['nodes'][0]]
+			if root.get('extras', {}).get('RTC_CENTER') is not None:
+				rtc_center = root['extras'].pop('RTC_CENTER')
+				scene['nodes'] = root.get('children', [])
+				root['children'] = []
+	return rtc_center
+
+""" Feature table semantics """
+def octDecode(encoded, bits):
+	""" Decode oct-encoded unit vectors, (n, 2) unsigned ints of the given width """
+	v = np.asarray(encoded, dtype = np.float64) / (2**bits - 1) * 2 - 1
+	z = 1 - np.abs(v[:, 0]) - np.abs(v[:, 1])
+	x, y = v[:, 0].copy(), v[:, 1].copy()
+	neg = z < 0
+	x[neg] = (1 - np.abs(v[neg, 1])) * np.sign(v[neg, 0])
+	y[neg] = (1 - np.abs(v[neg, 0])) * np.sign(v[neg, 1])
+	out = np.stack([x, y, z], axis = -1)
+	return out / np.linalg.norm(out, axis = -1, keepdims = True)
+
+def featurePositions(features):
+	""" Positions (float64, tile space, relative to RTC_CENTER) from
+		POSITION or POSITION_QUANTIZED """
+	if 'POSITION' in features.batch_in:
+		return np.asarray(features.batch_in['POSITION'], dtype = np.float64)
+	if 'POSITION_QUANTIZED' in features.batch_in:
+		scale = np.asarray(features.features_global['QUANTIZED_VOLUME_SCALE'], dtype = np.float64)
+		offset = np.asarray(features.features_global['QUANTIZED_VOLUME_OFFSET'], dtype = np.float64)
+		return features.batch_in['POSITION_QUANTIZED'] * (scale / 65535) + offset
+	raise KeyError("Feature table has neither POSITION nor POSITION_QUANTIZED")
+
+def featureIdExtension(count, table, attribute = True):
+	feature_ids = {'featureCount': max(int(count), 1)}
+	if attribute:
+		feature_ids['attribute'] = 0
+	if table is not None:
+		feature_ids['propertyTable'] = table
+	return {'featureIds': [feature_ids]}
+
+def loadBatch(decoder):
+	batch = BatchTable.expandHierarchy(parseJSON(decoder.batch_json), decoder.batch_bin)
+	return batch, decoder.batch_bin
+
+def newEncoderBatch(encoder, batch, batch_bin, count):
+	if batch:
+		encoder.loadJSONBatch(batch, False)
+		encoder.batch_table.batch_bin.extend(batch_bin)
+		encoder.batch_table.num_features = count
+
+""" b3dm """
+def b3dmToGLB(data):
+	decoder = b3dm.B3DM()
+	decoder.readBinary(data)
+	features = decoder.readFeatureTable()
+	count = features.features_global.get('BATCH_LENGTH', 0)
+
+	glb = GLB()
+	glb.readBinary(decoder.getGLTFBin())
+	batch, batch_bin = loadBatch(decoder)
+	table = addPropertyTable(glb, batch, batch_bin, count) if batch else None
+
+	for mesh in glb.gltf.get('meshes', []):
+		for primitive in mesh['primitives']:
+			attributes = primitive['attributes']
+			for legacy in ('_BATCHID', 'BATCHID'):
+				if legacy in attributes:
+					attributes['_FEATURE_ID_0'] = attributes.pop(legacy)
+					primitive.setdefault('extensions', {})['EXT_mesh_features'] = featureIdExtension(count, table)
+					glb.addExtension('EXT_mesh_features')
+
+	addRTC(glb, features.features_global.get('RTC_CENTER'))
+	return glb.writeBinary()
+
+def glbToB3DM(glb):
+	rtc_center = removeRTC(glb)
+	batch, batch_bin, count = removePropertyTable(glb)
+
+	for mesh in glb.gltf.get('meshes', []):
+		for primitive in mesh['primitives']:
+			extension = primitive.get('extensions', {}).pop('EXT_mesh_features', None)
+			if not primitive.get('extensions', True):
+				del primitive['extensions']
+			if extension:
+				feature_ids = extension['featureIds'][0]
+				count = max(count, feature_ids['featureCount'])
+				if 'attribute' in feature_ids:
+					attribute = '_FEATURE_ID_%d' % feature_ids['attribute']
+					primitive['attributes']['_BATCHID'] = primitive['attributes'].pop(attribute)
+	glb.removeExtension('EXT_mesh_features')
+
+	encoder = b3dm.B3DM()
+	newEncoderBatch(encoder, batch, batch_bin, count)
+	if rtc_center is not None:
+		encoder.feature_table.addGlobal('RTC_CENTER', rtc_center)
+	return encoder.writeBinary(glb.writeBinary(), count)
+
+""" i3dm """
+def instanceMatrices(features):
+	""" (n, 4, 4) instance transforms, in tile (z-up) space """
+	n = features.num_features
+	positions = featurePositions(features)
+	semantics = features.batch_in
+	if 'NORMAL_UP' in semantics and 'NORMAL_RIGHT' in semantics:
+		up = np.asarray(semantics['NORMAL_UP'], dtype = np.float64)
+		right = np.asarray(semantics['NORMAL_RIGHT'], dtype = np.float64)
+	elif 'NORMAL_UP_OCT32P' in semantics and 'NORMAL_RIGHT_OCT32P' in semantics:
+		up = octDecode(semantics['NORMAL_UP_OCT32P'], 16)
+		right = octDecode(semantics['NORMAL_RIGHT_OCT32P'], 16)
+	elif features.features_global.get('EAST_NORTH_UP'):
+		rtc_center = np.asarray(features.features_global.get('RTC_CENTER', [0, 0, 0]), dtype = np.float64)
+		right, up = eastNorthUp(positions + rtc_center)
+	else:
+		up = np.tile([0., 1., 0.], (n, 1))
+		right = np.tile([1., 0., 0.], (n, 1))
+	rotation = np.stack([right, up, np.cross(right, up)], axis = -1)
+
+	if 'SCALE_NON_UNIFORM' in semantics:
+		scale = np.asarray(semantics['SCALE_NON_UNIFORM'], dtype = np.float64)
+	elif 'SCALE' in semantics:
+		scale = np.repeat(np.asarray(semantics['SCALE'], dtype = np.float64)[:, np.newaxis], 3, axis = 1)
+	else:
+		scale = np.ones((n, 3))
+	return composeTRS(positions, rotation, scale)
+
+def i3dmToGLB(data):
+	decoder = i3dm.I3DM()
+	decoder.readBinary(data)
+	if not decoder.embed_gltf:
+		raise ValueError("Only i3dm files with an embedded GLB can be transcoded")
+	features = decoder.readFeatureTable()
+	n = features.num_features
+
+	glb = GLB()
+	glb.readBinary(decoder.getGLTFBin())
+	batch, batch_bin = loadBatch(decoder)
+	# Without BATCH_IDs, the batch table has one row per instance
+	count = features.features_global.get('BATCH_LENGTH', 0) if 'BATCH_ID' in features.batch_in else n
+	table = addPropertyTable(glb, batch, batch_bin, count) if batch else None
+
+	# Instance transforms in glTF (y-up) space
+	c = np.identity(4)
+	c[:3, :3] = Z_UP_TO_Y_UP
+	instances = c @ instanceMatrices(features) @ c.T
+
+	batch_ids = None
+	if 'BATCH_ID' in features.batch_in:
+		batch_ids = np.asarray(features.batch_in['BATCH_ID'])
+	elif batch:
+		batch_ids = np.arange(n, dtype = np.uint32)
+	if batch_ids is not None and batch_ids.dtype.itemsize > 2:
+		batch_ids = batch_ids.astype('<f4')		# glTF has no 32-bit feature ID attributes
+
+	# Each mesh node gets instances expressed in its own frame, so that
+	# the instance transform ends up outside the node's own transform
+	shared = None
+	matrices = globalMatrices(glb.gltf)
+	for i, node in enumerate(glb.gltf.get('nodes', [])):
+		if 'mesh' not in node:
+			continue
+		if np.allclose(matrices[i], np.identity(4)):
+			if shared is None:
+				shared = instanceAttributes(glb, instances, batch_ids)
+			attributes = shared
+		else:
+			local = np.linalg.inv(matrices[i]) @ instances @ matrices[i]
+			attributes = instanceAttributes(glb, local, batch_ids)
+		extensions = node.setdefault('extensions', {})
+		extensions['EXT_mesh_gpu_instancing'] = {'attributes': dict(attributes)}
+		if batch_ids is not None:
+			extensions['EXT_instance_features'] = featureIdExtension(count, table)
+	glb.addExtension('EXT_mesh_gpu_instancing', required = True)
+	if batch_ids is not None:
+		glb.addExtension('EXT_instance_features')
+
+	addRTC(glb, features.features_global.get('RTC_CENTER'))
+	return glb.writeBinary()
+
+def instanceAttributes(glb, matrices, batch_ids):
+	translation, rotation, scale = decomposeTRS(matrices)
+	attributes = {
+		'TRANSLATION': glb.addAccessor(translation.astype('<f4'), target = None),
+		'ROTATION': glb.addAccessor(matrixToQuat(rotation).astype('<f4'), target = None),
+		'SCALE': glb.addAccessor(scale.astype('<f4'), target = None),
+	}
+	if batch_ids is not None:
+		attributes['_FEATURE_ID_0'] = glb.addAccessor(batch_ids, target = None)
+	return attributes
+
+def glbToI3DM(glb):
+	rtc_center = removeRTC(glb)
+	batch, batch_bin, count = removePropertyTable(glb)
+
+	matrices = globalMatrices(glb.gltf)
+	instances = None
+	batch_ids = None
+	for i, node in enumerate(glb.gltf.get('nodes', [])):
+		extensions = node.get('extensions', {})
+		instancing = extensions.pop('EXT_mesh_gpu_instancing', None)
+		feature_ext = extensions.pop('EXT_instance_features', None)
+		if not extensions and 'extensions' in node:
+			del node['extensions']
+		if instancing is None or instances is not None:
+			continue
+
+		# Every instanced node carries the same instances, so the first
+		# one found is enough to recover them
+		attributes = instancing['attributes']
+		n = glb.gltf['accessors'][next(iter(attributes.values()))]['count']
+		t = glb.readAccessor(attributes['TRANSLATION']) if 'TRANSLATION' in attributes else np.zeros((n, 3))
+		r = glb.readAccessor(attributes['ROTATION']) if 'ROTATION' in attributes else np.tile([0., 0., 0., 1.], (n, 1))
+		s = glb.readAccessor(attributes['SCALE']) if 'SCALE' in attributes else np.ones((n, 3))
+		local = composeTRS(np.asarray(t, dtype = np.float64), quatToMatrix(np.asarray(r, dtype = np.float64)), \
+		                   np.asarray(s, dtype = np.float64))
+		instances = matrices[i] @ local @ np.linalg.inv(matrices[i])
+		if feature_ext:
+			feature_ids = feature_ext['featureIds'][0]
+			count = max(count, feature_ids['featureCount'])
+			if 'attribute' in feature_ids:
+				batch_ids = glb.readAccessor(attributes['_FEATURE_ID_%d' % feature_ids['attribute']])
+	if instances is None:
+		raise ValueError("GLB has no EXT_mesh_gpu_instancing nodes")
+	glb.removeExtension('EXT_mesh_gpu_instancing')
+	glb.removeExtension('EXT_instance_features')
+
+	# Back to tile (z-up) space
+	c = np.identity(4)
+	c[:3, :3] = Z_UP_TO_Y_UP
+	translation, rotation, scale = decomposeTRS(c.T @ instances @ c)
+	semantics = {
+		'POSITION': translation.astype('<f4'),
+		'NORMAL_RIGHT': rotation[:, :, 0].astype('<f4'),
+		'NORMAL_UP': rotation[:, :, 1].astype('<f4'),
+	}
+	if not np.allclose(scale, 1):
+		semantics['SCALE_NON_UNIFORM'] = scale.astype('<f4')
+	if batch_ids is not None:
+		semantics['BATCH_ID'] = np.asarray(batch_ids).astype(np.uint32)
+
+	encoder = i3dm.I3DM()
+	encoder.loadJSONInstances(semantics, False)
+	newEncoderBatch(encoder, batch, batch_bin, count)
+	if rtc_center is not None:
+		encoder.feature_table.addGlobal('RTC_CENTER', rtc_center)
+	return encoder.writeBinary(glb.writeBinary(), True, count)
+
+""" pnts """
+def rgb565ToRGB(packed):
+	packed = np.asarray(packed, dtype = np.uint32)
+	r = (packed >> 11) & 0x1f
+	g = (packed >> 5) & 0x3f
+	b = packed & 0x1f
+	return np.stack([r * 255 // 31, g * 255 // 63, b * 255 // 31], axis = -1).astype(np.uint8)
+
+def pntsToGLB(data):
+	decoder = pnts.PNTS()
+	decoder.readBinary(data)
+	features = decoder.readFeatureTable()
+	semantics = features.batch_in
+	glob = features.features_global
+
+	glb = GLB()
+	batch, batch_bin = loadBatch(decoder)
+	count = glob.get('BATCH_LENGTH', 0) or (features.num_features if batch and 'BATCH_ID' not in semantics else 0)
+	table = addPropertyTable(glb, batch, batch_bin, count) if batch else None
+
+	attributes = {'POSITION': glb.addAccessor(zUpToYUp(featurePositions(features)).astype('<f4'), bounds = True)}
+	if 'RGBA' in semantics:
+		attributes['COLOR_0'] = glb.addAccessor(np.asarray(semantics['RGBA'], dtype = np.uint8), normalized = True)
+	elif 'RGB' in semantics:
+		attributes['COLOR_0'] = glb.addAccessor(np.asarray(semantics['RGB'], dtype = np.uint8), normalized = True)
+	elif 'RGB565' in semantics:
+		attributes['COLOR_0'] = glb.addAccessor(rgb565ToRGB(semantics['RGB565']), normalized = True)
+	if 'NORMAL' in semantics:
+		attributes['NORMAL'] = glb.addAccessor(zUpToYUp(semantics['NORMAL']).astype('<f4'))
+	elif 'NORMAL_OCT16P' in semantics:
+		attributes['NORMAL'] = glb.addAccessor(zUpToYUp(octDecode(semantics['NORMAL_OCT16P'], 8)).astype('<f4'))
+
+	primitive = {'attributes': attributes, 'mode': 0}
+	if 'BATCH_ID' in semantics:
+		batch_ids = np.asarray(semantics['BATCH_ID'])
+		if batch_ids.dtype.itemsize > 2:
+			batch_ids = batch_ids.astype('<f4')		# glTF has no 32-bit feature ID attributes
+		attributes['_FEATURE_ID_0'] = glb.addAccessor(batch_ids)
+		primitive['extensions'] = {'EXT_mesh_features': featureIdExtension(count, table)}
+	elif batch:
+		# Feature IDs are implicitly the point indices
+		primitive['extensions'] = {'EXT_mesh_features': featureIdExtension(count, table, False)}
+	if 'extensions' in primitive:
+		glb.addExtension('EXT_mesh_features')
+
+	if 'CONSTANT_RGBA' in glob:
+		color = (np.asarray(glob['CONSTANT_RGBA'], dtype = np.float64) / 255).tolist()
+		glb.gltf['materials'] = [{'pbrMetallicRoughness': {'baseColorFactor': color}}]
+		primitive['material'] = 0
+
+	glb.gltf['meshes'] = [{'primitives': [primitive]}]
+	glb.gltf['nodes'] = [{'mesh': 0}]
+	glb.gltf['scenes'] = [{'nodes': [0]}]
+	glb.gltf['scene'] = 0
+	addRTC(glb, glob.get('RTC_CENTER'))
+	return glb.writeBinary()
+
+def glbToPNTS(glb):
+	rtc_center = removeRTC(glb)
+	batch, batch_bin, count = removePropertyTable(glb)
+
+	# Concatenate every point primitive's attributes
+	columns = {}
+	for mesh in glb.gltf.get('meshes', []):
+		for primitive in mesh['primitives']:
+			if primitive.get('mode', 4) != 0:
+				continue
+			attributes = primitive['attributes']
+			feature_ids = primitive.get('extensions', {}).get('EXT_mesh_features', {}).get('featureIds', [{}])[0]
+			count = max(count, feature_ids.get('featureCount', 0))
+			for name in ('POSITION', 'COLOR_0', 'NORMAL', '_FEATURE_ID_%d' % feature_ids.get('attribute', -1)):
+				if name in attributes:
+					values = glb.readAccessor(attributes[name])
+					if name == 'COLOR_0' and values.dtype.kind == 'f':
+						values = np.round(values * 255)
+					elif name == 'COLOR_0' and values.dtype == np.uint16:
+						values = values >> 8
+					columns.setdefault(name, []).append(values)
+
+	semantics = {'POSITION': yUpToZUp(np.concatenate(columns['POSITION'])).astype('<f4')}
+	if 'COLOR_0' in columns:
+		colors = np.concatenate(columns['COLOR_0']).astype(np.uint8)
+		semantics['RGBA' if colors.shape[1] == 4 else 'RGB'] = colors
+	if 'NORMAL' in columns:
+		semantics['NORMAL'] = yUpToZUp(np.concatenate(columns['NORMAL'])).astype('<f4')
+	for name in columns:
+		if name.startswith('_FEATURE_ID_'):
+			semantics['BATCH_ID'] = np.concatenate(columns[name]).astype(np.uint32)
+
+	encoder = pnts.PNTS()
+	encoder.loadJSONFeature(semantics, False)
+	newEncoderBatch(encoder, batch, batch_bin, count)
+	if rtc_center is not None:
+		encoder.feature_table.addGlobal('RTC_CENTER', rtc_center)
+	return encoder.writeBinary(count)
+
+""" Dispatch """
+TO_GLB = {
+	b3dm.B3DM_MAGIC: b3dmToGLB,
+	i3dm.I3DM_MAGIC: i3dmToGLB,
+	pnts.PNTS_MAGIC: pntsToGLB,
+}
+
+def tileToGLB(data):
+	magic = bytes(data[0:4]).decode('utf-8')
+	if magic not in TO_GLB:
+		raise ValueError('Cannot transcode tile with magic "%s"' % magic)
+	return TO_GLB[magic](data)
+
+def glbToTile(data):
+	""" Returns (magic, tile). The tile format is inferred from the GLB:
+		instancing means i3dm, only point primitives means pnts, and
+		anything else is b3dm. """
+	glb = GLB()
+	glb.readBinary(data)
+	modes = {primitive.get('mode', 4) for mesh in glb.gltf.get('meshes', []) for primitive in mesh['primitives']}
+	if 'EXT_mesh_gpu_instancing' in glb.gltf.get('extensionsUsed', []):
+		return i3dm.I3DM_MAGIC, glbToI3DM(glb)
+	elif modes == {0}:
+		return pnts.PNTS_MAGIC, glbToPNTS(glb)
+	return b3dm.B3DM_MAGIC, glbToB3DM(glb)
+
+def transcodeFile(src, dst_root, rel_path, reverse = False):
+	""" Transcode one file; returns its new path relative to dst_root """
+	with open(src, 'rb') as f:
+		if not os.fstat(f.fileno()).st_size:
+			raise ValueError("Empty file")			# mmap cannot map it
+		with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+			error = None
+			with memoryview(mapped) as data:
+				try:
+					if reverse:
+						magic, output = glbToTile(data)
+						ext = '.' + magic
+					else:
+						output = tileToGLB(data)
+						ext = GLB_EXT
+				except Exception as e:
+					# Drop the tracebacks, whose frames hold views of the
+					# mapping, so that the mapping can still be closed
+					error = e
+					while e is not None:
+						e.__traceback__ = None
+						e = e.__cause__ or e.__context__
+			if error is not None:
+				raise error
+	dst_rel = os.path.splitext(rel_path)[0] + ext
+	dst = os.path.join(dst_root, dst_rel)
+	os.makedirs(os.path.dirname(dst), exist_ok = True)
+	with open(dst, 'wb') as f:
+		f.write(output)
+	return dst_rel
+
+def rewriteTileset(src, dst, renamed, rel_dir, reverse):
+	""" Point a tileset's content URIs at the transcoded files """
+	with open(src, 'r') as f:
+		tileset = json.load(f)
+	tileset.setdefault('asset', {})['version'] = '1.0' if reverse else '1.1'
+	def visit(tile):
+		for content in ([tile['content']] if 'content' in tile else []) + tile.get('contents', []):
+			key = 'uri' if 'uri' in content else 'url'
+			if key in content:
+				rel = os.path.normpath(os.path.join(rel_dir, content[key]))
+				if rel in renamed:
+					content[key] = os.path.relpath(renamed[rel], rel_dir)
+		for child in tile.get('children', []):
+			visit(child)
+	visit(tileset['root'])
+	os.makedirs(os.path.dirname(dst), exist_ok = True)
+	with open(dst, 'w') as f:
+		json.dump(tileset, f, separators=(',', ':'))
+
+def copyFile(src_root, dst_root, rel_path):
+	dst = os.path.join(dst_root, rel_path)
+	os.makedirs(os.path.dirname(dst), exist_ok = True)
+	shutil.copy2(os.path.join(src_root, rel_path), dst)
+
+def isTileset(path):
+	with open(path, 'r') as f:
+		try:
+			return 'root' in json.load(f)
+		except ValueError:
+			return False
+
+def transcodeTree(src_root, dst_root, reverse = False, workers = None):
+	""" Transcode every tile under src_root into dst_root on a pool of
+		worker processes, copy every other file (cmpt tiles, external
+		glTF, textures, and so on), then rewrite any tileset JSON to
+		match. A tile that fails is reported and copied unchanged, and
+		the rest carry on. Returns (tiles transcoded, [(path, error)]). """
+	exts = {GLB_EXT} if reverse else TILE_EXTS
+	jobs = []
+	others = []
+	for dirpath, _, filenames in os.walk(src_root):
+		for filename in filenames:
+			rel_path = os.path.relpath(os.path.join(dirpath, filename), src_root)
+			if os.path.splitext(filename)[1].lower() in exts:
+				jobs.append(rel_path)
+			else:
+				others.append(rel_path)
+
+	errors = []
+	def report(rel_path, e):
+		errors.append((rel_path, '%s: %s' % (type(e).__name__, e)))
+
+	renamed = {}
+	tilesets = []
+	with ProcessPoolExecutor(max_workers = workers) as executor:
+		futures = [executor.submit(transcodeFile, os.path.join(src_root, rel_path), dst_root, rel_path, reverse) \
+		           for rel_path in jobs]
+
+		# Copy the other files while the tiles are transcoded
+		for rel_path in others:
+			try:
+				if rel_path.lower().endswith('.json') and isTileset(os.path.join(src_root, rel_path)):
+					tilesets.append(rel_path)
+				else:
+					copyFile(src_root, dst_root, rel_path)
+			except (OSError, UnicodeDecodeError) as e:
+				report(rel_path, e)
+
+		for rel_path, future in zip(jobs, futures):
+			try:
+				renamed[os.path.normpath(rel_path)] = future.result()
+			except Exception as e:
+				report(rel_path, e)
+				try:
+					copyFile(src_root, dst_root, rel_path)
+				except OSError as e:
+					report(rel_path, e)
+
+	for rel_path in tilesets:
+		try:
+			rewriteTileset(os.path.join(src_root, rel_path), os.path.join(dst_root, rel_path), \
+			               renamed, os.path.dirname(rel_path), reverse)
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			report(rel_path, e)
+	return len(renamed), sorted(errors)
+
+def main():
+	""" Transcode 3D Tiles 1.0 tiles to glTF (or back), in bulk """
+
+	# Parse options and get results
+	parser = argparse.ArgumentParser(description='Transcodes b3dm, i3dm, and pnts tiles to and from 3D Tiles 1.1 glTF')
+	parser.add_argument("-r", "--reverse", action='store_true', \
+	                    help="Transcode GLBs back to b3dm, i3dm, or pnts")
+	parser.add_argument("-j", "--jobs", type=int, default=None, \
+	                    help="Number of worker processes (defaults to the CPU count)")
+	parser.add_argument("input", help="Input tile or directory of tiles")
+	parser.add_argument("output", help="Output tile or directory")
+	args = parser.parse_args()
+
+	if os.path.isdir(args.input):
+		count, errors = transcodeTree(args.input, args.output, args.reverse, args.jobs)
+		for rel_path, error in errors:
+			print("%s: %s" % (rel_path, error), file = sys.stderr)
+		print("Transcoded %d tiles, with %d errors" % (count, len(errors)))
+		sys.exit(1 if errors else 0)
+	else:
+		with open(args.input, 'rb') as f:
+			data = f.read()
+		output = glbToTile(data)[1] if args.reverse else tileToGLB(data)
+		os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+		with open(args.output, 'wb') as f:
+			f.write(output)
+
+if __name__ == "__main__":
+	main()